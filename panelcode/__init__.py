@@ -1,11 +1,3 @@
 import os
 import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "libs"))
-
-import batcher
-import jinja2
-import markupsafe
-import mistune
-import pygments
-import pyparsing
-
@@ -0,0 +1,717 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the panelcode pipeline.
+Builds synthetic panelcode documents and times or counts the work done
+by the parser and renderers on them. Run all benchmarks, or name some:
+
+$ python -m panelcode.bench -b parse_count -n 200
+"""
+
+from __future__ import print_function
+import argparse
+import HTMLParser
+import os
+import pickle
+import StringIO
+import subprocess
+import sys
+import time
+from functools import wraps
+
+import panelcode.cssprune as cssprune
+import panelcode.fences as fences
+import panelcode.highlight as highlight
+import panelcode.lint as lint
+import panelcode.nodes as nodes
+import panelcode.parser as parser
+import panelcode.render as render
+import panelcode.scanner as scanner
+import panelcode.templates as templates
+import panelcode.treefile as treefile
+
+
+SAMPLE_BLOCKS = [
+    '1_2_3 {: img=a.png }',
+    '(r2+1,1)_3.c2 ; 0+2_u3 {| tall} | 4 {; broad}',
+    'c2+1,3 {dark} _ 2.x+1 _ u0 + u1 + 2u {! w3 ibefore}',
+    "1.z {: img='p1.jpg' } ; 1.z {: img='p2.jpg' } {@ autolabel}",
+]
+
+
+def sample_document(blocks=100, prose='Some *prose* between fences.'):
+    """Build a markdown document as a list of lines with many fenced
+    panelcode blocks separated by prose paragraphs.
+    """
+    lines = ['# Benchmark document', '']
+    for idx in range(blocks):
+        lines.extend([prose, '', '```',
+                      SAMPLE_BLOCKS[idx % len(SAMPLE_BLOCKS)],
+                      '```', ''])
+    return lines
+
+
+def sample_gallery(layouts=1000):
+    """Build one large panelcode gallery string of layouts and spreads."""
+    units = ['1_2_3', '(r2+1,1)_3.c2', '2.x+1,c2+1', '1.z {: img=p.jpg }']
+    spreads = []
+    for idx in range(0, layouts, 4):
+        spreads.append(' | '.join(units[:min(4, layouts - idx)]))
+    return ' ;\n'.join(spreads) + ' {@ autolabel }'
+
+
+def deep_sizeof(obj, seen=None):
+    """Approximate memory in bytes held by an object tree.
+    Shared objects, e.g. interned strings, are counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif isinstance(obj, nodes.Node):
+        for name in obj.__slots__:
+            size += deep_sizeof(getattr(obj, name), seen)
+    return size
+
+
+def best_of(func, repeat=3):
+    """Call func repeat times, return the fastest wall time in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+class CallCounter(object):
+    """Count calls to a module function while in a with block."""
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+        self.count = 0
+        self.func = None
+
+    def __enter__(self):
+        self.func = getattr(self.module, self.name)
+
+        @wraps(self.func)
+        def counted(*args, **kwargs):
+            """counting wrapper"""
+            self.count += 1
+            return self.func(*args, **kwargs)
+        setattr(self.module, self.name, counted)
+        return self
+
+    def __exit__(self, *exc_info):
+        setattr(self.module, self.name, self.func)
+
+
+class NoParseCache(object):
+    """Turn off the parser caches while in a with block, so that
+    benchmarks time and count real parses.
+    """
+    caches = (parser.PARSE_CACHE, parser.TREE_CACHE, scanner.SCAN_CACHE)
+
+    def __init__(self):
+        self.sizes = []
+
+    def __enter__(self):
+        for lru in self.caches:
+            self.sizes.append(lru.maxsize)
+            lru.resize(0)
+        return self
+
+    def __exit__(self, *exc_info):
+        for lru, size in zip(self.caches, self.sizes):
+            lru.resize(size)
+
+
+def bench_parse_count(blocks=100, out=sys.stdout):
+    """Count parser calls made rendering a fenced document.
+    The old two-pass pipeline parsed each block once for global opts
+    and once more for rendering: 2 * blocks parses.
+    """
+    data = sample_document(blocks)
+    with NoParseCache(), CallCounter(parser, 'parse_result') as counter:
+        seconds = best_of(lambda: render.parse_fenced_to_html(data), 1)
+    print('parse_count: %d blocks, %d parses (two-pass: %d), %.3fs' %
+          (blocks, counter.count, 2 * blocks, seconds), file=out)
+    return counter.count
+
+
+def bench_styles(blocks=100, out=sys.stdout):
+    """Page bytes with all styles inlined and with pruned styles, for a
+    small page and a large one, and the time to prune styles per page.
+    """
+    for size in (1, blocks):
+        items = render.parse_fenced_to_html(sample_document(size))
+        full = '\n'.join(render.html_page_wrapper(items, prune_styles=False))
+        pruned = '\n'.join(render.html_page_wrapper(items))
+        print('styles: %d blocks, page %d -> %d bytes; %s' %
+              (size, len(full), len(pruned),
+               cssprune.report_line('inline', *cssprune.prune_page(full)[1:])),
+              file=out)
+    cssprune.PRUNE_CACHE.clear()
+    print('  prune per page: %.4fs, same classes again %.4fs' %
+          (best_of(lambda: render.page_styles(items), 1),
+           best_of(lambda: render.page_styles(items))), file=out)
+    return len(pruned)
+
+
+def bench_template_compiles(blocks=100, out=sys.stdout, documents=1000):
+    """Count template compilations over a batch of documents.
+    Each template should be compiled once per process.
+    """
+    data = sample_document(max(1, blocks // 100))
+    templates.clear()
+    env = templates.environment()
+    with CallCounter(env, 'compile') as counter:
+        start = time.time()
+        for _ in range(documents):
+            render.html_page_wrapper(render.parse_fenced_to_html(data))
+        seconds = time.time() - start
+    print('template_compiles: %d documents, %d compiles, %.3fs' %
+          (documents, counter.count, seconds), file=out)
+    return counter.count
+
+
+def bench_tree(blocks=100, out=sys.stdout):
+    """Compare asDict() trees with syntax trees on a large gallery:
+    memory per panel, time to build each from parse results,
+    and render time from the syntax tree.
+    """
+    code = sample_gallery(layouts=10 * blocks)
+    results = parser.parse(code, parser.root)
+    tree = nodes.build(results)
+    panels = sum(panel.count
+                 for spread in tree.galleries[0].spreads
+                 for layout in spread.layouts
+                 for panelgroup in layout.panelgroups
+                 for row in panelgroup.rows
+                 for panel in row)
+    dict_size = deep_sizeof(results.asDict())
+    tree_size = deep_sizeof(tree)
+    print('tree: %d layouts, %d panels' % (10 * blocks, panels), file=out)
+    print('  bytes per panel: asDict %.0f, nodes %.0f' %
+          (float(dict_size) / panels, float(tree_size) / panels), file=out)
+    print('  build: asDict %.4fs, nodes %.4fs' %
+          (best_of(results.asDict), best_of(lambda: nodes.build(results))),
+          file=out)
+    print('  render from nodes: %.4fs' %
+          best_of(lambda: render.pobj_to_html5_ccs3_grid(tree)), file=out)
+    return tree_size
+
+
+def bench_markdown(blocks=100, out=sys.stdout):
+    """Render a prose-heavy document, with paragraphs of markdown between
+    fences, in the html and markdown formats: time and the markdown
+    engines built. Before the shared engine, one was built per segment,
+    and markdown was rendered for every format.
+    """
+    prose = ' '.join(['Some *prose* with `code` and a [link](a.html).'] * 20)
+    data = sample_document(blocks, prose=prose + '\n\n' + prose)
+    render.parse_fenced_to_html(data)
+    for fmt in ('html', 'markdown'):
+        render.MARKDOWN_ENGINES.clear()
+        with CallCounter(render.mistune, 'Markdown') as counter:
+            seconds = best_of(lambda: render.parse_fenced_to_html(
+                data, fmt=fmt))
+        print('markdown %s: %d blocks, %d prose bytes, %.3fs, '
+              '%d engines built' % (fmt, blocks, len(prose) * 2 * blocks,
+                                    seconds, counter.count), file=out)
+    return counter.count
+
+
+# code snippets of a technical document, by info string
+SNIPPETS = [
+    ('python', 'def main(args):\n    return {"blocks": len(args)}'),
+    ('json', '{"title": "Book", "pages": [1, 2, 3]}'),
+    ('sh', 'python paneler.py -t html < doc.md > doc.html'),
+    ('', 'for (i = 0; i < n; i++) { draw(i); }'),
+    ('', '$ pip install -r requirements.txt'),
+]
+
+
+def bench_mixed(blocks=100, out=sys.stdout):
+    """Render a technical document of code snippets in other languages,
+    tagged and untagged, among panelcode blocks: time and parser calls.
+    Before routing blocks by info string, every block was parsed.
+    """
+    data = []
+    for idx in range(blocks):
+        tag, code = SNIPPETS[idx % len(SNIPPETS)]
+        data.extend(['```' + tag, '%s  # %d' % (code, idx), '```', '',
+                     '```', '%d_%s' % (idx, SAMPLE_BLOCKS[idx % 4]), '```',
+                     ''])
+    with NoParseCache(), CallCounter(parser, 'parse_tree') as counter:
+        seconds = best_of(lambda: render.parse_fenced_to_html(data), 1)
+    print('mixed: %d snippets, %d panelcode blocks, %d parses, %.3fs' %
+          (blocks, blocks, counter.count, seconds), file=out)
+    return counter.count
+
+
+def bench_opts(blocks=100, out=sys.stdout):
+    """Count options loads rendering a large gallery with options at
+    every level. Options are resolved once per node: one load per
+    gallery, spread, layout and panelgroup, plus the pcode and global
+    options, where rendering used to reload the levels above each layout.
+    """
+    code = sample_gallery(layouts=10 * blocks) + ' {! w4 autolabel}'
+    tree = parser.parse_tree(code)
+    nodes_count = 2 + len(tree.galleries) + sum(
+        1 + len(spread.layouts) +
+        sum(len(layout.panelgroups) for layout in spread.layouts)
+        for gallery in tree.galleries for spread in gallery.spreads)
+    with CallCounter(render, 'opts_load') as counter:
+        seconds = best_of(lambda: render.pobj_to_html5_ccs3_grid(tree), 1)
+    print('opts: %d layouts, %d option nodes, %d loads, %.4fs' %
+          (10 * blocks, nodes_count, counter.count, seconds), file=out)
+    return counter.count
+
+
+def bench_parallel(blocks=100, out=sys.stdout):
+    """Time rendering a document of 10 * blocks distinct code blocks
+    with 1 job, then pools of 2 up to one job per core, which parse
+    the blocks (see render.parse_fenced_blocks). Parser caches start
+    cold on every run.
+    """
+    data = []
+    for idx in range(10 * blocks):
+        data.extend(['```', '%d_%s' % (idx, SAMPLE_BLOCKS[idx % 4]), '```',
+                     ''])
+
+    def run_jobs(jobs):
+        """render cold with jobs"""
+        parser.clear_caches()
+        return render.parse_fenced_to_html(data, mode='pre', jobs=jobs)
+    serial = run_jobs(1)
+    try:
+        import multiprocessing
+        cores = multiprocessing.cpu_count()
+    except ImportError:  # e.g. Jython
+        cores = 1
+    times = {}
+    for jobs in range(1, max(2, cores) + 1):
+        if run_jobs(jobs) != serial:
+            raise AssertionError('%d jobs changed the output' % jobs)
+        times[jobs] = best_of(lambda: run_jobs(jobs), 1)
+        print('parallel: %d blocks, %d cores, %d jobs, %.3fs (x%.2f)' %
+              (10 * blocks, cores, jobs, times[jobs], times[1] / times[jobs]),
+              file=out)
+    return times
+
+
+class ChunkSink(object):
+    """File-like sink recording bytes written and the time of the first
+    write, keeping nothing.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.first = None
+        self.size = 0
+
+    def write(self, data):
+        """count data"""
+        if self.first is None:
+            self.first = time.time() - self.start
+        self.size += len(data)
+
+
+class NodeCounter(HTMLParser.HTMLParser):
+    """Count the DOM nodes of html: elements and non-blank text, without
+    the inert contents of <template> elements.
+    """
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.nodes = 0
+        self.templates = 0
+
+    def handle_starttag(self, tag, attrs):
+        if not self.templates:
+            self.nodes += 1
+        if tag == 'template':
+            self.templates += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'template':
+            self.templates -= 1
+
+    def handle_data(self, data):
+        if data.strip() and not self.templates:
+            self.nodes += 1
+
+
+def dom_nodes(html):
+    """Count the DOM nodes of html, see NodeCounter."""
+    counter = NodeCounter()
+    counter.feed(html)
+    counter.close()
+    return counter.nodes
+
+
+def bench_consoles(blocks=100, out=sys.stdout):
+    """Compare a page of blocks with consoles to one with lazy consoles:
+    html bytes and DOM nodes when the page loads.
+    """
+    data = sample_document(blocks)
+    for consoles in (True, 'lazy'):
+        html = '\n'.join(render.parse_fenced_to_html(
+            data, mode='pre', reveal='', consoles=consoles))
+        print('consoles %s: %d blocks, %d bytes, %d DOM nodes' %
+              ('lazy' if consoles == 'lazy' else 'eager', blocks, len(html),
+               dom_nodes(html)), file=out)
+    return len(html)
+
+
+def bench_emit(blocks=100, out=sys.stdout):
+    """Compare rendering a catalog document to a list of lines, then
+    joining and writing it, with streaming it to a sink: time to first
+    byte, total time, and the largest string held at once -- the whole
+    output, or the largest chunk. Blocks are parsed (and cached) first.
+    """
+    data = sample_document(blocks)
+    data.extend(['```', sample_gallery(layouts=10 * blocks), '```'])
+    render.parse_fenced_to_html(data)
+    start = time.time()
+    text = '\n'.join(render.parse_fenced_to_html(data))
+    built = time.time() - start
+    largest = [0]
+
+    def chunks():
+        """stream chunks, recording the largest"""
+        for chunk in render.iter_lines(render.iter_fenced_to_html(data)):
+            largest[0] = max(largest[0], len(chunk))
+            yield chunk
+    sink = ChunkSink()
+    render.write_html(chunks(), sink)
+    streamed = time.time() - sink.start
+    print('emit: %d bytes; first byte list %.4fs, stream %.4fs; '
+          'total list %.4fs, stream %.4fs' %
+          (sink.size, built, sink.first, built, streamed), file=out)
+    print('  largest string held: list %d bytes, stream %d bytes' %
+          (len(text), largest[0]), file=out)
+    return largest[0]
+
+
+def bench_fast_grammar(blocks=100, out=sys.stdout):
+    """Time the reference grammar against the fast grammar, with and
+    without bounded packrat memoization, on wide and deep inputs.
+    """
+    codes = {
+        # many spreads of layouts in one gallery
+        'wide': ' ;\n'.join(['1_2_3.c2 | (r2+1,1)_3 {: img=a.png }'] *
+                             (3 * blocks)),
+        # long rows of panels in many galleries
+        'deep': '@'.join(['1+2+3+4+5+6+7+8,' * 20 + '1'] * (blocks // 5 + 1)),
+    }
+    modes = [('reference', False, 0), ('fast', True, 0),
+             ('fast+packrat', True, 4096)]
+    try:
+        for name in sorted(codes):
+            timings = []
+            for label, fast, packrat in modes:
+                parser.fast_mode(fast, packrat)
+                with NoParseCache():
+                    timings.append('%s %.3fs' % (label, best_of(
+                        lambda: parser.parse(codes[name], parser.root), 1)))
+            print('fast_grammar %s (%d chars): %s' %
+                  (name, len(codes[name]), ', '.join(timings)), file=out)
+    finally:
+        parser.fast_mode(False)
+
+
+def bench_backends(blocks=100, out=sys.stdout):
+    """Time parsing to syntax trees with each parser backend:
+    the pyparsing reference and fast grammars, and the hand-written
+    recursive-descent parser.
+    """
+    code = sample_gallery(layouts=10 * blocks)
+    modes = [('reference', 'pyparsing', False), ('fast', 'pyparsing', True),
+             ('rd', 'rd', None)]
+    timings = []
+    with NoParseCache():
+        for label, backend, fast in modes:
+            timings.append((label, best_of(lambda: parser.parse_tree(
+                code, parser.root, fast=fast, backend=backend))))
+    print('backends (%d chars): %s' % (len(code), ', '.join(
+        '%s %.4fs (x%.1f)' % (label, seconds, timings[0][1] / seconds)
+        for label, seconds in timings)), file=out)
+    return timings
+
+
+def bench_parse_cache(blocks=100, out=sys.stdout):
+    """Render a fenced document of recurring blocks twice, as in a
+    re-run, with the parse caches cold and then warm.
+    """
+    data = sample_document(blocks)
+    parser.clear_caches()
+    cold = best_of(lambda: render.parse_fenced_to_html(data), 1)
+    warm = best_of(lambda: render.parse_fenced_to_html(data), 1)
+    stats = parser.TREE_CACHE.stats()
+    print('parse_cache: %d blocks, cold %.3fs, warm %.3fs, '
+          'tree cache %d hits %d misses %d evictions' %
+          (blocks, cold, warm, stats['hits'], stats['misses'],
+           stats['evictions']), file=out)
+    return stats
+
+
+def bench_fences(blocks=100, out=sys.stdout):
+    """Split documents on their fences with the FENCES regex and the
+    line scanner: a well-formed document, and pathological ones with
+    unterminated fences, alone or between blocks that do close.
+    """
+    lines = 10 * blocks
+    docs = [('well-formed', sample_document(lines // 6)),
+            ('unterminated', ['```x', 'text'] * (lines // 2)),
+            ('mismatched', ['```pc', '1_2', '~~~~'] * (lines // 3))]
+    timings = []
+    for label, data in docs:
+        regex = best_of(lambda: render.FENCES.split('\n'.join(data)), 1)
+        scanner_time = best_of(lambda: fences.split_fences(data), 1)
+        timings.append((label, regex, scanner_time))
+        print('fences %s (%d lines): regex %.4fs, scanner %.4fs' %
+              (label, len(data), regex, scanner_time), file=out)
+    return timings
+
+
+def bench_highlight(blocks=100, out=sys.stdout):
+    """Render a fenced document in each mode with the highlight cache
+    cold: blocks lexed and time taken. Before the cache, every block was
+    lexed in every mode.
+    """
+    data = sample_document(blocks)
+    render.parse_fenced_to_html(data)
+    for mode, consoles in (('replace', True), ('pre', 'lazy'),
+                           ('pre', True), ('post', True)):
+        highlight.HIGHLIGHT_CACHE.clear()
+        with CallCounter(highlight, 'highlight') as counter:
+            seconds = best_of(lambda: render.parse_fenced_to_html(
+                data, mode=mode, consoles=consoles), 1)
+        print('highlight %s%s: %d blocks, %d lexed, %.3fs' %
+              (mode, ' lazy' if consoles == 'lazy' else '', blocks,
+               counter.count, seconds), file=out)
+    return counter.count
+
+
+def bench_scans(blocks=100, out=sys.stdout):
+    """Render distinct blocks with their code views, parsed with the rd
+    backend: scans of the shared tokenizer per block, one for the parse.
+    Code views are lexed by the highlighter (see bench_lexer).
+    """
+    data = []
+    for idx in range(blocks):
+        data.extend(['```', '%d_%s' % (idx, SAMPLE_BLOCKS[idx % 4]), '```'])
+    parser.clear_caches()
+    highlight.HIGHLIGHT_CACHE.clear()
+    parser.use_backend('rd')
+    try:
+        seconds = best_of(lambda: render.parse_fenced_to_html(
+            data, mode='post'), 1)
+    finally:
+        parser.use_backend('pyparsing')
+    scans = scanner.SCAN_CACHE.misses
+    print('scans: %d blocks, %d scans, %.3fs' % (blocks, scans, seconds),
+          file=out)
+    return scans
+
+
+def bench_split(blocks=100, out=sys.stdout):
+    """Time parsing and rendering one block of 10 * blocks spreads of
+    image layouts in galleries of 100, with 1 job, then pools of 2 up to
+    one job per core, which parse and render it a spread at a time (see
+    render.split_pcode_obj). Parser caches start cold on every run.
+    """
+    spreads = ['1.z {: img=p%d.png } | 2_1' % idx for idx in range(10 * blocks)]
+    code = ' @\n'.join(' ;\n'.join(spreads[idx:idx + 100])
+                        for idx in range(0, len(spreads), 100))
+    code += ' {! autolabel }'
+
+    def run_jobs(jobs):
+        """parse and render cold with jobs"""
+        parser.clear_caches()
+        return ''.join(render.iter_graph_to_html(code, jobs=jobs))
+    serial = run_jobs(1)
+    try:
+        import multiprocessing
+        cores = multiprocessing.cpu_count()
+    except ImportError:  # e.g. Jython
+        cores = 1
+    times = {}
+    for jobs in range(1, max(2, cores) + 1):
+        if run_jobs(jobs) != serial:
+            raise AssertionError('%d jobs changed the output' % jobs)
+        times[jobs] = best_of(lambda: run_jobs(jobs), 1)
+        print('split: %d spreads, %d cores, %d jobs, %.3fs (x%.2f)' %
+              (len(spreads), cores, jobs, times[jobs], times[1] / times[jobs]),
+              file=out)
+    return times
+
+
+def bench_stream(blocks=100, out=sys.stdout):
+    """Render a catalog block of many galleries whole and streamed
+    gallery by gallery: time, the largest syntax tree held, and the
+    entries streaming leaves in the parse caches, which are left on.
+    """
+    code = '\n@\n'.join([sample_gallery(layouts=8)] * (2 * blocks))
+    with NoParseCache():
+        tree = parser.parse_tree(code)
+        whole = best_of(lambda: render.pobj_to_html5_ccs3_grid(
+            parser.parse_tree(code)), 1)
+    parser.clear_caches()
+    streamed = best_of(lambda: sum(1 for _ in render.iter_html5_ccs3_grid(
+        parser.GalleryStream(StringIO.StringIO(code)))), 1)
+    cached = len(parser.PARSE_CACHE) + len(parser.TREE_CACHE)
+    print('stream: %d galleries, whole %.3fs (tree %d bytes), '
+          'streamed %.3fs (largest gallery %d bytes, %d cached)' %
+          (len(tree.galleries), whole, deep_sizeof(tree), streamed,
+           max(deep_sizeof(gallery) for gallery in tree.galleries),
+           cached), file=out)
+    return cached
+
+
+def bench_lexer(blocks=100, out=sys.stdout):
+    """Highlighting lexer throughput in tokens per second on a large
+    block: the Pygments rule-by-rule lexer and the combined-regex one.
+    """
+    code = sample_gallery(layouts=10 * blocks)
+    rates = []
+    for lexer in (highlight.PanelcodeLexer(), highlight.FastPanelcodeLexer()):
+        tokens = sum(1 for _ in lexer.get_tokens(code))
+        seconds = best_of(lambda: sum(1 for _ in lexer.get_tokens(code)))
+        rates.append((type(lexer).__name__, tokens / seconds))
+    print('lexer (%d chars, %d tokens): %s' % (len(code), tokens, ', '.join(
+        '%s %.0f tokens/s (x%.1f)' % (name, rate, rate / rates[0][1])
+        for name, rate in rates)), file=out)
+    return rates
+
+
+def bench_lint(blocks=100, out=sys.stdout):
+    """Time validating a fenced document against rendering it."""
+    lines = sample_document(blocks)
+    lines[-3] = '1_2 }'  # one invalid block
+    text = '\n'.join(lines)
+    with NoParseCache():
+        rendered = best_of(lambda: render.parse_fenced_to_html(lines), 1)
+    linted = best_of(lambda: lint.lint_text(text))
+    print('lint: %d blocks, %d problems, render %.3fs, lint %.4fs (x%.0f)' %
+          (blocks, len(lint.lint_text(text)), rendered, linted,
+           rendered / linted), file=out)
+    return linted
+
+
+# seconds to import each command line entry module in a fresh
+# interpreter, over the interpreter's own start up time
+IMPORT_BUDGET = {'panelcode.render': 0.03,
+                 'panelcode.lint': 0.04,
+                 'panelcode.parser': 0.025}
+
+
+def import_seconds(statement, repeat=5, flags=()):
+    """Fastest wall time to run statement in a fresh interpreter."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable] + list(flags) + ['-c', statement]
+    return best_of(lambda: subprocess.check_call(command, cwd=root), repeat)
+
+
+def bench_imports(blocks=100, out=sys.stdout):
+    """Time cold imports of the command line entry modules against
+    IMPORT_BUDGET. On Python 3.7+ also show the slowest imports
+    reported by -X importtime.
+    """
+    base = import_seconds('pass')
+    over = 0
+    for name in sorted(IMPORT_BUDGET):
+        seconds = import_seconds('import ' + name) - base
+        over += seconds > IMPORT_BUDGET[name]
+        print('imports: %s %.3fs (budget %.3fs) %s' %
+              (name, seconds, IMPORT_BUDGET[name],
+               'over' if seconds > IMPORT_BUDGET[name] else 'ok'), file=out)
+        if sys.version_info >= (3, 7):
+            report = subprocess.Popen(
+                [sys.executable, '-X', 'importtime', '-c', 'import ' + name],
+                stderr=subprocess.PIPE,
+                universal_newlines=True).communicate()[1]
+            rows = [line.split('|') for line in report.splitlines()[1:]]
+            for row in sorted(rows, key=lambda row: -int(row[1]))[:5]:
+                print('  %8sus %s' % (row[1].strip(), row[2].rstrip()),
+                      file=out)
+    return over
+
+
+def bench_treefile(blocks=100, out=sys.stdout):
+    """Persist a parsed corpus as pickled parse results and as a tree
+    file: bytes, and time to load it back as trees.
+    """
+    codes = ['%d @ ' % idx + SAMPLE_BLOCKS[idx % len(SAMPLE_BLOCKS)]
+             for idx in range(4 * blocks)]
+    with NoParseCache():
+        results = [parser.parse(code, parser.root) for code in codes]
+        reparse = best_of(lambda: [parser.parse_tree(code)
+                                   for code in codes], 1)
+    pickled = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+    data = treefile.dumps(results)
+    print('treefile: %d blocks, pickle %d bytes, tree file %d bytes' %
+          (len(codes), len(pickled), len(data)), file=out)
+    print('  load trees: reparse %.4fs, unpickle+build %.4fs, '
+          'tree file %.4fs' %
+          (reparse,
+           best_of(lambda: [nodes.build(item)
+                            for item in pickle.loads(pickled)]),
+           best_of(lambda: list(treefile.loads(data)))), file=out)
+    return len(data)
+
+
+BENCHMARKS = {
+    'backends': bench_backends,
+    'consoles': bench_consoles,
+    'emit': bench_emit,
+    'fast_grammar': bench_fast_grammar,
+    'fences': bench_fences,
+    'highlight': bench_highlight,
+    'imports': bench_imports,
+    'lexer': bench_lexer,
+    'lint': bench_lint,
+    'markdown': bench_markdown,
+    'mixed': bench_mixed,
+    'opts': bench_opts,
+    'parallel': bench_parallel,
+    'parse_cache': bench_parse_cache,
+    'parse_count': bench_parse_count,
+    'scans': bench_scans,
+    'split': bench_split,
+    'stream': bench_stream,
+    'styles': bench_styles,
+    'template_compiles': bench_template_compiles,
+    'tree': bench_tree,
+    'treefile': bench_treefile,
+}
+
+
+def run(names=None, blocks=100, out=sys.stdout):
+    """Run named benchmarks, or all of them."""
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name](blocks=blocks, out=out)
+
+
+if __name__ == '__main__':
+    DESC = """Benchmarks for the panelcode pipeline."""
+    AP = argparse.ArgumentParser(
+        description=DESC,
+        epilog='EXAMPLE:\n  python ' + os.path.basename(__file__) +
+        ' -b parse_count -n 200\n \n',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    AP.add_argument('-b', '--bench', action='append', default=[],
+                    choices=sorted(BENCHMARKS),
+                    help='benchmark to run (repeatable), default all')
+    AP.add_argument('-n', '--blocks', type=int, default=100,
+                    help='number of fenced blocks in sample documents')
+    CL_ARGS = AP.parse_args()
+    run(CL_ARGS.bench, CL_ARGS.blocks)
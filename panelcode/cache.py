@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Bounded caches for panelcode parsing.
+Panelcode blocks recur across documents and re-runs (scaffolded blocks,
+standard page grids, boilerplate options), so parse results are cached
+by a hash of their code text and parse settings.
+"""
+
+from __future__ import print_function
+import collections
+import hashlib
+import threading
+
+
+def content_key(text, *settings):
+    """Cache key for code text parsed with settings, e.g. a level name.
+    Hashes the text, so keys stay small for large blocks.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return (hashlib.sha1(text).hexdigest(),) + settings
+
+
+class LRUCache(object):
+    """Least recently used cache holding at most maxsize values.
+    Counts hits, misses and evictions. maxsize=0 caches nothing.
+    Values are shared between callers, so cache immutable values
+    or copy them on the way out.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        """Cached value for key, marking it most recently used."""
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache value for key, evicting the least recently used."""
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop key from the cache, if present."""
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        """Drop all values and reset the counters."""
+        with self.lock:
+            self.items.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def resize(self, maxsize):
+        """Change maxsize, evicting values over the new size."""
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.items) > max(maxsize, 0):
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Counters and sizes, as a dict."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self.items),
+                'maxsize': self.maxsize}
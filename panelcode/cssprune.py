@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Prune stylesheets to the classes a page uses.
+Pages inline site.css and panelcode-grid.css, but use only a few of
+their classes. A rule is kept if some selector of it needs only classes
+that occur in the page's html, as emitted by the renderer and the
+highlighter; classes under :not() are not needed. Rules without
+classes, other at-rules, and @media / @supports blocks with rules left
+are kept. The gallery size classes a console switches to, and the code
+classes lazy consoles highlight with, are kept on pages with consoles.
+
+Also prunes the inline <style> blocks of pages already rendered, with a
+report of bytes saved per page:
+
+$ python -m panelcode.cssprune data/output/*.html
+"""
+
+from __future__ import print_function
+import argparse
+import io
+import os
+import re
+import sys
+
+import panelcode.cache as cache
+
+
+COMMENTS = re.compile(r'/\*[\s\S]*?\*/')
+BLOCK_CHARS = re.compile(r'[{};]')
+BRACES = re.compile(r'[{}]')
+CLASSES = re.compile(r'\.(-?[_a-zA-Z][_a-zA-Z0-9-]*)')
+# selector parts that need no classes: negations and attribute tests
+NOT_NEEDED = re.compile(r':not\([^)]*\)|\[[^\]]*\]')
+HTML_CLASSES = re.compile(r'''\bclass\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+STYLE_BLOCKS = re.compile(r'(<style[^>]*>)([\s\S]*?)(</style>)')
+
+# at-rules holding rules, which are pruned in turn; other at-rules
+# (@font-face, @keyframes...) are kept whole
+GROUP_RULES = ('@media', '@supports', '@document')
+
+# classes added by the console size switcher (see render.CONSOLE_SCRIPT),
+# kept on pages with a console
+CONSOLE_CLASSES = frozenset(['gallery-size', 'all-size'])
+SIZE_CLASSES = frozenset(['default', 'small', 'thumb', 'mini', 'micro',
+                          'micro2'])
+
+# parsed stylesheets by content, and pruned ones by content and classes:
+# pages of a site tend to use the same classes
+PARSE_CACHE = cache.LRUCache(16)
+PRUNE_CACHE = cache.LRUCache(256)
+
+
+def parse_block(css, pos=0):
+    """Parse rules from pos to the closing brace of a block, or the end.
+    Returns (rules, end). Rules are (prelude, body) pairs: body is a
+    declarations string, a list of rules for group at-rules, or None
+    for at-rule statements such as @import.
+    """
+    rules = []
+    while True:
+        match = BLOCK_CHARS.search(css, pos)
+        if match is None:
+            return rules, len(css)
+        char = match.group()
+        prelude = css[pos:match.start()].strip()
+        pos = match.end()
+        if char == '}':
+            return rules, pos
+        if char == ';':
+            if prelude:
+                rules.append((prelude + ';', None))
+            continue
+        if prelude.startswith(GROUP_RULES):
+            body, pos = parse_block(css, pos)
+        else:
+            # declarations, or a whole other at-rule with nested braces
+            start = pos
+            depth = 1
+            while depth:
+                match = BRACES.search(css, pos)
+                if match is None:
+                    pos = len(css) + 1
+                    break
+                depth += 1 if match.group() == '{' else -1
+                pos = match.end()
+            body = css[start:pos - 1].strip()
+        rules.append((prelude, body))
+
+
+def parse(css):
+    """Parse a stylesheet into rules, without comments (see parse_block).
+    Results are cached by content; treat them as read-only.
+    """
+    key = cache.content_key(css)
+    rules = PARSE_CACHE.get(key)
+    if rules is None:
+        rules = parse_block(COMMENTS.sub('', css))[0]
+        PARSE_CACHE.put(key, rules)
+    return rules
+
+
+def split_selectors(prelude):
+    """Split a selector list on commas outside of parentheses."""
+    selectors = []
+    depth = start = 0
+    for idx, char in enumerate(prelude):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and not depth:
+            selectors.append(prelude[start:idx].strip())
+            start = idx + 1
+    selectors.append(prelude[start:].strip())
+    return selectors
+
+
+def selector_classes(selector):
+    """Classes an element must have for a selector to match."""
+    return frozenset(CLASSES.findall(NOT_NEEDED.sub('', selector)))
+
+
+def prune_rules(rules, classes):
+    """Rules with selectors that can match elements with classes."""
+    kept = []
+    for prelude, body in rules:
+        if isinstance(body, list):
+            body = prune_rules(body, classes)
+            if body:
+                kept.append((prelude, body))
+        elif body is None or prelude.startswith('@'):
+            kept.append((prelude, body))
+        else:
+            selectors = [selector for selector in split_selectors(prelude)
+                         if selector_classes(selector) <= classes]
+            if selectors:
+                kept.append((', '.join(selectors), body))
+    return kept
+
+
+def render_rules(rules, indent=''):
+    """Render rules as css text."""
+    lines = []
+    for prelude, body in rules:
+        if body is None:
+            lines.append(indent + prelude + '\n')
+        elif isinstance(body, list):
+            lines.append(indent + prelude + ' {\n' +
+                         render_rules(body, indent + '  ') + indent + '}\n')
+        else:
+            lines.append(indent + prelude + ' {\n' + indent + '  ' +
+                         body + ' }\n')
+    return ''.join(lines)
+
+
+def prune(css, classes):
+    """Prune a stylesheet to the rules that can apply to classes."""
+    classes = frozenset(classes)
+    key = cache.content_key(css, classes)
+    pruned = PRUNE_CACHE.get(key)
+    if pruned is None:
+        pruned = render_rules(prune_rules(parse(css), classes))
+        PRUNE_CACHE.put(key, pruned)
+    return pruned
+
+
+def html_classes(html):
+    """Classes used in html text or an iterable of html strings,
+    with the size classes a console may switch galleries to.
+    """
+    if not isinstance(html, basestring):
+        html = '\n'.join(html)
+    classes = set()
+    for match in HTML_CLASSES.finditer(html):
+        classes.update((match.group(1) or match.group(2) or '').split())
+    if classes & CONSOLE_CLASSES:
+        classes |= SIZE_CLASSES
+    return classes
+
+
+def prune_page(html):
+    """Prune the inline <style> blocks of an html page to the classes
+    used outside of them. Returns (html, bytes before, bytes after),
+    counting style block contents.
+    """
+    classes = html_classes(STYLE_BLOCKS.sub('', html))
+    sizes = [0, 0]
+
+    def prune_block(match):
+        """prune one block"""
+        css = prune(match.group(2), classes)
+        sizes[0] += len(match.group(2))
+        sizes[1] += len(css)
+        return match.group(1) + '\n' + css + match.group(3)
+    html = STYLE_BLOCKS.sub(prune_block, html)
+    return html, sizes[0], sizes[1]
+
+
+def report_line(name, before, after):
+    """One line of a bytes saved report."""
+    saved = before - after
+    return '%s: styles %d -> %d bytes, saved %d (%.0f%%)' % (
+        name, before, after, saved, 100.0 * saved / before if before else 0)
+
+
+def main(args):
+    """Prune the pages in args.paths, print bytes saved per page."""
+    total = [0, 0]
+    for path in args.paths:
+        with io.open(path, encoding='utf-8') as infile:
+            html, before, after = prune_page(infile.read())
+        if args.write:
+            with io.open(path, 'w', encoding='utf-8') as outfile:
+                outfile.write(html)
+        total[0] += before
+        total[1] += after
+        print(report_line(path, before, after))
+    if len(args.paths) > 1:
+        print(report_line('total', *total))
+    return 0
+
+
+if __name__ == '__main__':
+    DESC = """Prune the inline styles of html pages to the classes used."""
+    AP = argparse.ArgumentParser(
+        description=DESC,
+        epilog='EXAMPLE:\n  python ' + os.path.basename(__file__) +
+        ' -w data/output/*.html\n \n',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    AP.add_argument('paths', nargs='+', help='html pages')
+    AP.add_argument('-w', '--write', action='store_true',
+                    help='rewrite pages with pruned styles, '
+                    'default report only')
+    sys.exit(main(AP.parse_args()))
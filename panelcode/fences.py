@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Line-oriented scanner for markdown fenced code blocks.
+Splits a document given as lines into prose and code blocks without
+joining the document into one string. A first pass finds the lines
+that can close blocks, so that each opening fence knows where its
+block ends: scanning is linear in the size of the document, including
+for unterminated or mismatched fences.
+
+On well-formed documents it splits as render.FENCES does: a block opens
+on a line of a ``` or ~~~ fence with an optional info string, and
+closes on the next line of the same fence alone. Documents differ where
+that regex matches within lines: here fences are whole lines, and a
+closing fence right after the opening one closes an empty block. A
+fence without a closing fence is prose, as for the regex.
+"""
+
+from __future__ import print_function
+import collections
+import re
+
+
+OPENER = re.compile(r' *(`{3,}(?!`)|~{3,}(?!~))( *\S+ *)?$')
+CLOSER = re.compile(r' *(`{3,}|~{3,}) *$')
+FENCE_CHARS = ('`', '~')
+
+# a fenced code block: fence string, info string (or None), code, and
+# the position of the code in the joined document
+Fence = collections.namedtuple('Fence', 'fence info code start')
+
+
+def split_lines(items):
+    """Yield the lines of '\\n'.join(items)."""
+    for item in items:
+        if '\n' in item:
+            for line in item.split('\n'):
+                yield line
+        else:
+            yield item
+
+
+def closing_lines(lines):
+    """Indexes of the lines that could close a block, by fence string,
+    in order.
+    """
+    closers = collections.defaultdict(collections.deque)
+    for idx, line in enumerate(lines):
+        if line.lstrip(' ')[:1] in FENCE_CHARS:
+            match = CLOSER.match(line)
+            if match is not None:
+                closers[match.group(1)].append(idx)
+    return closers
+
+
+def iter_fences(lines):
+    """Yield the prose and code blocks of a document given as lines,
+    in order: prose text before each block as a string, the block as a
+    Fence, and finally the prose after the last block. Prose and code
+    are as FENCES.split('\\n'.join(lines)) gives them: empty lines after
+    a closing fence are dropped, and code keeps the indentation of its
+    closing fence. An opening fence that is never closed is prose, and
+    blocks after it are still found.
+    """
+    lines = list(split_lines(lines))
+    closers = closing_lines(lines)
+    prose = []
+    block = None  # fence, info, closing line index, code lines, start
+    offset = 0
+    after_block = False
+    for idx, line in enumerate(lines):
+        offset += len(line) + 1
+        if block is not None:
+            if idx < block[2]:
+                block[3].append(line)
+                continue
+            match = CLOSER.match(line)
+            yield '\n'.join(prose) + '\n' if prose else ''
+            yield Fence(block[0], block[1],
+                        ''.join(code + '\n' for code in block[3]) +
+                        line[:match.start(1)], block[4])
+            prose = []
+            block = None
+            after_block = True
+        elif after_block and not line:
+            continue
+        else:
+            after_block = False
+            match = None
+            if line.lstrip(' ')[:1] in FENCE_CHARS:
+                match = OPENER.match(line)
+            if match is not None:
+                # the block closes on the next closing line of its fence
+                ends = closers[match.group(1)]
+                while ends and ends[0] <= idx:
+                    ends.popleft()
+                if not ends:
+                    match = None
+            if match is None:
+                prose.append(line)
+            else:
+                block = (match.group(1), match.group(2), ends.popleft(), [],
+                         offset)
+    yield '\n'.join(prose)
+
+
+def split_fences(lines):
+    """Split a document given as lines on its code blocks, into the list
+    FENCES.split('\\n'.join(lines)) gives: prose, then for each block its
+    fence, info string, code and fence again, followed by prose.
+    """
+    items = []
+    for item in iter_fences(lines):
+        if isinstance(item, Fence):
+            items.extend((item.fence, item.info, item.code, item.fence))
+        else:
+            items.append(item)
+    return items
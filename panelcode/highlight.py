@@ -2,16 +2,21 @@
 # -*- coding: utf-8 -*-
 """Syntax highlighting methods for Panelcode.
    Custom lexer built with Pygments, custom style using Solarized colors.
+   Code views, eager or in lazy consoles, are all highlighted on the
+   server by FastPanelcodeLexer.
 """
 
 from __future__ import print_function
+import re
 from pygments import highlight
 from pygments.formatters import HtmlFormatter  # pylint: disable=E0611
 from pygments.lexer import bygroups, RegexLexer
-from pygments.token import Comment, Keyword, \
+from pygments.token import Comment, Error, Keyword, \
     Literal, Name, Number, Operator, Punctuation, String, Text
+from pygments.token import _TokenType
 from pygments.style import Style
-from pygments.styles import STYLE_MAP
+
+import panelcode.cache as cache
 
 
 # pylint: disable=bad-whitespace
@@ -94,6 +99,106 @@ class PanelcodeLexer(RegexLexer):
     }
 
 
+class RuleMatch(object):
+    """The groups of one rule's alternative in a combined regex match,
+    numbered as in a match of the rule's own regex.
+    """
+    __slots__ = ('match', 'base')
+
+    def __init__(self, match, base):
+        self.match = match
+        self.base = base
+
+    def group(self, idx=0):
+        """group idx of the rule"""
+        return self.match.group(self.base + idx)
+
+    def start(self, idx=0):
+        """start of group idx of the rule"""
+        return self.match.start(self.base + idx)
+
+    def end(self, idx=0):
+        """end of group idx of the rule"""
+        return self.match.end(self.base + idx)
+
+
+class FastPanelcodeLexer(PanelcodeLexer):
+    """PanelcodeLexer with the rules of each state combined into one
+    regex, so that a single match finds the rule that applies where
+    Pygments tries each rule in turn. Emits the same tokens.
+    """
+
+    # per state, the combined regex match, and by group name the rules'
+    # group numbers, actions and new states
+    combined = None
+
+    @classmethod
+    def combine(cls, tokendefs):
+        """Combine the rules of each state, in order: the first
+        alternative to match is the first rule to match. Takes regexes
+        from tokens, and actions and new states as processed by Pygments
+        in tokendefs; the states have no include()s, so rules pair up.
+        """
+        combined = {}
+        for state, rules in tokendefs.items():
+            regexes = [rule[0] for rule in cls.tokens[state]]
+            regex = re.compile('|'.join('(?P<r%d>%s)' % item
+                                        for item in enumerate(regexes)),
+                               cls.flags)
+            combined[state] = (regex.match, dict(
+                ('r%d' % idx, (regex.groupindex['r%d' % idx], action,
+                               new_state))
+                for idx, (_, action, new_state) in enumerate(rules)))
+        return combined
+
+    def get_tokens_unprocessed(self, text, stack=('root',)):
+        """Split text into (index, tokentype, value) tokens, as
+        RegexLexer.get_tokens_unprocessed does.
+        """
+        if FastPanelcodeLexer.combined is None:
+            FastPanelcodeLexer.combined = self.combine(self._tokens)
+        combined = FastPanelcodeLexer.combined
+        statestack = list(stack)
+        match, rules = combined[statestack[-1]]
+        pos = 0
+        end = len(text)
+        while pos < end:
+            m = match(text, pos)
+            if m is None:
+                if text[pos] == '\n':
+                    # at EOL, reset state to "root"
+                    statestack = ['root']
+                    match, rules = combined['root']
+                    yield pos, Text, u'\n'
+                else:
+                    yield pos, Error, text[pos]
+                pos += 1
+                continue
+            base, action, new_state = rules[m.lastgroup]
+            if action is not None:
+                if type(action) is _TokenType:
+                    yield pos, action, m.group()
+                else:
+                    # callbacks such as bygroups
+                    for item in action(self, RuleMatch(m, base)):
+                        yield item
+            pos = m.end()
+            if new_state is not None:
+                if isinstance(new_state, tuple):
+                    for state in new_state:
+                        if state == '#pop':
+                            statestack.pop()
+                        elif state == '#push':
+                            statestack.append(statestack[-1])
+                        else:
+                            statestack.append(state)
+                elif isinstance(new_state, int):
+                    del statestack[new_state:]
+                else:
+                    statestack.append(statestack[-1])
+                match, rules = combined[statestack[-1]]
+
+
 class SolarizedStyle(Style):  # pylint: disable=too-few-public-methods
     """Style map for lexed Panelcode.
     Maps Solarized colors to Pygments token class names as CSS definitions.
@@ -146,12 +251,15 @@ class SolarizedStyle(Style):  # pylint: disable=too-few-public-methods
     }
 
 
-def all_styles(code, outpath, lexer=PanelcodeLexer(),
+def all_styles(code, outpath, lexer=None,
                prefix='test_', suffix='.html'):
     """Given code, outputs an HTML file for each available built-in style.
     A testing class for quickly previewing how a particular approach to
     lexer token naming will look across a variety of pre-existing styles.
     """
+    from pygments.styles import STYLE_MAP
+    if lexer is None:
+        lexer = PanelcodeLexer()
     # print(STYLE_MAP.keys())
     for smkey in STYLE_MAP.keys():  # pylint: disable=C0201
         fname = outpath + '/' + prefix + smkey + suffix
@@ -161,17 +269,51 @@ def all_styles(code, outpath, lexer=PanelcodeLexer(),
             highlight(code, lexer, formatter, outfile=htmlfile)
 
 
-def style_string(code, lexer=PanelcodeLexer(), style=SolarizedStyle,
+# highlighted html by code and style: blocks recur across documents and
+# re-runs, like their parses (see cache)
+HIGHLIGHT_CACHE = cache.LRUCache(256)
+
+# one lexer, and one formatter per style, shared by all calls
+LEXERS = []
+FORMATTERS = {}
+
+
+def default_lexer():
+    """The shared FastPanelcodeLexer instance."""
+    if not LEXERS:
+        LEXERS.append(FastPanelcodeLexer())
+    return LEXERS[0]
+
+
+def html_formatter(style=SolarizedStyle, full=False):
+    """The shared HtmlFormatter for a style."""
+    key = (style, full)
+    if key not in FORMATTERS:
+        formatter = HtmlFormatter(style=style)
+        formatter.full = full
+        FORMATTERS[key] = formatter
+    return FORMATTERS[key]
+
+
+def style_string(code, lexer=None, style=SolarizedStyle,
                  full=False):
     """Render plaintext Panelcode as syntax-highlighting HTML.
     Code is returned as tokens tagged with <span class="sometokenID">.
     Uses a custom Panelcode lexer and a color style that targets
     Panelcode token types and distributions. The style argument can be
     a string naming any built-in style, e.g. 'paraiso-dark'.
+
+    Without a lexer, code is highlighted by the shared
+    FastPanelcodeLexer, and results are cached by code and style.
     """
-    formatter = HtmlFormatter(style=style)
-    formatter.full = full
-    html_str = highlight(code, lexer, formatter)
+    if lexer is not None:
+        return highlight(code, lexer, html_formatter(style, full))
+    key = cache.content_key(code, style, full)
+    html_str = HIGHLIGHT_CACHE.get(key)
+    if html_str is None:
+        html_str = highlight(code, default_lexer(),
+                             html_formatter(style, full))
+        HIGHLIGHT_CACHE.put(key, html_str)
     return html_str
 
 
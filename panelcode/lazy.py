@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Lazy module imports.
+Command line tools import panelcode modules once per run, so modules
+import their heavier dependencies (pyparsing, pygments, jinja2, mistune)
+as LazyModules: the real import happens on first attribute access.
+"""
+
+from __future__ import print_function
+import importlib
+
+
+class LazyModule(object):
+    """A module imported on first attribute access.
+    Tries each name in turn, like a chain of try / except ImportError
+    imports, e.g. LazyModule('panelcode.libs.mistune', 'mistune').
+    Its own attributes start with an underscore, so as not to hide the
+    module's attributes.
+    """
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def _load(self):
+        """Import the module now, if not yet imported, and return it."""
+        if self._module is None:
+            for name in self._names[:-1]:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    continue
+            else:
+                self._module = importlib.import_module(self._names[-1])
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module %s>' % '|'.join(self._names)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Validate panelcode files without rendering them.
+Checks .panelcode files, and the fenced code blocks of markdown files,
+with the recognition-only parser (see rdparser): no trees, no html.
+Reports each invalid block as path:line:col: message and exits 1 if
+there are any. Directories are searched for files, which are checked
+in parallel on all cores where multiprocessing is available.
+
+$ python -m panelcode.lint docs/ book.panelcode
+
+Untagged markdown blocks that are not panelcode are reported too: the
+renderer shows those as code instead of panels. Blocks tagged with
+another language, e.g. ```python, are not checked.
+"""
+
+from __future__ import print_function
+import argparse
+import bisect
+import collections
+import io
+import os
+import sys
+
+import panelcode.fences as fences
+import panelcode.rdparser as rdparser
+import panelcode.render as render
+
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+PANELCODE_EXTENSIONS = ('.panelcode', '.pcode')
+
+Problem = collections.namedtuple('Problem', 'path line col msg')
+
+
+def decomment_offsets(string):
+    """Decomment a string as render.decomment does, and return the result
+    with a list of (position, offset) pairs, sorted by position: from each
+    position in the result, add offset to find the original position.
+    """
+    parts = []
+    offsets = [(0, 0)]
+    begin = removed = 0
+    for match in render.COMMENTS.finditer(string):
+        if match.group(1) is not None:
+            continue
+        parts.append(string[begin:match.start()])
+        position = match.start() - removed
+        removed += match.end() - match.start()
+        begin = match.end()
+        offsets.append((position, removed))
+    parts.append(string[begin:])
+    return ''.join(parts), offsets
+
+
+def original_loc(loc, offsets):
+    """Map a location in decommented code to the original code."""
+    idx = bisect.bisect_right(offsets, (loc, sys.maxsize)) - 1
+    return loc + offsets[idx][1]
+
+
+def line_col(string, loc):
+    """1-based line and column of a location in a string."""
+    line = string.count('\n', 0, loc) + 1
+    return line, loc - (string.rfind('\n', 0, loc) + 1) + 1
+
+
+def check_block(code):
+    """Return (loc, msg) for the first error in a panelcode block,
+    as found after decommenting but located in the original code,
+    or None if it is valid.
+    """
+    clean, offsets = decomment_offsets(code)
+    try:
+        rdparser.recognize(clean)
+    except rdparser.pp.ParseException as err:
+        return original_loc(err.loc, offsets), err.msg
+    return None
+
+
+def iter_blocks(text, markdown=True):
+    """Yield (start, code) for each panelcode block of a document:
+    the fenced code blocks of markdown that the renderer tries as
+    panelcode, or else the whole text.
+    """
+    if not markdown:
+        yield 0, text
+        return
+    for item in fences.iter_fences(text.split('\n')):
+        if isinstance(item, fences.Fence) and (
+                render.info_tag(item.info) in (None,) + render.PANELCODE_TAGS):
+            yield item.start, item.code
+
+
+def lint_text(text, path='', markdown=True):
+    """List the Problems in a document's text."""
+    problems = []
+    for start, code in iter_blocks(text, markdown):
+        error = check_block(code)
+        if error:
+            line, col = line_col(text, start + error[0])
+            problems.append(Problem(path, line, col, error[1]))
+    return problems
+
+
+def lint_file(path):
+    """List the Problems in a markdown or panelcode file. A file that
+    can't be read, or isn't utf-8, is a problem at its first line.
+    """
+    try:
+        with io.open(path, encoding='utf-8') as infile:
+            # only line endings: splitlines() would also break at form
+            # feeds and unicode separators, shifting line numbers
+            text = infile.read().replace('\r\n', '\n').replace('\r', '\n')
+    except IOError as err:
+        return [Problem(path, 1, 1, err.strerror)]
+    except UnicodeDecodeError as err:
+        return [Problem(path, 1, 1, 'Not utf-8: %s' % err)]
+    markdown = not path.lower().endswith(PANELCODE_EXTENSIONS)
+    return lint_text(text, path, markdown)
+
+
+def iter_files(paths):
+    """Yield files to check: named files, and markdown and panelcode
+    files found under named directories, in sorted order.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(MARKDOWN_EXTENSIONS +
+                                             PANELCODE_EXTENSIONS):
+                    yield os.path.join(dirpath, filename)
+
+
+def lint_paths(paths, jobs=None):
+    """List the Problems in files and directories, in file order.
+    Files are checked by jobs processes, default one per core;
+    jobs=1, or no multiprocessing, checks them in this process.
+    """
+    files = list(iter_files(paths))
+    try:
+        import multiprocessing
+    except ImportError:  # e.g. Jython
+        multiprocessing = None
+    if jobs is None and multiprocessing is not None:
+        jobs = multiprocessing.cpu_count()
+    if multiprocessing is None or not jobs or jobs < 2 or len(files) < 2:
+        results = [lint_file(path) for path in files]
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(files)))
+        try:
+            results = pool.map(lint_file, files,
+                               chunksize=max(1, len(files) // (4 * jobs)))
+        finally:
+            pool.close()
+            pool.join()
+    return [problem for problems in results for problem in problems]
+
+
+def main(args):
+    """Lint args.paths, print problems, return the exit status."""
+    problems = lint_paths(args.paths, args.jobs)
+    for problem in problems:
+        print('%s:%d:%d: %s' % problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    DESC = """Validate panelcode and markdown files without rendering."""
+    AP = argparse.ArgumentParser(
+        description=DESC,
+        epilog='EXAMPLE:\n  python ' + os.path.basename(__file__) +
+        ' docs/ book.panelcode\n \n',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    AP.add_argument('paths', nargs='+',
+                    help='files, or directories to search for files')
+    AP.add_argument('-j', '--jobs', type=int, default=None,
+                    help='processes to use, default one per core')
+    sys.exit(main(AP.parse_args()))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Panelcode syntax tree.
+Compact node classes for parsed panelcode, one per level of organization:
+Pcode, Gallery, Spread, Layout, Panelgroup and Panel.
+
+Nodes use __slots__ and hold their children and options in tuples.
+They are built once from parser results and are read-only by convention:
+renderers read them without copying or mutating them, so one tree can be
+rendered, cached or shared any number of times.
+
+Options are a tuple of attr words (strings, e.g. 'c2') and key value
+pairs (tuples, e.g. ('img', 'a.png')). Panel counts are ints.
+Attr words and keys are interned, in a bounded cache: strings past
+its size are still shared by recently built trees, not by all of them.
+"""
+
+from __future__ import print_function
+import panelcode.cache as cache
+
+
+# interned attribute strings, shared by recently built trees
+STRINGS = cache.LRUCache(4096)
+
+
+def intern_str(string):
+    """Return the shared copy of an attribute string."""
+    shared = STRINGS.get(string)
+    if shared is None:
+        STRINGS.put(string, string)
+        return string
+    return shared
+
+
+class Node(object):
+    """Base class for panelcode syntax tree nodes."""
+    __slots__ = ()
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                all(getattr(self, name) == getattr(other, name)
+                    for name in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, name) for name in self.__slots__))
+
+    def __reduce__(self):
+        return (type(self),
+                tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join(repr(getattr(self, name))
+                                     for name in self.__slots__))
+
+
+class Pcode(Node):
+    """A panelcode block: galleries joined by @, with {! } options."""
+    __slots__ = ('galleries', 'opts')
+
+
+class Gallery(Node):
+    """Spreads joined by ; with {@ } options."""
+    __slots__ = ('spreads', 'opts')
+
+
+class Spread(Node):
+    """Layouts joined by | with {; } options."""
+    __slots__ = ('layouts', 'opts')
+
+
+class Layout(Node):
+    """Panelgroups joined by _ with {: } options."""
+    __slots__ = ('panelgroups', 'opts')
+
+
+class Panelgroup(Node):
+    """Rows of panels (rows split on , and panels joined by +)
+    with { } options."""
+    __slots__ = ('rows', 'opts')
+
+
+class Panel(Node):
+    """A count of panels sharing attr word args, e.g. 2.r2 or 0."""
+    __slots__ = ('count', 'args')
+
+
+def build_opt(opt):
+    """Build one option from a parsed attr_word, kv_word or kv_expr.
+    Classifies it the same way as render.opts_load.
+    """
+    if isinstance(opt, basestring):  # attr_word
+        return intern_str(opt)
+    elif len(opt) == 1 or (len(opt) == 2 and not opt[1]):  # attr_word
+        return intern_str(opt[0])
+    elif (len(opt) == 2 and
+          len(opt[0]) == 1 and
+          opt[0].isalpha() and
+          opt[1].isdigit()
+          ):  # kv_word
+        return intern_str(opt[0] + opt[1])
+    # kv_expr
+    return (intern_str(opt[0]), " ".join(opt[1:]))
+
+
+def build_opts(results):
+    """Build an options tuple from an options ParseResult."""
+    if not results:
+        return ()
+    return tuple(build_opt(opt) for opt in results[0])
+
+
+def build_panel(term):
+    """Build a panel from a group unit term, e.g. ['2', 'r2']."""
+    count = term[0]
+    args = [intern_str(arg) for arg in term[1:]]
+    # missing counts = 1, e.g. ['']['r2'] = ['1']['r2']
+    if count == '':
+        count = '1'
+    # 0 indicates a blank / spacer panel
+    elif count == '0':
+        count = '1'
+        args.append('x')
+    return Panel(int(count), tuple(args))
+
+
+def build_panelgroup(results):
+    """Build a panelgroup, grouping terms into rows by commas."""
+    rows = [[]]
+    for term in results.get('terms', [[]])[0]:
+        # , adds row sublist
+        if term[0] == ',':
+            rows.append([])
+        # skip +
+        elif term[0] == '+':
+            continue
+        else:
+            rows[-1].append(build_panel(term))
+    return Panelgroup(tuple(tuple(row) for row in rows),
+                      build_opts(results.get('panelgroupopts')))
+
+
+def build_layout(results):
+    """Build a layout from a layout ParseResult."""
+    return Layout(tuple(build_panelgroup(item)
+                        for item in results.get('panelgroup', [])),
+                  build_opts(results.get('layoutopts')))
+
+
+def build_spread(results):
+    """Build a spread from a spread ParseResult."""
+    return Spread(tuple(build_layout(item)
+                        for item in results.get('layout', [])),
+                  build_opts(results.get('spreadopts')))
+
+
+def build_gallery(results):
+    """Build a gallery from a gallery ParseResult."""
+    return Gallery(tuple(build_spread(item)
+                         for item in results.get('spread', [])),
+                   build_opts(results.get('galleryopts')))
+
+
+def build_pcode(results):
+    """Build a pcode block from a pcode ParseResult."""
+    return Pcode(tuple(build_gallery(item)
+                       for item in results.get('gallery', [])),
+                 build_opts(results.get('pcodeopts')))
+
+
+LEVEL_BUILDERS = (('pcode', build_pcode),
+                  ('gallery', build_gallery),
+                  ('spread', build_spread),
+                  ('layout', build_layout),
+                  ('panelgroup', build_panelgroup))
+
+
+def build(results):
+    """Build a syntax tree from the results of parser.parse.
+    The node type follows the parse level, e.g. parser.root gives a
+    Pcode node. Nodes are passed through unchanged.
+    """
+    if isinstance(results, Node):
+        return results
+    for name, builder in LEVEL_BUILDERS:
+        if name in results:
+            return builder(results[name][0])
+    raise ValueError('not a panelcode parse result')
@@ -3,89 +3,594 @@
 """Panelcode parsing functions.
 Converts code strings into object trees for rendering.
 Based on an implementation of the EBNF using pyparsing.
+
+The grammar comes in two forms, both built on first use by grammar().
+The reference grammar uses longest-match alternatives (^) throughout.
+The fast grammar rewrites those rules as first-match alternatives (|)
+or without alternatives where the language allows it, and produces the
+same results while trying far fewer alternatives. Turn it on with
+fast_mode(). Levels are named, e.g. parser.root is 'pcode'.
+
+parse() can also use a hand-written recursive-descent backend
+(see rdparser) that builds syntax trees directly and is much faster
+than either grammar. Choose it per call with backend='rd', or for the
+process with use_backend('rd').
+
+Results are cached in bounded LRU caches keyed by a hash of the code and
+the parse settings: PARSE_CACHE for parse() and TREE_CACHE for
+parse_tree(), which caches only the tree, not the results it was built
+from. Syntax trees are immutable and shared; pyparsing results
+are copied for each caller. Use clear_caches() to invalidate them.
+build_tree() parses into a tree without caching, for code that won't
+recur.
+
+GalleryStream parses a panelcode text stream one gallery at a time,
+for blocks too large to hold as a single tree. split_spreads,
+chunk_levels and join_chunks parse a large block as chunks of one
+spread each, which can be parsed in parallel (see render.split_pcode_obj).
 """
 
 from __future__ import print_function
-try:
-    import panelcode.lib.pyparsing as pp
-except ImportError:
-    import pyparsing as pp
+import codecs
+import collections
+import copy
+import re
+import tempfile
+import threading
+import panelcode.cache as cache
+import panelcode.lazy as lazy
+import panelcode.nodes as nodes
+import panelcode.rdparser as rdparser
+import panelcode.scanner as scanner
+
+pp = lazy.LazyModule('panelcode.lib.pyparsing', 'pyparsing')
 
 # pylint: disable=bad-whitespace
 # pylint: disable=invalid-name
 # pylint: disable=line-too-long
 
-# options and attributes
-
-term = pp.Word(pp.alphas, pp.alphanums + '-')
-key = term
-equals = pp.Suppress('=')
-value = pp.Suppress("'") + pp.Regex(r"[^']*") + pp.Suppress("'") | term
-kv_expr = pp.Suppress(pp.Optional(pp.Literal("."))) + pp.Group(key + equals + value)
-kv_word = pp.Suppress(pp.Optional(pp.Literal("."))) + pp.Group(pp.Regex(r"[a-zA-Z]+") + pp.Regex(r"[0-9]*"))
-attr_word = pp.Suppress(pp.Optional(pp.Literal("."))) + term
-attr_list = pp.ZeroOrMore(attr_word ^ kv_expr ^ kv_word)
-
-b_opt_pg =  pp.Literal("{+") | pp.Literal("{")
-b_opt_l =   pp.Literal("{|") | pp.Literal("{:")
-b_opt_s =   pp.Literal("{;") | pp.Literal("{::")
-b_opt_g =   pp.Literal("{@") | pp.Literal("{:::")
-b_opt_r =  pp.Literal("{!") | pp.Literal("{::::")
-e_opt =     pp.Literal("}")
-
-panelgroupopts = (pp.Suppress(b_opt_pg) +
-                  pp.Optional(attr_list) +
-                  pp.Suppress(e_opt)).setResultsName('panelgroupopts',
-                                                     listAllMatches=True)
-layoutopts  = (pp.Suppress(b_opt_l) +
-               pp.Optional(attr_list) +
-               pp.Suppress(e_opt)).setResultsName('layoutopts',
-                                                  listAllMatches=True)
-spreadopts  = (pp.Suppress(b_opt_s) +
-               pp.Optional(attr_list) +
-               pp.Suppress(e_opt)).setResultsName('spreadopts',
-                                                  listAllMatches=True)
-galleryopts = (pp.Suppress(b_opt_g) +
-               pp.Optional(attr_list) +
-               pp.Suppress(e_opt)).setResultsName('galleryopts',
-                                                  listAllMatches=True)
-pcodeopts   = (pp.Suppress(b_opt_r) +
-               pp.Optional(attr_list) +
-               pp.Suppress(e_opt)).setResultsName('pcodeopts',
-                                                  listAllMatches=True)
-
-# panelgroups
-
-numrow         = pp.Regex(r"[0-9]*")
-newcol         = pp.Literal("+")
-newrow         = pp.Literal(",")
-groupseparator = pp.Group(newcol ^ newrow)
-groupunit      = pp.Group(numrow + pp.OneOrMore(attr_word) ^ numrow ^ attr_word)
-groupterms     = pp.Suppress(pp.Optional(pp.Suppress(pp.Literal("(")))) + pp.Group(groupunit + pp.ZeroOrMore(groupseparator + groupunit)).setResultsName('terms', listAllMatches=True) + pp.Suppress(pp.Optional(pp.Suppress(pp.Literal(")"))))
-panelgroup     = pp.Group((groupterms ^ groupunit) +
-                          pp.Optional(panelgroupopts)).setResultsName('panelgroup', listAllMatches=True)
-
-# levels of organization
-
-
-layout         = pp.Group(pp.delimitedList(panelgroup, delim="_") +
-                          pp.Optional(layoutopts)).setResultsName('layout', listAllMatches=True)
-spread         = pp.Group(pp.delimitedList(layout, delim="|") +
-                          pp.Optional(spreadopts)).setResultsName('spread', listAllMatches=True)
-gallery        = pp.Group(pp.delimitedList(spread, delim=";") +
-                          pp.Optional(galleryopts)).setResultsName('gallery', listAllMatches=True)
-root           = pp.Group(pp.delimitedList(gallery, delim="@") +
-                          pp.Optional(pcodeopts)).setResultsName('pcode', listAllMatches=True)
-
-
-def parse(code_str, parselevel):
+# parse levels, by name
+root = 'pcode'
+gallery = 'gallery'
+spread = 'spread'
+layout = 'layout'
+panelgroup = 'panelgroup'
+LEVELS = (root, gallery, spread, layout, panelgroup)
+
+# grammar elements by level, built on first use, see grammar()
+GRAMMARS = {}
+
+
+def build_grammar():
+    """Build the reference and fast grammars.
+    Returns {'reference': {level: element}, 'fast': {level: element}}.
+    """
+    # options and attributes
+
+    term = pp.Word(pp.alphas, pp.alphanums + '-')
+    key = term
+    equals = pp.Suppress('=')
+    value = pp.Suppress("'") + pp.Regex(r"[^']*") + pp.Suppress("'") | term
+    kv_expr = pp.Suppress(pp.Optional(pp.Literal("."))) + pp.Group(key + equals + value)
+    kv_word = pp.Suppress(pp.Optional(pp.Literal("."))) + pp.Group(pp.Regex(r"[a-zA-Z]+") + pp.Regex(r"[0-9]*"))
+    attr_word = pp.Suppress(pp.Optional(pp.Literal("."))) + term
+    attr_list = pp.ZeroOrMore(attr_word ^ kv_expr ^ kv_word)
+
+    b_opt_pg =  pp.Literal("{+") | pp.Literal("{")
+    b_opt_l =   pp.Literal("{|") | pp.Literal("{:")
+    b_opt_s =   pp.Literal("{;") | pp.Literal("{::")
+    b_opt_g =   pp.Literal("{@") | pp.Literal("{:::")
+    b_opt_r =  pp.Literal("{!") | pp.Literal("{::::")
+    e_opt =     pp.Literal("}")
+
+    panelgroupopts = (pp.Suppress(b_opt_pg) +
+                      pp.Optional(attr_list) +
+                      pp.Suppress(e_opt)).setResultsName('panelgroupopts',
+                                                         listAllMatches=True)
+    layoutopts  = (pp.Suppress(b_opt_l) +
+                   pp.Optional(attr_list) +
+                   pp.Suppress(e_opt)).setResultsName('layoutopts',
+                                                      listAllMatches=True)
+    spreadopts  = (pp.Suppress(b_opt_s) +
+                   pp.Optional(attr_list) +
+                   pp.Suppress(e_opt)).setResultsName('spreadopts',
+                                                      listAllMatches=True)
+    galleryopts = (pp.Suppress(b_opt_g) +
+                   pp.Optional(attr_list) +
+                   pp.Suppress(e_opt)).setResultsName('galleryopts',
+                                                      listAllMatches=True)
+    pcodeopts   = (pp.Suppress(b_opt_r) +
+                   pp.Optional(attr_list) +
+                   pp.Suppress(e_opt)).setResultsName('pcodeopts',
+                                                      listAllMatches=True)
+
+    # panelgroups
+
+    numrow         = pp.Regex(r"[0-9]*")
+    newcol         = pp.Literal("+")
+    newrow         = pp.Literal(",")
+    groupseparator = pp.Group(newcol ^ newrow)
+    groupunit      = pp.Group(numrow + pp.OneOrMore(attr_word) ^ numrow ^ attr_word)
+    groupterms     = pp.Suppress(pp.Optional(pp.Suppress(pp.Literal("(")))) + pp.Group(groupunit + pp.ZeroOrMore(groupseparator + groupunit)).setResultsName('terms', listAllMatches=True) + pp.Suppress(pp.Optional(pp.Suppress(pp.Literal(")"))))
+    panelgroup     = pp.Group((groupterms ^ groupunit) +
+                              pp.Optional(panelgroupopts)).setResultsName('panelgroup', listAllMatches=True)
+
+    # levels of organization
+
+    layout         = pp.Group(pp.delimitedList(panelgroup, delim="_") +
+                              pp.Optional(layoutopts)).setResultsName('layout', listAllMatches=True)
+    spread         = pp.Group(pp.delimitedList(layout, delim="|") +
+                              pp.Optional(spreadopts)).setResultsName('spread', listAllMatches=True)
+    gallery        = pp.Group(pp.delimitedList(spread, delim=";") +
+                              pp.Optional(galleryopts)).setResultsName('gallery', listAllMatches=True)
+    root           = pp.Group(pp.delimitedList(gallery, delim="@") +
+                              pp.Optional(pcodeopts)).setResultsName('pcode', listAllMatches=True)
+
+    # fast grammar
+    #
+    # attr_list: kv_expr always matches longer than attr_word when both match.
+    #     kv_word only matches longer than attr_word for an alpha-only word
+    #     followed by whitespace, as it skips the whitespace looking for digits
+    #     (e.g. 'dark ' -> ['dark', ''], 'c 2' -> ['c', '2']). Otherwise
+    #     attr_word wins. First match in that order finds the same options.
+    # groupunit: numrow can match the empty string, so numrow + attr words
+    #     covers all three alternatives.
+    # panelgroup: groupterms starts with groupunit, so it always matches at
+    #     least as far.
+
+    fast_kv_word = pp.Suppress(pp.Optional(pp.Literal("."))) + pp.Group(pp.Regex(r"[a-zA-Z]+(?=[ \t\n\r])") + pp.Regex(r"[0-9]*"))
+    fast_attr_list = pp.ZeroOrMore(kv_expr | fast_kv_word | attr_word)
+
+    def fast_opts(b_opt, name):
+        """Fast option block with a results name, e.g. 'layoutopts'."""
+        return (pp.Suppress(b_opt) +
+                pp.Optional(fast_attr_list) +
+                pp.Suppress(e_opt)).setResultsName(name, listAllMatches=True)
+
+    fast_groupseparator = pp.Group(newcol | newrow)
+    fast_groupunit      = pp.Group(numrow + pp.ZeroOrMore(attr_word))
+    fast_groupterms     = pp.Suppress(pp.Optional(pp.Suppress(pp.Literal("(")))) + pp.Group(fast_groupunit + pp.ZeroOrMore(fast_groupseparator + fast_groupunit)).setResultsName('terms', listAllMatches=True) + pp.Suppress(pp.Optional(pp.Suppress(pp.Literal(")"))))
+    fast_panelgroup     = pp.Group(fast_groupterms +
+                                   pp.Optional(fast_opts(b_opt_pg, 'panelgroupopts'))).setResultsName('panelgroup', listAllMatches=True)
+    fast_layout         = pp.Group(pp.delimitedList(fast_panelgroup, delim="_") +
+                                   pp.Optional(fast_opts(b_opt_l, 'layoutopts'))).setResultsName('layout', listAllMatches=True)
+    fast_spread         = pp.Group(pp.delimitedList(fast_layout, delim="|") +
+                                   pp.Optional(fast_opts(b_opt_s, 'spreadopts'))).setResultsName('spread', listAllMatches=True)
+    fast_gallery        = pp.Group(pp.delimitedList(fast_spread, delim=";") +
+                                   pp.Optional(fast_opts(b_opt_g, 'galleryopts'))).setResultsName('gallery', listAllMatches=True)
+    fast_root           = pp.Group(pp.delimitedList(fast_gallery, delim="@") +
+                                   pp.Optional(fast_opts(b_opt_r, 'pcodeopts'))).setResultsName('pcode', listAllMatches=True)
+
+    return {'reference': {'pcode': root,
+                           'gallery': gallery,
+                           'spread': spread,
+                           'layout': layout,
+                           'panelgroup': panelgroup},
+            'fast': {'pcode': fast_root,
+                     'gallery': fast_gallery,
+                     'spread': fast_spread,
+                     'layout': fast_layout,
+                     'panelgroup': fast_panelgroup}}
+
+
+def is_level(parselevel):
+    """True for a level name, e.g. parser.root; False for a grammar
+    element (elements compare equal to strings they match).
+    """
+    return isinstance(parselevel, basestring) and parselevel in LEVELS
+
+
+def grammar(fast=False):
+    """The pyparsing grammar elements by level name, e.g.
+    grammar()[parser.root]. Both grammars are built on first use, so that
+    importing parser doesn't import pyparsing or build the grammar.
+    """
+    if not GRAMMARS:
+        GRAMMARS.update(build_grammar())
+    return GRAMMARS['fast' if fast else 'reference']
+
+
+# fast mode settings, see fast_mode()
+FAST_MODE = {'enabled': False, 'packrat': 0}
+
+
+class PackratCache(dict):
+    """Bounded pyparsing packrat cache.
+    Holds at most size entries, evicting the oldest first.
+    Writes are locked; pyparsing clears the cache at each parseString.
+
+    pyparsing looks entries up with `key in cache` and then cache[key].
+    Another thread may clear the cache or evict the key in between, so
+    a lookup reads the entry once, and the value it found is what the
+    following cache[key] of the same thread returns.
+    """
+    MISSING = object()
+
+    def __init__(self, size):
+        super(PackratCache, self).__init__()
+        self.size = size
+        self.order = collections.deque()
+        self.lock = threading.Lock()
+        self.found = threading.local()
+
+    def __contains__(self, key):
+        value = self.get(key, self.MISSING)
+        self.found.entry = (key, value)
+        return value is not self.MISSING
+
+    def __getitem__(self, key):
+        entry = getattr(self.found, 'entry', None)
+        if entry is not None and entry[0] is key:
+            self.found.entry = None
+            return entry[1]
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key not in self:
+                self.order.append(key)
+                while len(self.order) > self.size:
+                    dict.pop(self, self.order.popleft(), None)
+            dict.__setitem__(self, key, value)
+
+    def clear(self):
+        with self.lock:
+            dict.clear(self)
+            self.order.clear()
+
+
+def fast_mode(enabled=True, packrat=0):
+    """Turn the fast grammar on or off for parse() calls that don't
+    choose a grammar themselves.
+
+    packrat > 0 also turns on pyparsing packrat memoization with a cache
+    bounded to that many entries; packrat=0 turns it off. Packrat is a
+    pyparsing class setting, so it applies to every pyparsing grammar in
+    the process, not only panelcode. The cache is shared by all threads
+    and is cleared whenever any thread starts a parse: lookups are
+    atomic (see PackratCache), so results stay correct, but concurrent
+    threads lower each other's hit rate.
+    For parallel parsing use processes. With pyparsing 2.1.4 packrat
+    is slower on panelcode than the fast grammar alone (see bench.py),
+    so it is off by default.
+    """
+    FAST_MODE['enabled'] = enabled
+    FAST_MODE['packrat'] = packrat
+    if enabled and packrat > 0:
+        pp.ParserElement._exprArgCache = PackratCache(packrat)
+        pp.ParserElement._packratEnabled = True
+        pp.ParserElement._parse = pp.ParserElement._parseCache
+    else:
+        pp.ParserElement._exprArgCache = {}
+        pp.ParserElement._packratEnabled = False
+        pp.ParserElement._parse = pp.ParserElement._parseNoCache
+
+
+# parser backends: 'pyparsing' grammars or 'rd' (rdparser)
+BACKENDS = ('pyparsing', 'rd')
+BACKEND = {'name': 'pyparsing'}
+
+
+def use_backend(name):
+    """Set the parser backend for parse() calls that don't choose one
+    themselves: 'pyparsing' (the default) or 'rd'.
+    """
+    if name not in BACKENDS:
+        raise ValueError('unknown parser backend: %s' % name)
+    BACKEND['name'] = name
+
+
+# parse results and syntax trees by content_key, see parse_key()
+PARSE_CACHE = cache.LRUCache(256)
+TREE_CACHE = cache.LRUCache(256)
+
+
+def clear_caches():
+    """Invalidate all cached parse results, syntax trees, scans and
+    interned strings."""
+    PARSE_CACHE.clear()
+    TREE_CACHE.clear()
+    scanner.SCAN_CACHE.clear()
+    nodes.STRINGS.clear()
+
+
+def parse_key(code_str, parselevel, fast, backend, kind='parse'):
+    """Cache key for parsing code at a level with given settings,
+    or None for levels that aren't cached.
+    """
+    if not is_level(parselevel):
+        return None
+    if backend == 'rd':
+        fast = None
+    return cache.content_key(code_str, kind, parselevel, backend,
+                             None if fast is None else bool(fast))
+
+
+def parse(code_str, parselevel, fast=None, backend=None, shared=False):
     """Parse panelcode string at level parselevel.
     Levels are parser.root, parser.gallery etc.
     Renderers may assume a particular top-level,
-    e.g. parser.root.
+    e.g. parser.root. A pyparsing element may also be given as the
+    level; it is parsed with as is, without caching.
+
+    With fast=True the fast grammar for that level is used, with
+    fast=False the reference grammar; by default, the fast_mode setting.
+
+    With backend='rd' the recursive-descent parser is used instead and
+    the result is a syntax tree (see nodes) rather than a ParseResult;
+    by default, the use_backend setting. Both raise the same
+    ParseException on invalid code.
+
+    Results and errors are cached. A cached ParseResult is copied for
+    the caller unless shared=True, for callers that only read it.
     """
-    try:
-        result = parselevel.parseString(code_str, parseAll=True)
+    if backend is None:
+        backend = BACKEND['name']
+    if fast is None:
+        fast = FAST_MODE['enabled']
+    key = None
+    if PARSE_CACHE.maxsize > 0:
+        key = parse_key(code_str, parselevel, fast, backend)
+    result = PARSE_CACHE.get(key) if key else None
+    if result is None:
+        try:
+            result = parse_result(code_str, parselevel, fast, backend)
+        except pp.ParseException as err:
+            result = err
+        if key:
+            PARSE_CACHE.put(key, result)
+    if isinstance(result, nodes.Node):
         return result
-    except pp.ParseException as err:
-        raise err
+    if isinstance(result, pp.ParseException):
+        raise result
+    if key and not shared:
+        result = copy.deepcopy(result)
+    return result
+
+
+def parse_result(code_str, parselevel, fast, backend):
+    """Parse as parse() does, without the cache: a ParseResult, or
+    a syntax tree with backend='rd'.
+    """
+    if backend == 'rd' and is_level(parselevel):
+        return rdparser.parse(code_str, parselevel)
+    if is_level(parselevel):
+        parselevel = grammar(fast)[parselevel]
+    return parselevel.parseString(code_str, parseAll=True)
+
+
+def build_tree(code_str, parselevel=root, fast=None, backend=None):
+    """Parse panelcode string at level parselevel into a syntax tree,
+    as parse_tree() does, without caching the tree or its results.
+    """
+    if backend is None:
+        backend = BACKEND['name']
+    if fast is None:
+        fast = FAST_MODE['enabled']
+    return nodes.build(parse_result(code_str, parselevel, fast, backend))
+
+
+def parse_tree(code_str, parselevel=root, fast=None, backend=None):
+    """Parse panelcode string at level parselevel into a syntax tree.
+    Returns nodes built straight from the parse results,
+    e.g. a nodes.Pcode for parser.root. Trees and errors are cached and
+    shared; the parse results they are built from are not cached.
+    """
+    if backend is None:
+        backend = BACKEND['name']
+    if fast is None:
+        fast = FAST_MODE['enabled']
+    key = None
+    if TREE_CACHE.maxsize > 0:
+        key = parse_key(code_str, parselevel, fast, backend, 'tree')
+    tree = TREE_CACHE.get(key) if key else None
+    if tree is None:
+        try:
+            tree = build_tree(code_str, parselevel, fast, backend)
+        except pp.ParseException as err:
+            tree = err
+        if key:
+            TREE_CACHE.put(key, tree)
+    if isinstance(tree, pp.ParseException):
+        raise tree
+    return tree
+
+
+# top-level delimiters @ and ; among the tokens that can hide them:
+# quoted values and comments (as scanner.TOKENS finds them), and the
+# braces of option blocks
+TOP_LEVEL = re.compile(r"""
+    '[^']*' | "(?:\\.|[^"])*" | //[^\n]* | /\*[\s\S]*?\*/ | [{}@;]
+    """, re.VERBOSE)
+
+# the same within a chunk of a stream: a token that may go on in the
+# next chunk matches as partial, at the end of the chunk
+STREAM_TOP_LEVEL = re.compile(r"""
+    '[^']*' | "(?:\\.|[^"])*" | //[^\n]*(?=\n) | /\*[\s\S]*?\*/ | [{}@;]
+  | (?P<partial>(?:'[^']* | "(?:\\.|[^"])* | //[^\n]* | /\*[\s\S]* | /)\Z)
+    """, re.VERBOSE)
+
+
+def iter_top_level(chunks):
+    """Split panelcode given as chunks of text lexically at its
+    top-level delimiters @ and ;, without parsing it. Yields (code,
+    delimiter) for the code before each delimiter, then (code, None)
+    for the rest. Delimiters in option blocks, quoted values and
+    comments don't count; tokens may span chunks.
+    """
+    in_opts = False
+    parts = []
+    pending = ''
+    chunks = iter(chunks)
+    while True:
+        chunk = next(chunks, None)
+        text = pending + chunk if chunk else pending
+        pending = ''
+        begin = 0
+        tokens = STREAM_TOP_LEVEL if chunk else TOP_LEVEL
+        for match in tokens.finditer(text):
+            char = match.group()
+            if match.lastgroup == 'partial':
+                pending = text[match.start():]
+                text = text[:match.start()]
+                break
+            if char == '{':
+                in_opts = True
+            elif char == '}':
+                in_opts = False
+            elif char in ('@', ';') and not in_opts:
+                parts.append(text[begin:match.start()])
+                yield ''.join(parts), char
+                parts = []
+                begin = match.end()
+        parts.append(text[begin:])
+        if not chunk:
+            yield ''.join(parts), None
+            return
+
+
+def strip_comments(code_str):
+    """Code without the comments that TOP_LEVEL finds."""
+    return TOP_LEVEL.sub(
+        lambda match: '' if match.group()[:1] == '/' else match.group(),
+        code_str)
+
+
+def split_galleries(stream, chunk_size=65536):
+    """Split a panelcode text stream into the code of each gallery,
+    at top-level @ delimiters (see iter_top_level). Reads chunk_size
+    characters at a time; yields one gallery's code at a time, comments
+    included. The last code also holds any pcode options {! }.
+    """
+    codes = []
+    for code, delimiter in iter_top_level(
+            iter(lambda: stream.read(chunk_size), '')):
+        codes.append(code)
+        if delimiter != ';':
+            yield ';'.join(codes)
+            codes = []
+
+
+def split_spreads(code_str):
+    """Split panelcode lexically at its top-level delimiters (see
+    iter_top_level): a list of galleries, split at @, each a list of the
+    code of its spreads, split at ;. The last code of a gallery keeps
+    its options {@ }, and the last code of all the pcode options {! }.
+    """
+    galleries = [[]]
+    for code, delimiter in iter_top_level([code_str]):
+        galleries[-1].append(code)
+        if delimiter == '@':
+            galleries.append([])
+    return galleries
+
+
+def chunk_levels(galleries):
+    """(code, level) to parse each spread code of split_spreads at:
+    gallery, for a spread and any gallery options after it, and root
+    for the last code, which may hold the pcode options too.
+    """
+    chunks = [(code, gallery) for codes in galleries for code in codes]
+    chunks[-1] = (chunks[-1][0], root)
+    return chunks
+
+
+def parse_chunk(chunk):
+    """Syntax tree of a (code, level) chunk, or None if it doesn't parse."""
+    try:
+        return parse_tree(*chunk)
+    except pp.ParseException:
+        return None
+
+
+def join_chunks(galleries, trees):
+    """Stitch the trees of the chunk_levels of split_spreads into the
+    tree of the whole code: spreads in order, with the options of their
+    gallery from its last code, and the pcode options from the last
+    code of all. Returns None if the chunks didn't parse as the code
+    would, with a tree that is None or holds more or other than one
+    spread and its options; parse the code whole for its error.
+    """
+    trees = iter(trees)
+    gallery_nodes = []
+    pcode_opts = ()
+    for codes in galleries:
+        spreads = []
+        for idx in range(len(codes)):
+            tree = next(trees)
+            if isinstance(tree, nodes.Pcode) and len(tree.galleries) == 1:
+                pcode_opts = tree.opts
+                tree = tree.galleries[0]
+            if (not isinstance(tree, nodes.Gallery) or
+                    len(tree.spreads) != 1 or
+                    (tree.opts and idx < len(codes) - 1)):
+                return None
+            spreads.append(tree.spreads[0])
+        gallery_nodes.append(nodes.Gallery(tuple(spreads), tree.opts))
+    return nodes.Pcode(tuple(gallery_nodes), pcode_opts)
+
+
+class GalleryStream(object):
+    """Galleries parsed one at a time from a panelcode text stream.
+    Iterate over it for gallery nodes; only one gallery's code and tree
+    are held at a time, e.g. for rendering with
+    render.iter_html5_ccs3_grid. Iterate once. Comments are removed
+    from each gallery's code before it is parsed.
+
+    The pcode options {! } come after the last gallery. If they are not
+    passed in as opts, they are read ahead: streams that can't seek,
+    such as pipes, are first copied to a temporary file, a chunk at a
+    time. Invalid code raises ParseException for the code of the
+    gallery it is in.
+    """
+    def __init__(self, stream, opts=None, backend=None, chunk_size=65536):
+        self.stream = stream
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.opts = opts
+        if opts is None:
+            self.opts = self.read_opts()
+
+    def spool(self):
+        """Copy the stream to a temporary file that can seek, and read
+        from that instead. Text is stored as utf-8 and read back as text.
+        """
+        copy = tempfile.TemporaryFile()
+        text = False
+        for chunk in iter(lambda: self.stream.read(self.chunk_size), ''):
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+                text = True
+            copy.write(chunk)
+        copy.seek(0)
+        self.stream = codecs.getreader('utf-8')(copy) if text else copy
+
+    def read_opts(self):
+        """Read ahead for the pcode options, restoring the stream
+        position.
+        """
+        try:
+            start = self.stream.tell()
+        except (AttributeError, IOError):
+            self.spool()
+            start = 0
+        code = ''
+        for code in split_galleries(self.stream, self.chunk_size):
+            pass
+        self.stream.seek(start)
+        return self.parse(code, root).opts
+
+    def parse(self, code, level):
+        """Syntax tree of a gallery's code, without its comments.
+        Galleries of a stream don't recur: they are parsed uncached, so
+        the caches don't hold on to them (see build_tree).
+        """
+        return build_tree(strip_comments(code), level, backend=self.backend)
+
+    def __iter__(self):
+        codes = split_galleries(self.stream, self.chunk_size)
+        code = next(codes)
+        for next_code in codes:
+            yield self.parse(code, gallery)
+            code = next_code
+        yield self.parse(code, root).galleries[0]
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Hand-written panelcode parser backend.
+A recursive-descent parser over the tokens of the shared scanner (see
+scanner) and the levels of the EBNF, building syntax trees (see nodes)
+directly in a single pass.
+
+It follows the pyparsing grammar in parser.py exactly, including its
+whitespace handling, and raises the same ParseException at the same
+location for code it rejects. Use it through parser.parse:
+
+    parser.parse(code_str, parser.root, backend='rd')
+
+Level delimiters: @ gallery, ; spread, | layout, _ panelgroup,
+, row and + panel. Option blocks: {! pcode, {@ gallery, {; spread,
+{: or {| layout, { or {+ panelgroup (also {::::, {:::, {::).
+"""
+
+from __future__ import print_function
+import panelcode.lazy as lazy
+import panelcode.nodes as nodes
+import panelcode.scanner as scanner
+
+pp = lazy.LazyModule('panelcode.lib.pyparsing', 'pyparsing')
+
+
+# option block openers by level
+OPENERS = {'{': 'panelgroup', '{+': 'panelgroup',
+           '{:': 'layout', '{|': 'layout',
+           '{::': 'spread', '{;': 'spread',
+           '{:::': 'gallery', '{@': 'gallery',
+           '{::::': 'pcode', '{!': 'pcode'}
+
+WHITESPACE = ' \t\r\n'
+
+
+def tokenize(code_str):
+    """Split code into (kind, text, start, end) tokens, without whitespace,
+    from the shared scan of the code (see scanner.scan).
+    """
+    return [token for token in scanner.scan(code_str) if token[0] != 'ws']
+
+
+class Parser(object):
+    """Recursive-descent panelcode parser over a token list."""
+
+    def __init__(self, code_str):
+        # pyparsing parses with tabs expanded; so do we, for identical
+        # quoted values and error locations
+        self.code = code_str.expandtabs()
+        self.tokens = tokenize(self.code)
+        self.tokens.append(('end', '', len(self.code), len(self.code)))
+        self.pos = 0
+
+    def accept(self, text):
+        """Consume the current token if it is punct text."""
+        kind, tok_text = self.tokens[self.pos][:2]
+        if kind == 'punct' and tok_text == text:
+            self.pos += 1
+            return True
+        return False
+
+    def parse(self, level='pcode'):
+        """Parse all code at a level: pcode, gallery, spread, layout or
+        panelgroup. Raises ParseException if code is left over.
+        """
+        node = getattr(self, level)()
+        kind, _, start = self.tokens[self.pos][:3]
+        if kind != 'end':
+            raise pp.ParseException(self.code, start, 'Expected end of text')
+        return node
+
+    # levels of organization
+
+    def pcode(self):
+        """galleries joined by @ with optional {! } options"""
+        galleries = [self.gallery()]
+        while self.accept('@'):
+            galleries.append(self.gallery())
+        return nodes.Pcode(tuple(galleries), self.opts('pcode'))
+
+    def gallery(self):
+        """spreads joined by ; with optional {@ } options"""
+        spreads = [self.spread()]
+        while self.accept(';'):
+            spreads.append(self.spread())
+        return nodes.Gallery(tuple(spreads), self.opts('gallery'))
+
+    def spread(self):
+        """layouts joined by | with optional {; } options"""
+        layouts = [self.layout()]
+        while self.accept('|'):
+            layouts.append(self.layout())
+        return nodes.Spread(tuple(layouts), self.opts('spread'))
+
+    def layout(self):
+        """panelgroups joined by _ with optional {: } options"""
+        panelgroups = [self.panelgroup()]
+        while self.accept('_'):
+            panelgroups.append(self.panelgroup())
+        return nodes.Layout(tuple(panelgroups), self.opts('layout'))
+
+    def panelgroup(self):
+        """optionally parenthesized rows of units, with optional { }
+        options. Rows are split on , and units joined by +.
+        A unit may be empty, so a panelgroup always matches.
+        """
+        self.accept('(')
+        rows = [[self.unit()]]
+        while True:
+            if self.accept('+'):
+                rows[-1].append(self.unit())
+            elif self.accept(','):
+                rows.append([self.unit()])
+            else:
+                break
+        self.accept(')')
+        return nodes.Panelgroup(tuple(tuple(row) for row in rows),
+                                self.opts('panelgroup'))
+
+    def unit(self):
+        """optional panel count followed by attr words, e.g. 2.r2"""
+        term = ['']
+        kind, text = self.tokens[self.pos][:2]
+        if kind == 'num':
+            term[0] = text
+            self.pos += 1
+        while True:
+            word = self.attr_word()
+            if word is None:
+                break
+            term.append(word)
+        return nodes.build_panel(term)
+
+    def attr_word(self):
+        """optional . followed by a term, or None"""
+        pos = self.pos
+        self.accept('.')
+        kind, text = self.tokens[self.pos][:2]
+        if kind == 'word':
+            self.pos += 1
+            return text
+        self.pos = pos
+        return None
+
+    # options
+
+    def opts(self, level):
+        """Options block for level, or () if there is none here."""
+        kind, text = self.tokens[self.pos][:2]
+        if kind != 'open' or OPENERS.get(text) != level:
+            return ()
+        pos = self.pos
+        self.pos += 1
+        opts = []
+        while True:
+            opt = self.opt()
+            if opt is None:
+                break
+            opts.append(nodes.build_opt(opt))
+        if self.accept('}'):
+            return tuple(opts)
+        self.pos = pos
+        return ()
+
+    def opt(self):
+        """One option as parsed: a kv_expr [key, value], a kv_word
+        [letters, digits], an attr_word string, or None.
+        """
+        pos = self.pos
+        self.accept('.')
+        kind, text, _, end = self.tokens[self.pos]
+        if kind != 'word':
+            self.pos = pos
+            return None
+        self.pos += 1
+        # kv_expr
+        if self.accept('='):
+            kind, value = self.tokens[self.pos][:2]
+            if kind == 'quoted':
+                self.pos += 1
+                return [text, value[1:-1].lstrip(WHITESPACE)]
+            if kind == 'word':
+                self.pos += 1
+                return [text, value]
+            self.pos -= 1
+        # kv_word: an alpha-only word followed by whitespace takes the
+        # digits after the whitespace, if any
+        if (text.isalpha() and end < len(self.code) and
+                self.code[end] in WHITESPACE):
+            kind, digits = self.tokens[self.pos][:2]
+            if kind == 'num':
+                self.pos += 1
+                return [text, digits]
+            return [text, '']
+        return text
+
+
+class Recognizer(Parser):
+    """Recognition-only panelcode parser: accepts or rejects code like
+    Parser, at the same location, but builds no tree.
+    """
+
+    def pcode(self):
+        """galleries joined by @ with optional {! } options"""
+        self.gallery()
+        while self.accept('@'):
+            self.gallery()
+        self.opts('pcode')
+
+    def gallery(self):
+        """spreads joined by ; with optional {@ } options"""
+        self.spread()
+        while self.accept(';'):
+            self.spread()
+        self.opts('gallery')
+
+    def spread(self):
+        """layouts joined by | with optional {; } options"""
+        self.layout()
+        while self.accept('|'):
+            self.layout()
+        self.opts('spread')
+
+    def layout(self):
+        """panelgroups joined by _ with optional {: } options"""
+        self.panelgroup()
+        while self.accept('_'):
+            self.panelgroup()
+        self.opts('layout')
+
+    def panelgroup(self):
+        """optionally parenthesized units joined by + or ,"""
+        self.accept('(')
+        self.unit()
+        while self.accept('+') or self.accept(','):
+            self.unit()
+        self.accept(')')
+        self.opts('panelgroup')
+
+    def unit(self):
+        """optional panel count followed by attr words"""
+        if self.tokens[self.pos][0] == 'num':
+            self.pos += 1
+        while self.attr_word() is not None:
+            pass
+
+    def opts(self, level):
+        """Options block for level, if there is one here."""
+        kind, text = self.tokens[self.pos][:2]
+        if kind != 'open' or OPENERS.get(text) != level:
+            return
+        pos = self.pos
+        self.pos += 1
+        while self.opt() is not None:
+            pass
+        if not self.accept('}'):
+            self.pos = pos
+
+
+def parse(code_str, level='pcode'):
+    """Parse panelcode string into a syntax tree at a level:
+    pcode, gallery, spread, layout or panelgroup.
+    """
+    return Parser(code_str).parse(level)
+
+
+def recognize(code_str, level='pcode'):
+    """Check that panelcode string parses at a level, without building
+    a tree. Raises the ParseException parse() would raise.
+    """
+    Recognizer(code_str).parse(level)
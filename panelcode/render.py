@@ -7,53 +7,125 @@
 
 from __future__ import print_function
 import datetime
+import hashlib
 import os
 import re
+import panelcode.cssprune as cssprune
+import panelcode.fences as fences
+import panelcode.lazy as lazy
+import panelcode.nodes as nodes
 import panelcode.parser as parser
-import panelcode.highlight as highlight
-import panelcode.templates as templates
-try:
-    import panelcode.libs.mistune as mistune
-except ImportError:
-    import mistune
-
-
-CSS_ATTACH_SCRIPT = """<script type="text/javascript">
-  $('head').append('<link rel="stylesheet" type="text/css" href="./custom.css">')
-</script>"""
-
-CSS_ATTACH_SCRIPT_NO_CACHE = """<script type="text/javascript">
-   $('head').append('<link rel="stylesheet" type="text/css" href="./custom.css?nocache=' + new Date().toISOString() + '">')
-</script>"""
-
-JQUERY_SCRIPT_CDN = """<script
-  src="https://code.jquery.com/jquery-2.2.4.min.js"
-  integrity="sha256-BbhdlvQf/xTY9gja0Dq3HiwQF8LaCRTXxZKRutelT44="
-  crossorigin="anonymous">
-</script>"""
-SIZER_SCRIPT = """<script type="text/javascript">
-  $(document).ready(function(){
-    // On load
-    $('.gallery-size').change(function(){
-      $(this).closest('div.gallery')
-      .removeClass('default small thumb mini micro micro2')
-        .addClass( $(this).val() );
-    })
-    $('.all-size').change(function(){
-      $('div.gallery')
-      .removeClass('default small thumb mini micro micro2')
-        .addClass( $(this).val() );
-    })
-})
-</script>"""
+
+# imported on first use: pygments, jinja2 and mistune
+highlight = lazy.LazyModule('panelcode.highlight')
+templates = lazy.LazyModule('panelcode.templates')
+mistune = lazy.LazyModule('panelcode.libs.mistune', 'mistune')
+
+
+# stylesheets included by html_page.html
+PAGE_STYLESHEETS = ('site.css', 'panelcode-grid.css')
+
+# fenced code blocks: group 3 is the code, see mistune. Documents are
+# split with the linear fence scanner instead (see fences), which
+# splits well-formed documents as FENCES.split does
+FENCES = re.compile(
+    r' *(`{3,}|~{3,})( *\S+ *)?\n'  # ```lang (removed)
+    r'([\s\S]+?\s*)'
+    r'(\1)(?: *\n+|$)')  # ```
+
+# comments, see decomment; group 1 holds quoted strings to keep
+COMMENTS = re.compile(
+    r"//.*|/\*[\s\S]*?\*/|(\"(\\.|[^\"])*\"|'(\\.|[^\'])*')")
+
+# info strings of fenced blocks rendered as panelcode. Untagged blocks
+# are too if they pass the prefilter (see non_panelcode_loc); blocks
+# tagged otherwise (python, json...) are shown as code, unparsed
+PANELCODE_TAGS = ('panelcode', 'pcode')
+
+# characters that panelcode is made of, outside quoted values
+PANELCODE_CHARS = re.compile(
+    r"(?:[A-Za-z0-9 \t\r\n_|;@+,().=}{:!-]+|'[^']*')*")
+
+# css customization / override file, linked from pages saved beside it:
+# looked up in the directory of the output page (see custom_css_href)
+CUSTOM_CSS = 'custom.css'
+CUSTOM_CSS_LINK = '<link rel="stylesheet" type="text/css" href="{0}">'
+
+# documents with fewer code blocks, and blocks with fewer spreads, are
+# parsed and rendered serially even when jobs are asked for: starting a
+# process pool costs more than it saves
+PARALLEL_MIN_BLOCKS = 64
+
+# console script: delegated listeners for all consoles on a page, so it
+# needs no library and can run once, deferred until the page is parsed.
+# Inline scripts ignore defer, but module scripts are always deferred.
+# Page wrappers put it in the head; fragments leave it to their page.
+# 1. size switcher: selecting a size sets it as the class of the
+#    console's gallery, or of all galleries.
+# 2. lazy consoles (see console_html): the size menu and code view of a
+#    console, highlighted on the server like any other, are inserted
+#    from their <template> when it is first opened.
+CONSOLE_SIZES = ('default', 'small', 'thumb', 'mini', 'micro', 'micro2')
+CONSOLE_SCRIPT = r"""<script type="module">
+(function () {
+  var sizes = ['%s'];
+  function resize(gallery, size) {
+    for (var i = 0; i < sizes.length; i++) {
+      gallery.classList.remove(sizes[i]);
+    }
+    if (size) {
+      gallery.classList.add(size);
+    }
+  }
+  document.addEventListener('change', function (event) {
+    var select = event.target;
+    if (!select.classList) {
+      return;
+    }
+    if (select.classList.contains('gallery-size')) {
+      var gallery = select.closest('div.gallery');
+      if (gallery) {
+        resize(gallery, select.value);
+      }
+    } else if (select.classList.contains('all-size')) {
+      var galleries = document.querySelectorAll('div.gallery');
+      for (var i = 0; i < galleries.length; i++) {
+        resize(galleries[i], select.value);
+      }
+    }
+  });
+  function expand(details) {
+    var template = details.querySelector('template.console-code');
+    if (template) {
+      template.parentNode.replaceChild(
+        document.importNode(template.content, true), template);
+    }
+  }
+  document.addEventListener('toggle', function (event) {
+    if (event.target.open && event.target.querySelector) {
+      expand(event.target);
+    }
+  }, true);
+  document.addEventListener('DOMContentLoaded', function () {
+    var opened = document.querySelectorAll('details[open]');
+    for (var i = 0; i < opened.length; i++) {
+      expand(opened[i]);
+    }
+  });
+})();
+</script>""" % "', '".join(CONSOLE_SIZES)
 
 
 def console_html(size_list='', content='', summary='panelcode',
-                 css_class='gallery-size', reveal='open'):
+                 css_class='gallery-size', reveal='open', lazy=False):
     """Render a console area for a gallery. Includes:
     1. a code view (syntax highlighting)
     2. resizing of gallery layouts
     3. show / hide console contents
+
+    A lazy console keeps its size menu and content in a <template>,
+    inert until CONSOLE_SCRIPT inserts them when the console is first
+    opened.
     """
     if not size_list:
         size_list = ['', 'default', 'small', 'thumb', 'mini', 'micro2']
@@ -61,12 +133,14 @@ def console_html(size_list='', content='', summary='panelcode',
     tmpl = templates.load(filename=template)
     html_str = tmpl.render(summary=summary, option_list=size_list,
                            css_class=css_class, content=content,
-                           reveal=reveal)
+                           reveal=reveal, lazy=lazy)
     return html_str
 
 
+
 def parse_fenced_to_html(data_list, mode='replace', reveal='open',
-                         consoles=True, colorize=True, fmt='markdown'):
+                         consoles=True, colorize=True, fmt='markdown',
+                         custom_css=CUSTOM_CSS, jobs=1, out_dir=''):
     """Parse panelcode only within markdown fenced code blocks.
     Split a list of lines on fence open and close markers,
     attempt to render code block contents as panelcode or pass through,
@@ -74,90 +148,391 @@ def parse_fenced_to_html(data_list, mode='replace', reveal='open',
 
     Results can replace the code block ('replace') or come
     before or after it ('pre' / 'post')
+
+    A custom_css file, if there is one, is linked (see custom_css_link);
+    a relative path is looked up in out_dir, where the output is saved.
+    Consoles='lazy' renders consoles whose code views are inserted
+    when first opened (see console_html), for pages with many blocks.
+    Code blocks are parsed by jobs processes (see parse_fenced_blocks),
+    default 1 for this process.
     """
-    result_list = []
-    global_opts = []
-    fences = re.compile(  # see mistune
-        r' *(`{3,}|~{3,})( *\S+ *)?\n'  # ```lang (removed)
-        r'([\s\S]+?\s*)'
-        r'(\1)(?: *\n+|$)')  # ```
-    data_fence_list = fences.split('\n'.join(data_list))
-    if consoles and len(data_fence_list) > 1:
-        result_list.extend([JQUERY_SCRIPT_CDN, SIZER_SCRIPT])
+    if fmt == 'htmlfull':
+        result_list = list(text_items(iter_fenced_to_html(
+            data_list, mode, reveal, consoles, colorize, fmt,
+            fragment=False, jobs=jobs)))
+        return html_page_wrapper(result_list, custom_css=custom_css,
+                                 out_dir=out_dir)
+    return list(text_items(iter_fenced_to_html(
+        data_list, mode, reveal, consoles, colorize, fmt, custom_css,
+        jobs=jobs, out_dir=out_dir)))
 
-    # inject css customization / override file hook
-    result_list.extend([CSS_ATTACH_SCRIPT_NO_CACHE])
 
-    # assemble all global opts from any code block and merge
-    # before passing merged opts into per-code-block contexts
-    global_opts_dict = dict()
-    for idx, graph in enumerate(data_fence_list):
-        if idx % 5 == 3:
-            new_global_opts = (graph_to_pcode_obj(graph).asDict())['pcode'][0].pop('pcodeopts', [['']])
-            if new_global_opts[0][0]:
-                pass
-            for item in new_global_opts[0]:
-                if isinstance(item, list) and len(item) == 2:
-                    global_opts_dict.update([item])
-                if isinstance(item, basestring) and len(item) > 0:
-                    global_opts_dict.update([[item, '']])
-    global_opts_list = []
-    for key, value in global_opts_dict.items():
-        global_opts_list.append([key, value])
-    global_opts.append(global_opts_list)
+def iter_fenced_to_html(data_list, mode='replace', reveal='open',
+                        consoles=True, colorize=True, fmt='markdown',
+                        custom_css=CUSTOM_CSS, fragment=True, jobs=1,
+                        out_dir=''):
+    """Yield the items of parse_fenced_to_html, without the page wrapper,
+    as they are rendered. All code blocks are parsed first, for their
+    global options, by jobs processes (see parse_fenced_blocks). Code
+    block items are iterators of html chunks, rendered as they are
+    consumed (see iter_graph_to_html); the rest are strings.
+
+    A fragment starts with the custom css link, which a page wrapper
+    puts in the page head instead: pass fragment=False for contents of
+    a page. Only the page wrapper adds the console script (see
+    CONSOLE_SCRIPT), once per page.
+    """
+    data_fence_list = fences.split_fences(data_list)
+    if fragment:
+        # css customization / override file hook
+        custom_link = custom_css_link(custom_css, out_dir)
+        if custom_link:
+            yield custom_link
+
+    # parse each code block once, then assemble all global opts from the
+    # stored trees and merge before passing merged opts into per-code-block
+    # contexts, which render from the same stored trees
+    pcode_objs = parse_fenced_blocks(data_fence_list, jobs)
+    global_opts = [merge_global_opts(
+        [pobj_globals(pcode_objs[idx]) for idx in sorted(pcode_objs)
+         if not isinstance(pcode_objs[idx], parser.pp.ParseException)])]
 
     for idx, graph in enumerate(data_fence_list):
         if graph is None:
             continue
         if idx % 5 == 0:
-            if fmt == 'html' or 'htmlfull':
-                result_list.append(mdhtml_to_html(graph))
+            if fmt in MARKDOWN_FORMATS:
+                yield mdhtml_to_html(graph)
             else:
-                result_list.append(graph)
+                yield graph
         if idx % 5 == 3:
-            result = parse_graph_to_html(graph, mode, reveal,
-                                         consoles, colorize, global_opts)
-            result_list.append(result)
+            yield iter_graph_to_html(graph, mode, reveal,
+                                     consoles, colorize, global_opts,
+                                     pcode_obj=pcode_objs[idx], jobs=jobs)
     if consoles and len(data_fence_list) > 1:
         console_str = console_html(content='',
                                    summary='Resize all galleries: ',
                                    css_class='all-size',
                                    reveal=reveal)
-        result_list.append(console_str)
-    result_list.append('<p style="font-size:x-small">' +
-                       '<em>panelcode: fence pre-processor</em></p>\n')
+        yield console_str
+    yield ('<p style="font-size:x-small">' +
+           '<em>panelcode: fence pre-processor</em></p>\n')
+
+
+def text_items(items):
+    """Yield items as strings, joining iterators of chunks."""
+    for item in items:
+        if isinstance(item, basestring):
+            yield item
+        else:
+            yield ''.join(item)
+
+
+def iter_lines(items, sep='\n'):
+    """Yield the chunks of sep.join(text_items(items)), without joining:
+    iterator items are passed through chunk by chunk.
+    """
+    for idx, item in enumerate(items):
+        if idx:
+            yield sep
+        if isinstance(item, basestring):
+            yield item
+        else:
+            for chunk in item:
+                yield chunk
+
+
+def write_html(chunks, sink, encoding='utf-8'):
+    """Write html chunks to a file-like sink as they come, encoded,
+    or as text if encoding is None. Returns the number of chunks.
+    """
+    count = 0
+    for chunk in chunks:
+        if encoding:
+            chunk = chunk.encode(encoding)
+        sink.write(chunk)
+        count += 1
+    return count
+
+
+def stream_fenced_to_html(data_list, sink, mode='replace', reveal='open',
+                          consoles=True, colorize=True, fmt='markdown',
+                          custom_css=CUSTOM_CSS, encoding='utf-8', jobs=1,
+                          out_dir=None, **page_args):
+    """Render as parse_fenced_to_html, writing to a file-like sink as
+    rendering goes, rather than returning a list: the sink receives
+    '\n'.join(parse_fenced_to_html(...)). With fmt='htmlfull',
+    page_args are passed to the page wrapper, which inlines all styles
+    unless prune_styles=True (see iter_page_wrapper). By default out_dir is
+    the directory of the sink, if it is a file, else the current one.
+    """
+    if out_dir is None:
+        out_dir = sink_dir(sink)
     if fmt == 'htmlfull':
-        result_list = html_page_wrapper(result_list)
-    return result_list
+        items = iter_fenced_to_html(data_list, mode, reveal, consoles,
+                                    colorize, fmt, fragment=False, jobs=jobs)
+        chunks = iter_page_wrapper(text_items(items), custom_css=custom_css,
+                                   out_dir=out_dir, **page_args)
+    else:
+        items = iter_fenced_to_html(data_list, mode, reveal, consoles,
+                                    colorize, fmt, custom_css, jobs=jobs,
+                                    out_dir=out_dir)
+        chunks = iter_lines(items)
+    return write_html(chunks, sink, encoding)
+
+
+def sink_dir(sink):
+    """Directory of the file a sink writes to, or '' for the current
+    directory if it has none, e.g. stdout or a StringIO.
+    """
+    name = getattr(sink, 'name', None)
+    if isinstance(name, basestring) and os.path.isfile(name):
+        return os.path.dirname(name)
+    return ''
 
 
 def html_page_wrapper(data_list, pagetitle='', template='html_page.html',
-                      styles_inline=True, show_timestamp=True, timestamp=''):
+                      styles_inline=True, show_timestamp=True, timestamp='',
+                      prune_styles=True, stylesheets=None,
+                      custom_css=CUSTOM_CSS, out_dir=''):
     """Wrap html contents in a full panelcode html page with styles.
     Styles_inline copies the style information into the page itself,
-    rather than pointing to external stylesheets.
+    rather than pointing to external stylesheets. Prune_styles inlines
+    only the style rules for the classes in the page (see cssprune).
+    Otherwise pages link to stylesheets, a list of urls, by default the
+    styles folder (see utils.publish_styles for shared, hashed ones).
+    A custom_css file, if there is one, is linked in the head after
+    the page styles; a relative path is looked up in out_dir, where
+    the page is saved (see custom_css_href). The head also holds the
+    console script, once per page, deferred (see CONSOLE_SCRIPT).
+    """
+    html_page_str = ''.join(iter_page_wrapper(
+        data_list, pagetitle, template, styles_inline, show_timestamp,
+        timestamp, prune_styles, stylesheets, custom_css, out_dir))
+    result_list = html_page_str.split('\n')
+    return result_list
+
+
+def iter_page_wrapper(data_list, pagetitle='', template='html_page.html',
+                      styles_inline=True, show_timestamp=True, timestamp='',
+                      prune_styles=False, stylesheets=None,
+                      custom_css=CUSTOM_CSS, out_dir=''):
+    """Yield the chunks of a full html page as html_page_wrapper, without
+    joining them. data_list may be an iterator of html strings, which is
+    consumed as the page is generated, so the head goes out before the
+    contents are rendered. Pruning styles needs the classes of all the
+    contents before the head, so prune_styles=True renders the whole
+    page first: smaller pages, but nothing is sent until they are done.
+    Streaming therefore inlines all styles by default.
     """
     tmpl = templates.load(filename=template)
     if show_timestamp:
         timestamp = datetime.datetime.now().replace(microsecond=0)
-    html_page_str = tmpl.render(contents=data_list,
-                                pagetitle=pagetitle,
-                                styles_inline=styles_inline,
-                                datetime=timestamp
-                                )
-    result_list = html_page_str.split('\n')
-    return result_list
+    styles = None
+    if styles_inline and prune_styles:
+        data_list = list(data_list)
+        styles = page_styles(data_list)
+    return tmpl.generate(contents=data_list,
+                         pagetitle=pagetitle,
+                         styles_inline=styles_inline,
+                         styles=styles,
+                         stylesheets=stylesheets,
+                         custom_css=custom_css_href(custom_css, out_dir),
+                         console_script=CONSOLE_SCRIPT,
+                         datetime=timestamp
+                         )
 
 
-def graph_to_pcode_obj(graph):
-    """Convert panelcode code block to a pcode pyparsing object."""
+def custom_css_href(custom_css=CUSTOM_CSS, out_dir=''):
+    """Fingerprinted url of a custom css file, for pages saved beside it,
+    e.g. custom.css?v=0123456789ab, or None if there is no such file.
+    The url changes with the file's content, so browsers can cache it.
+    A relative custom_css is looked up in out_dir, the directory the
+    page is saved in, by default the current directory.
+    """
+    if not custom_css:
+        return None
+    try:
+        with open(os.path.join(out_dir, custom_css), 'rb') as cssfile:
+            data = cssfile.read()
+    except EnvironmentError:
+        return None
+    return '%s?v=%s' % (os.path.basename(custom_css),
+                        hashlib.sha1(data).hexdigest()[:12])
+
+
+def custom_css_link(custom_css=CUSTOM_CSS, out_dir=''):
+    """Link to a custom css file (see custom_css_href), or ''."""
+    href = custom_css_href(custom_css, out_dir)
+    if href is None:
+        return ''
+    return CUSTOM_CSS_LINK.format(href)
+
+
+def page_styles(data_list):
+    """The page stylesheets, pruned to the classes used in html contents."""
+    classes = cssprune.html_classes(data_list)
+    return '\n'.join(cssprune.prune(templates.source(filename=name), classes)
+                     for name in PAGE_STYLESHEETS)
+
+
+def parse_fenced_blocks(data_fence_list, jobs=1):
+    """Parse every code block of a fence-split document exactly once.
+    Returns a dict of parse results keyed by position in data_fence_list.
+    Blocks that are not valid panelcode keep their ParseException
+    in place of a tree, so later passes can skip or fall back on them.
+
+    Parsing is most of the work of rendering a block, and blocks parse
+    independently: with jobs > 1 (None for one per core), documents of
+    PARALLEL_MIN_BLOCKS blocks or more are parsed by a process pool,
+    and trees come back in order (see block_jobs). In documents of
+    fewer blocks, large blocks are parsed in chunks by a pool instead
+    (see split_pcode_obj).
+    """
+    idxs = range(3, len(data_fence_list), 5)
+    blocks = [(data_fence_list[idx], data_fence_list[idx - 1])
+              for idx in idxs]
+    pool_jobs, multiprocessing = block_jobs(jobs, len(blocks))
+    if multiprocessing is None:
+        return dict((idx, block_pcode_obj(graph, info, jobs))
+                    for idx, (graph, info) in zip(idxs, blocks))
+    pool = multiprocessing.Pool(pool_jobs)
+    try:
+        trees = pool.map(block_tree, blocks,
+                         chunksize=max(1, len(blocks) // (4 * pool_jobs)))
+    finally:
+        pool.close()
+        pool.join()
+    return dict((idx, parser.pp.ParseException(*tree)
+                 if isinstance(tree, tuple) else tree)
+                for idx, tree in zip(idxs, trees))
+
+
+def block_jobs(jobs, blocks):
+    """Processes to parse or render blocks (or chunks of one) with: jobs,
+    or one per core for jobs=None, and 1 where a pool wouldn't pay or
+    can't be had (see PARALLEL_MIN_BLOCKS), returned with the
+    multiprocessing module.
+    """
+    if (jobs is not None and jobs < 2) or blocks < PARALLEL_MIN_BLOCKS:
+        return 1, None
+    try:
+        import multiprocessing
+    except ImportError:  # e.g. Jython
+        return 1, None
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    return (jobs, multiprocessing) if jobs > 1 else (1, None)
+
+
+def block_tree(block):
+    """Syntax tree of a (code, info) block, or the (pstr, loc, msg) of
+    its ParseException if it is not panelcode: the worker of
+    parse_fenced_blocks. ParseExceptions don't survive pickling back
+    from a pool, so the parent rebuilds them from these.
+    """
+    pcode_obj = block_pcode_obj(*block)
+    if isinstance(pcode_obj, parser.pp.ParseException):
+        return (pcode_obj.pstr, pcode_obj.loc, pcode_obj.msg)
+    return pcode_obj
+
+
+def merge_global_opts(opts_lists):
+    """Merge lists of pcode options into a single global options list.
+    Later key value pairs take precedence; attr words are kept once.
+    """
+    global_opts_dict = dict()
+    for opts in opts_lists:
+        for item in opts:
+            if isinstance(item, (list, tuple)) and len(item) == 2:
+                global_opts_dict.update([item])
+            if isinstance(item, basestring) and len(item) > 0:
+                global_opts_dict.update([[item, '']])
+    global_opts_list = []
+    for key, value in global_opts_dict.items():
+        global_opts_list.append([key, value])
+    return global_opts_list
+
+
+def info_tag(info):
+    """Language tag of a fenced block's info string, lowercase,
+    or None for untagged blocks."""
+    if info is None or not info.strip():
+        return None
+    return info.split()[0].lower()
+
+
+def non_panelcode_loc(code):
+    """Location of the first character of decommented code that cannot
+    be panelcode, or None if all can. A cheap check before parsing:
+    code it rejects would not parse.
+    """
+    end = PANELCODE_CHARS.match(code).end()
+    return end if end < len(code) else None
+
+
+def block_pcode_obj(graph, info=None, jobs=1):
+    """Syntax tree of a code block, or the ParseException saying why it
+    is not panelcode, returned rather than raised. Blocks are routed by
+    the info string of their fence (see PANELCODE_TAGS), and code that
+    fails the prefilter is not parsed. Large blocks are parsed by jobs
+    processes (see split_pcode_obj).
+    """
+    tag = info_tag(info)
+    if tag is not None and tag not in PANELCODE_TAGS:
+        return parser.pp.ParseException(graph, 0, 'Not panelcode: ' + tag)
     graph_clean = ''.join(decomment(graph))
-    pcode_obj = parser.parse(graph_clean, parser.root)
+    loc = non_panelcode_loc(graph_clean)
+    if loc is not None:
+        return parser.pp.ParseException(graph_clean, loc,
+                                        'Not a panelcode character')
+    try:
+        return split_pcode_obj(graph_clean, jobs)
+    except parser.pp.ParseException as err:
+        return err
+
+
+def split_pcode_obj(code_str, jobs=1):
+    """Parse decommented panelcode into a syntax tree, as
+    parser.parse_tree does. With jobs > 1 (None for one per core), code
+    of PARALLEL_MIN_BLOCKS spreads or more is split at its top-level
+    delimiters and parsed a spread at a time by a process pool, and the
+    trees stitched back together (see parser.split_spreads). Code that
+    doesn't parse in chunks is parsed whole, for its ParseException.
+    """
+    # every spread but the first follows a delimiter: count them before
+    # splitting, which small blocks don't need
+    spreads = code_str.count(';') + code_str.count('@') + 1
+    if (jobs is None or jobs > 1) and spreads >= PARALLEL_MIN_BLOCKS:
+        # tabs expand by column, which splitting would shift
+        galleries = parser.split_spreads(code_str.expandtabs())
+        chunks = parser.chunk_levels(galleries)
+        jobs, multiprocessing = block_jobs(jobs, len(chunks))
+        if multiprocessing is not None:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                trees = pool.map(parser.parse_chunk, chunks,
+                                 chunksize=max(1, len(chunks) // (4 * jobs)))
+            finally:
+                pool.close()
+                pool.join()
+            tree = parser.join_chunks(galleries, trees)
+            if tree is not None:
+                return tree
+    return parser.parse_tree(code_str, parser.root)
+
+
+def graph_to_pcode_obj(graph):
+    """Convert panelcode code block to a pcode syntax tree."""
+    pcode_obj = block_pcode_obj(graph)
+    if isinstance(pcode_obj, parser.pp.ParseException):
+        raise pcode_obj
     return pcode_obj
 
 
 def parse_graph_to_html(graph, mode='replace', reveal='',
-                        consoles=True, colorize=True, global_opts=None):
+                        consoles=True, colorize=True, global_opts=None,
+                        pcode_obj=None):
     """Parse panelcode only within markdown fenced code blocks.
     Split a list of lines on fence open and close markers,
     attempt to render code block contents as panelcode or pass through,
@@ -165,33 +540,63 @@ def parse_graph_to_html(graph, mode='replace', reveal='',
 
     Results can replace the code block ('replace') or come
     before or after it ('pre' / 'post')
+
+    A pcode_obj already parsed from graph (or the ParseException it
+    raised) may be passed in to skip parsing the block again.
     """
-    result = ''
-    if colorize:
-        graph_out = unicode(highlight.style_string(graph))
-    else:
-        graph_out = '    <pre><code>' + graph + '    </code></pre>' + '\n'
-        # ... or use data_fence_list[idx-2] -- catches ~~~ etc.
-    try:
-        pcode_obj = graph_to_pcode_obj(graph)
-        html_lines = pobj_to_html5_ccs3_grid(pcode_obj, global_opts)
+    return ''.join(iter_graph_to_html(graph, mode, reveal, consoles,
+                                      colorize, global_opts, pcode_obj))
+
+
+def iter_graph_to_html(graph, mode='replace', reveal='',
+                       consoles=True, colorize=True, global_opts=None,
+                       pcode_obj=None, jobs=1):
+    """Yield the html chunks of parse_graph_to_html, one gallery line
+    at a time, as they are rendered. The code view is only rendered
+    where it is shown: for blocks that don't parse, in eager consoles
+    and after the galleries in 'post' mode. Large blocks are parsed
+    and rendered by jobs processes (see split_pcode_obj).
+    """
+    if pcode_obj is None:
+        pcode_obj = block_pcode_obj(graph, jobs=jobs)
+    if isinstance(pcode_obj, parser.pp.ParseException):
+        yield code_html(graph, colorize)
+        return
+    html_lines = iter_html5_ccs3_grid(pcode_obj, global_opts, jobs)
+    if mode == 'pre':
         console_str = ''
         if consoles or 'console' in graph:
             if 'noconsole' not in graph:
-                console_str = console_html(content=graph_out,
-                                           css_class='gallery-size',
-                                           reveal=reveal)
-        if mode == 'pre':
-            html_lines.insert(-1, console_str)
-            result += ''.join(html_lines)
-        elif mode == 'post':
-            result += '\n' + graph_out + '\n'
-            result += ''.join(html_lines)
-        elif mode == 'replace':
-            result = ''.join(html_lines)
-    except parser.pp.ParseException:
-        result = graph_out
-    return result
+                console_str = console_html(
+                    content=code_html(graph, colorize),
+                    css_class='gallery-size', reveal=reveal,
+                    lazy=consoles == 'lazy')
+        # the console goes before the closing line of the last gallery
+        last_line = None
+        for line in html_lines:
+            if last_line is not None:
+                yield last_line
+            last_line = line
+        yield console_str
+        if last_line is not None:
+            yield last_line
+    elif mode == 'post':
+        yield '\n' + code_html(graph, colorize) + '\n'
+        for line in html_lines:
+            yield line
+    elif mode == 'replace':
+        for line in html_lines:
+            yield line
+
+
+def code_html(graph, colorize=True):
+    """Code view of a panelcode block: highlighted html if colorize,
+    else a plain <pre><code> block.
+    """
+    if colorize:
+        return unicode(highlight.style_string(graph))
+    # ... or use data_fence_list[idx-2] -- catches ~~~ etc.
+    return '    <pre><code>' + graph + '    </code></pre>' + '\n'
 
 
 def decomment(string):
@@ -204,35 +609,70 @@ def decomment(string):
     The Group 1 umbrella capturing group compiles everything
     that should be preserved (if anything).
     """
-    pattern = r"//.*|/\*[\s\S]*?\*/|(\"(\\.|[^\"])*\"|'(\\.|[^\'])*')"
-    regex = re.compile(pattern)
-    return regex.sub(lambda m: m.group(1), string)
+    return COMMENTS.sub(lambda m: m.group(1), string)
 
 
-class PanelCodeRenderer(mistune.Renderer):
-    """Render full markdown document with fenced panelcode blocks"""
-    def block_code(self, code, lang=None):
-        html_str = ''
-        if lang == 'panelcode':
-            try:
-                graph = ''.join(decomment(code))
-                html_str = parse_graph_to_html(graph, mode='replace',
-                    reveal='', consoles=True, colorize=True)
-            except parser.pp.ParseException:
+# PanelCodeRenderer, see markdown_renderer_class()
+RENDERER_CLASSES = {}
+
+# shared mistune.Markdown engines, see markdown_engine()
+MARKDOWN_ENGINES = {}
+
+# output formats whose prose is rendered from markdown; 'markdown'
+# passes it through
+MARKDOWN_FORMATS = ('html', 'htmlfull')
+
+
+def markdown_renderer_class():
+    """Return the PanelCodeRenderer class, a mistune.Renderer.
+    Defined on first use, so that importing render doesn't import mistune.
+    """
+    if 'PanelCodeRenderer' in RENDERER_CLASSES:
+        return RENDERER_CLASSES['PanelCodeRenderer']
+
+    class PanelCodeRenderer(mistune.Renderer):
+        """Render full markdown document with fenced panelcode blocks"""
+        def block_code(self, code, lang=None):
+            html_str = ''
+            if lang in PANELCODE_TAGS:
+                try:
+                    graph = ''.join(decomment(code))
+                    html_str = parse_graph_to_html(graph, mode='replace',
+                        reveal='', consoles=True, colorize=True)
+                except parser.pp.ParseException:
+                    html_str = '\n<pre><code>%s</code></pre>\n' % code
+                    # mistune.escape(code)
+            else:
                 html_str = '\n<pre><code>%s</code></pre>\n' % code
-                # mistune.escape(code)
+            return html_str
+            # return sys.stdout.write(code)
+
+    RENDERER_CLASSES['PanelCodeRenderer'] = PanelCodeRenderer
+    return PanelCodeRenderer
+
+
+def markdown_engine(panelcode=False):
+    """Return the shared mistune.Markdown for prose, or for markdown with
+    panelcode blocks (see markdown_renderer_class). Built on first use
+    and reused across segments and documents: mistune resets its state
+    on each call. Not for use by several threads at once.
+    """
+    if panelcode not in MARKDOWN_ENGINES:
+        if panelcode:
+            renderer = markdown_renderer_class()()
         else:
-            html_str = '\n<pre><code>%s</code></pre>\n' % code
-        return html_str
-        # return sys.stdout.write(code)
+            renderer = mistune.Renderer()
+        MARKDOWN_ENGINES[panelcode] = mistune.Markdown(renderer=renderer)
+    return MARKDOWN_ENGINES[panelcode]
 
 
 def mdhtml_to_html(data_str):
     """Complete markdown rendering after panelcode embedded code blocks
-    are rendered."""
-    mdrenderer = mistune.Renderer()
-    markdown = mistune.Markdown(renderer=mdrenderer)
-    return markdown(data_str)
+    are rendered. Blank segments render to nothing, without markdown.
+    """
+    if not data_str.strip():
+        return ''
+    return markdown_engine()(data_str)
 
 
 def merge_dicts(*dict_args):
@@ -248,25 +688,26 @@ def merge_dicts(*dict_args):
 
 def pc_md_to_html(data_list):
     """Render markdown with embedded panelcode to html."""
-    pcrenderer = PanelCodeRenderer()
-    markdown = mistune.Markdown(renderer=pcrenderer)
+    markdown = markdown_engine(panelcode=True)
     label = '<p style="font-size:x-small"><em>panelcode: markdown processor (mistune)</em></p>\n'
     return markdown("\n".join(data_list) + label)
 
 
-def img_render(kve, lopt_str, sopt_str, gopt_str, popt_str, glopt_str, img_path):
-    """Render image preview strings based on settings."""
+def img_render(ropts, global_ropts, img_path):
+    """Render image preview strings for a layout from its resolved
+    options and the global options."""
     i_before = ''
     i_layer = ''
     i_after = ''
     i_label_str_html = ''
+    kve = ropts.kv_exprs
     if 'img' in kve:
         img_paths = [x.strip() for x in kve['img'].split(':')]
-        for opt_str in glopt_str, popt_str, gopt_str, sopt_str, lopt_str:
-            if 'autoilabel' in opt_str:
-                i_label_str = os.path.splitext(os.path.basename(img_paths[0]))[0]
-                i_label_str_html = '      <div class="label bottom">' \
-                    + i_label_str + '</div>'
+        flags = ropts.flags | global_ropts.flags
+        if 'autoilabel' in flags:
+            i_label_str = os.path.splitext(os.path.basename(img_paths[0]))[0]
+            i_label_str_html = '      <div class="label bottom">' \
+                + i_label_str + '</div>'
         if 'ilabel' in kve:
             i_label_str = kve['ilabel']
             i_label_str_html = '      <div class="label bottom">' \
@@ -274,15 +715,14 @@ def img_render(kve, lopt_str, sopt_str, gopt_str, popt_str, glopt_str, img_path)
         img_tag_str = ''
         for idx, path in enumerate(img_paths):
             img_tag_str = img_tag_str + '<img src="' + img_path + img_paths[idx] + '"/>'
-        for opt_str in [glopt_str, popt_str, gopt_str, sopt_str, lopt_str]:
-            if 'ibefore' in opt_str:
-                i_before = '    <div class="layout ' + lopt_str \
-                         + '"><div class="img">' + img_tag_str + '</div>' \
-                         + i_label_str_html + '</div>'
-            if 'iafter' in opt_str:
-                i_after = '    <div class="layout ' + lopt_str \
-                        + '"><div class="img">' + img_tag_str + '</div>' \
-                        + i_label_str_html + '</div>'
+        if 'ibefore' in flags:
+            i_before = '    <div class="layout ' + ropts.classes \
+                     + '"><div class="img">' + img_tag_str + '</div>' \
+                     + i_label_str_html + '</div>'
+        if 'iafter' in flags:
+            i_after = '    <div class="layout ' + ropts.classes \
+                    + '"><div class="img">' + img_tag_str + '</div>' \
+                    + i_label_str_html + '</div>'
         if not (i_before or i_after):
             i_layer = '    <div class="img">' + img_tag_str + '</div>'
         return i_before, i_layer, i_after
@@ -290,14 +730,14 @@ def img_render(kve, lopt_str, sopt_str, gopt_str, popt_str, glopt_str, img_path)
 
 
 def opts_load(opts):
-    """Retrieve lists of option types from an option ParseResult."""
+    """Retrieve lists of option types from an options list or tuple."""
     attr_words = []
     kv_words = []
     kv_exprs = {}
     for opt in opts:
         if isinstance(opt, basestring):  # attr_word
             attr_words.append(opt)
-        elif isinstance(opt, list):
+        elif isinstance(opt, (list, tuple)):
             if len(opt) == 1:  # attr_word
                 attr_words.append(unicode(opt[0]))
             elif len(opt) == 2 and not opt[1]:  # attr_word
@@ -329,262 +769,354 @@ def opts_render(opts, get_aw=True, get_kw=True, get_ke=False):
     return " ".join(result)
 
 
+# option words that switch rendering features on for a node and the
+# levels below it; matched within rendered class strings
+FLAG_WORDS = ('autoilabel', 'autolabel', 'iafter', 'ibefore')
+
+
+class ResolvedOpts(object):
+    """The options of one tree node, loaded and rendered once, with
+    what it inherits from the levels above: feature flags and the
+    panelgroup width. Child nodes share their parent's values.
+
+    attr_words, kv_words, kv_exprs -- as opts_load
+    classes -- as opts_render, for html class attributes
+    flags -- FLAG_WORDS set here or above
+    width -- panelgroup width wN set highest up, or 0
+    """
+    def __init__(self, opts=(), parent=None):
+        self.parent = parent
+        self.attr_words, self.kv_words, self.kv_exprs = opts_load(opts)
+        self.classes = " ".join(self.attr_words + self.kv_words)
+        flags = frozenset(word for word in FLAG_WORDS
+                          if word in self.classes)
+        width = 0
+        for word in self.attr_words:
+            if word.startswith('w') and word[1:].isdigit():
+                width = int(word[1:])
+                break
+        if parent is None:
+            self.flags = flags
+            self.width = width
+        else:
+            self.flags = parent.flags | flags if flags else parent.flags
+            self.width = parent.width or width
+
+    def child(self, opts):
+        """Resolve the options of a child node."""
+        return ResolvedOpts(opts, self)
+
+
 def pobj_counts(pcode_obj):
     """ simple statistics on a pcode object """
-    pcode = (pcode_obj.asDict())['pcode'][0]  # no multiple pcode blocks - no delimiter
+    pcode = nodes.build(pcode_obj)
     counts = {'galleries': 0, 'spreads': 0, 'layouts': 0, 'panelgroups': 0}
     # , 'panels': 0, 'skips': 0 }
-    galleries = pcode.pop('gallery', '')
-    counts['galleries'] = len(galleries)
-    for gallery in galleries:
-        spreads = gallery.pop('spread', '')
-        counts['spreads'] += len(spreads)
-        for spread in spreads:
-            layouts = spread.pop('layout', '')
-            counts['layouts'] += len(layouts)
-            for layout in layouts:
-                panelgroups = layout.pop('panelgroup', '')
-                counts['panelgroups'] += len(panelgroups)
+    counts['galleries'] = len(pcode.galleries)
+    for gallery in pcode.galleries:
+        counts['spreads'] += len(gallery.spreads)
+        for spread in gallery.spreads:
+            counts['layouts'] += len(spread.layouts)
+            for layout in spread.layouts:
+                counts['panelgroups'] += len(layout.panelgroups)
     return counts
 
 
 def pobj_globals(pcode_obj):
-    """ convert a parsed panelcode object into html for html5 + css3-grid rendering"""
-    html_str = []
-    pcode = (pcode_obj.asDict())['pcode'][0]  # no multiple pcode blocks - no delimiter
-    pcodeopts = pcode.pop('pcodeopts', [['']])  # {:::: } # pcodeopts = pcode['pcodeopts']
+    """ retrieve the pcode-level options {! } of a parsed panelcode object"""
+    return nodes.build(pcode_obj).opts
 
 
-def pobj_to_html5_ccs3_grid(pcode_obj, global_opts):
-    """ convert a parsed panelcode object into html for html5 + css3-grid rendering"""
-    html_str = []
-    pkve = opts_load(global_opts[0])[2]
-    pcode = (pcode_obj.asDict())['pcode'][0]  # no multiple pcode blocks - no delimiter
-    pcodeopts = pcode.pop('pcodeopts', [['']])  # {:::: } # pcodeopts = pcode['pcodeopts']
+def iter_html5_ccs3_grid(pcode_obj, global_opts=None, jobs=1):
+    """ yield html lines for html5 + css3-grid rendering one gallery at a
+    time, from a parsed panelcode object or a parser.GalleryStream.
+    Stream galleries are rendered as they are parsed, with the pcode
+    options {! } the stream read ahead.
+    Trees of many spreads are rendered by jobs processes, one spread at a
+    time (see iter_spreads_html).
+    """
+    if not global_opts:
+        global_opts = [[]]
+    if isinstance(pcode_obj, parser.GalleryStream):
+        galleries = pcode_obj
+        pcodeopts = pcode_obj.opts
+    else:
+        pcode = nodes.build(pcode_obj)  # a syntax tree; read, never mutated
+        galleries = pcode.galleries
+        pcodeopts = pcode.opts  # {:::: }
+    # options are resolved once per node, from the global options down
+    global_ropts = ResolvedOpts(global_opts[0])
+    pcode_ropts = ResolvedOpts(pcodeopts)
+    if jobs != 1 and not isinstance(pcode_obj, parser.GalleryStream):
+        spreads = sum(len(gallery.spreads) for gallery in galleries)
+        jobs, multiprocessing = block_jobs(jobs, spreads)
+        if multiprocessing is not None:
+            for line in iter_spreads_html(galleries, pcode_ropts,
+                                          global_ropts, jobs,
+                                          multiprocessing):
+                yield line
+            return
+    for gallery in galleries:
+        for line in gallery_to_html5_ccs3_grid(gallery, pcode_ropts,
+                                               global_ropts):
+            yield line
+
+
+def spread_html(task):
+    """Html of a (spread, gallery_ropts, global_ropts, imgpath,
+    g_layout_counter) task, as one string: the worker of
+    iter_spreads_html.
+    """
+    return ''.join(spread_to_html5_ccs3_grid(*task))
 
-    galleries = pcode.pop('gallery', '')
+
+def iter_spreads_html(galleries, pcode_ropts, global_ropts, jobs,
+                      multiprocessing):
+    """Yield the html of gallery_to_html5_ccs3_grid for each gallery,
+    with spreads rendered by a pool of jobs processes. Each spread is
+    sent with what it takes from the spreads before it: the resolved
+    options of its gallery and the layouts numbered so far, for
+    autolabels. Spreads come back in order, one string each.
+    """
+    openings = []
+    tasks = []
     for gallery in galleries:
-        galleryopts = gallery.pop('galleryopts', [['']])  # {::: }
-        gkve = opts_load(galleryopts[0])[2]  # aw, kvw, kvw =
+        gallery_ropts, imgpath = gallery_ropts_imgpath(gallery, pcode_ropts,
+                                                       global_ropts)
+        openings.append(gallery_open_html(gallery_ropts, global_ropts))
+        g_layout_counter = 0
+        for spread in gallery.spreads:
+            tasks.append((spread, gallery_ropts, global_ropts, imgpath,
+                          g_layout_counter))
+            g_layout_counter += len(spread.layouts)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        htmls = pool.imap(spread_html, tasks,
+                          chunksize=max(1, len(tasks) // (4 * jobs)))
+        for gallery, opening in zip(galleries, openings):
+            yield opening
+            for _ in gallery.spreads:
+                yield next(htmls)
+            yield '</div>' + '\n'
+    finally:
+        # all results are in unless rendering was abandoned
+        pool.terminate()
+        pool.join()
+
+
+def pobj_to_html5_ccs3_grid(pcode_obj, global_opts=None):
+    """ convert a parsed panelcode object into html for html5 + css3-grid rendering"""
+    return list(iter_html5_ccs3_grid(pcode_obj, global_opts))
+
+
+def gallery_ropts_imgpath(gallery, pcode_ropts, global_ropts):
+    """ resolve the options {::: } of a gallery node, and find the image
+    path its layouts use"""
+    gallery_ropts = pcode_ropts.child(gallery.opts)  # {::: }
+    try:
+        imgpath = gallery_ropts.kv_exprs['imgpath']
+    except KeyError:
         try:
-            imgpath = gkve['imgpath']
+            imgpath = global_ropts.kv_exprs['imgpath']
         except KeyError:
-            try:
-                imgpath = pkve['imgpath']
-            except KeyError:
-                imgpath = ''
-        html_str.append('<div class="gallery ' + opts_render(global_opts[0]) + ' ' + opts_render(galleryopts[0]) + '">' + '\n')
+            imgpath = ''
+    return gallery_ropts, imgpath
 
-        spreads = gallery.pop('spread', '')
-        g_layout_counter = 0
-        for spread in spreads:
-            spreadopts = spread.pop('spreadopts', [['']])  # {:: }
-            html_str.append('  <div class="spread ' + opts_render(spreadopts[0]) + '">' + '\n')
-
-            layouts = spread.pop('layout', '')
-            for layout in layouts:
-                g_layout_counter += 1
-                panelcounter = 0
-                panelskip = 0  # for blank x z panels
-                layoutopts = layout.pop('layoutopts', [['']])  # {: }
-                kve = opts_load(layoutopts[0])[2]  # aw, kvw, kvw =
-                i_before, i_str, i_after = img_render(
-                    kve, opts_render(layoutopts[0]),
-                    opts_render(spreadopts[0]),
-                    opts_render(galleryopts[0]),
-                    opts_render(pcodeopts[0]),
-                    opts_render(global_opts[0]),
-                    imgpath
-                    )
-                html_str.append(i_before)
-                if 'url' in kve:
-                    if 'http' not in kve['url']:
-                        html_str.append('    <a href="http://' + kve['url'] + '">' + '\n')
-                    else:
-                        html_str.append('    <a href="' + kve['url'] + '">' + '\n')
-                html_str.append('    <div class="layout ' + opts_render(layoutopts[0]) + '">' + '\n')
-                label_str_html = ''
-
-                panelgroups = layout.pop('panelgroup', '')
-                for panelgroup in panelgroups:
-                    panelgroupopts = panelgroup.pop('panelgroupopts', [['']])  # {}
-                    terms = panelgroup.pop('terms', [['']])
-                    # build row list -- grouped by commas and skipping +
-                    row_list = [[]]
-                    for term in terms[0]:
-                        # , adds row sublist
-                        if term == [',']:
-                            row_list.append([])
-                        # skip +
-                        elif term == ['+']:
-                            continue
-                        # missing counts = 1, e.g. ['']['r2'] = ['1']['r2']
-                        elif term[0] == '':
-                            term[0] = '1'
-                            row_list[-1].append(term)
-                        # 0 indicates a blank / spacer panel
-                        elif term[0] == '0':
-                            term[0] = '1'
-                            term.append('x')  # or z? based on setting?
-                            row_list[-1].append(term)
-                            # setting panels to x or z will impact panel numbering and total count
-                        # just append anything else
+
+def gallery_open_html(gallery_ropts, global_ropts):
+    """ the opening line of a gallery """
+    return '<div class="gallery ' + global_ropts.classes + ' ' + gallery_ropts.classes + '">' + '\n'
+
+
+def gallery_to_html5_ccs3_grid(gallery, pcode_ropts, global_ropts):
+    """ convert one gallery node into html lines for html5 + css3-grid
+    rendering, with its resolved pcode options {! } and global options"""
+    gallery_ropts, imgpath = gallery_ropts_imgpath(gallery, pcode_ropts,
+                                                   global_ropts)
+    html_str = [gallery_open_html(gallery_ropts, global_ropts)]
+    # layouts are numbered through the gallery, for autolabels
+    g_layout_counter = 0
+    for spread in gallery.spreads:
+        html_str.extend(spread_to_html5_ccs3_grid(
+            spread, gallery_ropts, global_ropts, imgpath, g_layout_counter))
+        g_layout_counter += len(spread.layouts)
+    html_str.append('</div>' + '\n')
+
+    return html_str
+
+
+def spread_to_html5_ccs3_grid(spread, gallery_ropts, global_ropts,
+                              imgpath='', g_layout_counter=0):
+    """ convert one spread node into html lines for html5 + css3-grid
+    rendering, with the resolved options of its gallery, the global
+    options, and the count of layouts before it in its gallery"""
+    html_str = []
+    spread_ropts = gallery_ropts.child(spread.opts)  # {:: }
+    html_str.append('  <div class="spread ' + spread_ropts.classes + '">' + '\n')
+
+    for layout in spread.layouts:
+        g_layout_counter += 1
+        panelcounter = 0
+        panelskip = 0  # for blank x z panels
+        layout_ropts = spread_ropts.child(layout.opts)  # {: }
+        kve = layout_ropts.kv_exprs
+        i_before, i_str, i_after = img_render(layout_ropts, global_ropts,
+                                              imgpath)
+        html_str.append(i_before)
+        if 'url' in kve:
+            if 'http' not in kve['url']:
+                html_str.append('    <a href="http://' + kve['url'] + '">' + '\n')
+            else:
+                html_str.append('    <a href="' + kve['url'] + '">' + '\n')
+        html_str.append('    <div class="layout ' + layout_ropts.classes + '">' + '\n')
+        label_str_html = ''
+
+        for panelgroup in layout.panelgroups:
+            panelgroupopts = panelgroup.opts  # {}
+            # rows of panels -- grouped by commas, missing counts = 1,
+            # 0 counts are blank / spacer panels (see nodes)
+            row_list = panelgroup.rows
+
+            # Find the panelgroup width. This is either:
+            # 1. Defined above, in the pcode, gallery, spread, or layout level.
+            #    For example, newspaper comics might be defined at the spread
+            #       or layout level for reflow.
+            # 2. ...or else: Defined in panelgroupopts.
+            # 3. ...or else: Calculated  from the longest row.
+            #    (i.e. discovered via comma placement)
+            #
+            # In the css3 renderer width must be specified in the panelgroup class.
+            pgroup_width = layout_ropts.child(panelgroupopts).width
+            if pgroup_width == 0:
+                # Find the length in panel spans of the longest row.
+                # e.g. c3 + 2 = 5
+                # This could be the first row, but not necessarily.
+                # Rows are *not* the same length in groups with rowspans.
+                # Rows could also be ragged. (in theory) although this
+                # isn't explicitly supported.
+                row_lengths = []
+                for row in row_list:
+                    row_len = 0
+                    for panel in row:
+                        # check for 'c2' style column span arugment
+                        # ...there should be only one c arg, but the
+                        # max is taken if there are many, 1 if no arg.
+                        c_args = [int(arg[1:]) for arg in panel.args
+                                  if arg.startswith('c')
+                                  and len(arg) > 1
+                                  and arg[1:].isdigit()]
+                        # # print(c_args)
+                        try:
+                            c_max = max(c_args)
+                        except ValueError:
+                            c_max = 1
+                        # multiply panel width by panel count
+                        panel_len = panel.count * c_max
+                        # append panel length to total row length
+                        row_len = row_len + panel_len
+                    # append row length to list
+                    row_lengths.append(row_len)
+                # set width to max
+                pgroup_width = max(row_lengths)
+            pgroup_class = ''
+            if panelgroupopts and isinstance(panelgroupopts[0], basestring):
+                pgroup_class = panelgroupopts[0]
+            html_str.append('      <div class="panelgroup ' + pgroup_class + ' w' + unicode(pgroup_width) + '">' + '\n')
+
+            for row in row_list:
+                # load panel arguments
+                for panel in row:
+                    arg_add = []
+                    for arg in panel.args:
+                        # intercept generic u for CSS styling and add count
+                        if arg.startswith('u'):
+                            if len(arg) == 1:
+                                arg_add.append('u1')
+                            elif len(arg) > 1 and arg[1:].isdigit():
+                                arg_add.append('u')
+                            # note that the edge case e.g. u.u3 is not handled
+                            # this will be fine for renderer (u_max=3, correct label)
+                            # but will become u u1 u2 in css -- works but unclear
+                    panel_arg_list = panel.args + tuple(arg_add)
+                    panel_args = ' ' + ' '.join(panel_arg_list)
+                    panel_count = panel.count
+                    # print panels, assigning counts and id labels
+                    for idx in range(0, panel_count):
+                        pas = panel_args.strip()
+                        # blank panels
+                        if 'x' in panel_args or 'z' in panel_args:
+                            panelcounter += 1
+                            panelskip += 1
+                            html_str.append(
+                                '        <div class="panel '
+                                + pas + '">*</div>' + '\n'
+                                )
+                        # unencoded (multi)panels -- mutually exclusive with blanks
+                        elif 'u' in panel_args:
+                            # ignore generic u and check for u# count
+                            u_args = [int(arg[1:]) for arg in panel_arg_list
+                                      if (arg.startswith('u')
+                                          and len(arg) > 1)
+                                      and arg[1:].isdigit()
+                                      ]
+                            # after loading u_args, add generic u in-place for CSS styling
+                            try:
+                                u_max = max(u_args)
+                            except ValueError:
+                                u_max = 1
+                            if u_max == 0:
+                                panelcounter += 1
+                                panelskip += 1
+                                html_str.append(
+                                    '        <div class="panel '
+                                    + pas + '">*</div>' + '\n'
+                                    )
+                            elif u_max == 1:
+                                panelcounter += 1
+                                label = unicode(panelcounter - panelskip)
+                                html_str.append(
+                                    '        <div class="panel '
+                                    + pas + '">' + label + '</div>' + '\n'
+                                    )
+                            else:
+                                label = unicode(panelcounter + 1 - panelskip) + '-' + unicode(panelcounter + (u_max) - panelskip)
+                                html_str.append(
+                                    '        <div class="panel '
+                                    + pas + '">' + label + '</div>' + '\n'
+                                    )
+                                panelcounter += u_max
+                        # regular panels
                         else:
-                            row_list[-1].append(term)
-
-                    # Find the panelgroup width. This is either:
-                    # 1. Defined above, in the pcode, gallery, spread, or layout level.
-                    #    For example, newspaper comics might be defined at the spread
-                    #       or layout level for reflow.
-                    # 2. ...or else: Defined in panelgroupopts.
-                    # 3. ...or else: Calculated  from the longest row.
-                    #    (i.e. discovered via comma placement)
-                    #
-                    # In the css3 renderer width must be specified in the panelgroup class.
-                    allopts = [pcodeopts[0], galleryopts[0],
-                               spreadopts[0], layoutopts[0], panelgroupopts[0]]
-                    pgroup_width = 0
-                    while allopts and pgroup_width == 0:
-                        opts = allopts.pop(0)
-                        for opt in opts:
-                            if isinstance(opt, basestring) and opt.startswith('w'):
-                                pgroup_width = int(opt[1:])
-                                break
-                    if pgroup_width == 0:
-                        # Find the length in panel spans of the longest row.
-                        # e.g. c3 + 2 = 5
-                        # This could be the first row, but not necessarily.
-                        # Rows are *not* the same length in groups with rowspans.
-                        # Rows could also be ragged. (in theory) although this
-                        # isn't explicitly supported.
-                        row_lengths = []
-                        for row in row_list:
-                            row_len = 0
-                            for panel in row:
-                                # check for 'c2' style column span arugment
-                                # ...there should be only one c arg, but the
-                                # max is taken if there are many, 1 if no arg.
-                                c_args = [int(arg[1:]) for arg in panel
-                                          if isinstance(arg, basestring)
-                                          and arg.startswith('c')
-                                          and len(arg) > 1
-                                          and arg[1:].isdigit()]
-                                # # print(c_args)
-                                try:
-                                    c_max = max(c_args)
-                                except ValueError:
-                                    c_max = 1
-                                # multiply panel width by panel count
-                                panel_len = int(panel[0]) * c_max
-                                # append panel length to total row length
-                                row_len = row_len + panel_len
-                            # append row length to list
-                            row_lengths.append(row_len)
-                        # set width to max
-                        pgroup_width = max(row_lengths)
-                    panelgroupopts[0][0] = panelgroupopts[0][0] + ' w' + unicode(pgroup_width)
-                    html_str.append('      <div class="panelgroup ' + panelgroupopts[0][0] + '">' + '\n')
-
-                    for row in row_list:
-                        # load panel arguments
-                        for panel in row:
-                            arg_add = []
-                            for idx, arg in enumerate(panel):
-                                # intercept generic u for CSS styling and add count
-                                if arg.startswith('u') and isinstance(arg, basestring):
-                                    if len(arg) == 1:
-                                        arg_add.append('u1')
-                                    elif len(arg) > 1 and arg[1:].isdigit():
-                                        arg_add.append('u')
-                                    # note that the edge case e.g. u.u3 is not handled
-                                    # this will be fine for renderer (u_max=3, correct label)
-                                    # but will become u u1 u2 in css -- works but unclear
-                            panel = panel + arg_add
-                            panel_args = ' ' + ' '.join(panel[1:])
-                            panel_count = int(panel[0])
-                            # print panels, assigning counts and id labels
-                            for idx in range(0, panel_count):
-                                pas = panel_args.strip()
-                                # blank panels
-                                if 'x' in panel_args or 'z' in panel_args:
-                                    panelcounter += 1
-                                    panelskip += 1
-                                    html_str.append(
-                                        '        <div class="panel '
-                                        + pas + '">*</div>' + '\n'
-                                        )
-                                # unencoded (multi)panels -- mutually exclusive with blanks
-                                elif 'u' in panel_args:
-                                    # ignore generic u and check for u# count
-                                    u_args = [int(arg[1:]) for arg in panel
-                                              if (arg.startswith('u')
-                                                  and len(arg) > 1)
-                                              and arg[1:].isdigit()
-                                              ]
-                                    # after loading u_args, add generic u in-place for CSS styling
-                                    try:
-                                        u_max = max(u_args)
-                                    except ValueError:
-                                        u_max = 1
-                                    if u_max == 0:
-                                        panelcounter += 1
-                                        panelskip += 1
-                                        html_str.append(
-                                            '        <div class="panel '
-                                            + pas + '">*</div>' + '\n'
-                                            )
-                                    elif u_max == 1:
-                                        panelcounter += 1
-                                        label = unicode(panelcounter - panelskip)
-                                        html_str.append(
-                                            '        <div class="panel '
-                                            + pas + '">' + label + '</div>' + '\n'
-                                            )
-                                    else:
-                                        label = unicode(panelcounter + 1 - panelskip) + '-' + unicode(panelcounter + (u_max) - panelskip)
-                                        html_str.append(
-                                            '        <div class="panel '
-                                            + pas + '">' + label + '</div>' + '\n'
-                                            )
-                                        panelcounter += u_max
-                                # regular panels
-                                else:
-                                    panelcounter += 1
-                                    label = unicode(panelcounter - panelskip)
-                                    html_str.append(
-                                        '        <div class="panel '
-                                        + pas + '">' + label + '</div>' + '\n'
-                                        )
-
-                    html_str.append('      </div>' + '\n')
-
-                html_str.append(i_str)
+                            panelcounter += 1
+                            label = unicode(panelcounter - panelskip)
+                            html_str.append(
+                                '        <div class="panel '
+                                + pas + '">' + label + '</div>' + '\n'
+                                )
+
+            html_str.append('      </div>' + '\n')
+
+        html_str.append(i_str)
+        try:
+            label_str_html = ''
+            if 'autolabel' in layout_ropts.flags:
                 try:
-                    label_str_html = ''
-                    for opt_str in [opts_render(layoutopts[0]),
-                                    opts_render(spreadopts[0]),
-                                    opts_render(galleryopts[0]),
-                                    opts_render(pcodeopts[0])
-                                    ]:
-                        if 'autolabel' in opt_str:
-                            try:
-                                label_str = os.path.splitext(os.path.basename(kve['img']))[0]
-                            except:
-                                label_str = unicode(g_layout_counter)
-                            label_str_html = '      <div class="label bottom">' \
-                                + label_str + '</div>' + '\n'
-                    if 'label' in kve:
-                        label_str = kve['label']
-                        label_str_html = '      <div class="label bottom"><div>' + label_str + '</div></div>' + '\n'
-                    if label_str_html:
-                        html_str.append('      ' + label_str_html)
-                except TypeError:
-                    pass
-                html_str.append('    </div>' + '\n')
-                if 'url' in kve:
-                    html_str.append('    </a>' + '\n')
-                html_str.append(i_after)
-            html_str.append('  </div>' + '\n')
-        html_str.append('</div>' + '\n')
+                    label_str = os.path.splitext(os.path.basename(kve['img']))[0]
+                except:
+                    label_str = unicode(g_layout_counter)
+                label_str_html = '      <div class="label bottom">' \
+                    + label_str + '</div>' + '\n'
+            if 'label' in kve:
+                label_str = kve['label']
+                label_str_html = '      <div class="label bottom"><div>' + label_str + '</div></div>' + '\n'
+            if label_str_html:
+                html_str.append('      ' + label_str_html)
+        except TypeError:
+            pass
+        html_str.append('    </div>' + '\n')
+        if 'url' in kve:
+            html_str.append('    </a>' + '\n')
+        html_str.append(i_after)
+    html_str.append('  </div>' + '\n')
 
     return html_str
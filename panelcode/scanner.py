@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Shared panelcode tokenizer.
+A single regex scan of a block into (kind, text, start, end) tokens,
+which feeds the recursive-descent parser and recognizer (see rdparser),
+and so the linter, whose error locations are token starts. Scans are
+cached by content, so a block is scanned once per render however often
+it is parsed. Code views are not highlighted from the scan but by
+highlight.FastPanelcodeLexer, whose token classes the page styles color.
+
+Kinds are ws, comment, word, num, quoted, dquoted, open, punct and
+error. The parser skips ws and accepts none of comment, dquoted and
+error, which it sees as it saw single error characters before.
+"""
+
+from __future__ import print_function
+import re
+
+import panelcode.cache as cache
+
+
+TOKENS = re.compile(r"""
+    (?P<ws>[ \t\r\n]+)
+  | (?P<word>[A-Za-z][A-Za-z0-9-]*)
+  | (?P<num>[0-9]+)
+  | (?P<quoted>'[^']*')
+  | (?P<open>\{(?:\+|\||;|@|!|:{1,4})?)
+  | (?P<punct>[_|;@+,().=}])
+  | (?P<comment>//[^\n]*|/\*[\s\S]*?\*/)
+  | (?P<dquoted>"(?:\\.|[^"])*")
+  | (?P<error>.)
+    """, re.VERBOSE | re.DOTALL)
+
+# token lists by content_key, see scan_key()
+SCAN_CACHE = cache.LRUCache(256)
+
+
+def scan_key(code_str):
+    """Cache key for scanning code. Byte strings that aren't ascii scan
+    to other positions than their text, and are keyed apart.
+    """
+    if isinstance(code_str, bytes):
+        try:
+            code_str.decode('ascii')
+        except UnicodeDecodeError:
+            return cache.content_key(code_str, 'bytes')
+    return cache.content_key(code_str)
+
+
+def scan(code_str):
+    """Split code into (kind, text, start, end) tokens, whitespace
+    included. Results are cached and shared; treat them as read-only.
+    """
+    key = scan_key(code_str)
+    tokens = SCAN_CACHE.get(key)
+    if tokens is None:
+        tokens = [(match.lastgroup, match.group(), match.start(), match.end())
+                  for match in TOKENS.finditer(code_str)]
+        SCAN_CACHE.put(key, tokens)
+    return tokens
@@ -6,17 +6,24 @@ from __future__ import print_function
 import os
 try:
     from panelcode.libs.jinja2 import Environment
+    from panelcode.libs.jinja2.bccache import FileSystemBytecodeCache
     from panelcode.libs.jinja2.loaders import FileSystemLoader
 except ImportError:
     from jinja2 import Environment
+    from jinja2.bccache import FileSystemBytecodeCache
     from jinja2.loaders import FileSystemLoader
 
 
-def load(abspath='', filename='template.html'):
-    """Load template for rendering -- with sketch defaults.
-       Jinja2 is designed to work only within a relative
-       list established by its Environment.
-    """
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Shared Jinja2 environments, one per search path list and bytecode cache
+# directory. Each environment keeps the templates it has compiled, so a
+# template is compiled once per process rather than once per load.
+ENVIRONMENTS = {}
+
+
+def search_paths(abspath=''):
+    """List template directories -- with sketch defaults."""
     pathlist = []
     if abspath:
         pathlist.append(abspath)
@@ -35,19 +42,66 @@ def load(abspath='', filename='template.html'):
     pathlist.append(os.getcwd() + '/data/')
     pathlist.append(os.getcwd())
     # Try relative to script
-    script_path = os.path.dirname(os.path.realpath(__file__))
-    pathlist.append(script_path + '/templates/')
-    pathlist.append(script_path + '/styles/')
-    pathlist.append(script_path + '/../data/templates/')
-    pathlist.append(script_path + '/../data/output/styles/')
-    pathlist.append(script_path + '/../data/')
-    pathlist.append(script_path + '/data/templates/')
-    pathlist.append(script_path + '/data/output/styles/')
-    pathlist.append(script_path + '/data/')
-    pathlist.append(script_path)
-    env = Environment(loader=FileSystemLoader(pathlist),
-        trim_blocks=True,
-        lstrip_blocks=True
-        )
+    pathlist.append(SCRIPT_PATH + '/templates/')
+    pathlist.append(SCRIPT_PATH + '/styles/')
+    pathlist.append(SCRIPT_PATH + '/../data/templates/')
+    pathlist.append(SCRIPT_PATH + '/../data/output/styles/')
+    pathlist.append(SCRIPT_PATH + '/../data/')
+    pathlist.append(SCRIPT_PATH + '/data/templates/')
+    pathlist.append(SCRIPT_PATH + '/data/output/styles/')
+    pathlist.append(SCRIPT_PATH + '/data/')
+    pathlist.append(SCRIPT_PATH)
+    return pathlist
+
+
+def environment(abspath='', bytecode_dir=''):
+    """Get the shared Jinja2 environment for a template search path.
+       Environments are created once and reused. They do not check
+       template files for changes (see load). With bytecode_dir,
+       compiled templates are also cached on disk across processes.
+    """
+    pathlist = search_paths(abspath)
+    key = (tuple(pathlist), bytecode_dir)
+    env = ENVIRONMENTS.get(key)
+    if env is None:
+        bytecode_cache = None
+        if bytecode_dir:
+            bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+        env = Environment(loader=FileSystemLoader(pathlist),
+            trim_blocks=True,
+            lstrip_blocks=True,
+            auto_reload=False,
+            bytecode_cache=bytecode_cache
+            )
+        ENVIRONMENTS[key] = env
+    return env
+
+
+def clear():
+    """Drop all shared environments and their compiled templates."""
+    ENVIRONMENTS.clear()
+
+
+def load(abspath='', filename='template.html', reload=False,
+         bytecode_dir=''):
+    """Load template for rendering -- with sketch defaults.
+       Jinja2 is designed to work only within a relative
+       list established by its Environment.
+
+       Templates are compiled once and cached in a shared environment.
+       Template file modification times are only checked on reload.
+    """
+    env = environment(abspath, bytecode_dir)
     tmpl = env.get_template(filename)
+    if reload and not tmpl.is_up_to_date:
+        env.cache.clear()
+        tmpl = env.get_template(filename)
     return tmpl
+
+
+def source(abspath='', filename='template.html', bytecode_dir=''):
+    """Source text of a template or included file, e.g. a stylesheet,
+       found on the same search path as load.
+    """
+    env = environment(abspath, bytecode_dir)
+    return env.loader.get_source(env, filename)[0]
@@ -15,12 +15,30 @@ Use `tests.run(TestFoo)` to run one specific test class.
 
 from __future__ import print_function
 import unittest
+import io
 import itertools
 import os
+import random
+import re
+import shutil
+import StringIO
+import subprocess
 import sys
+import tempfile
+import threading
 
+import panelcode.cache as cache
+import panelcode.cssprune as cssprune
+import panelcode.fences as fences
+import panelcode.highlight as highlight
+import panelcode.lint as lint
+import panelcode.nodes as nodes
 import panelcode.parser as parser
+import panelcode.rdparser as rdparser
 import panelcode.render as render
+import panelcode.scanner as scanner
+import panelcode.templates as templates
+import panelcode.treefile as treefile
 import panelcode.utils as utils
 
 
@@ -108,6 +126,1282 @@ class TestPickling(unittest.TestCase):
         self.assertFalse(os.path.exists('test.pickle'))
 
 
+class TestFencedPipeline(unittest.TestCase):
+    """Test fenced document rendering from parsed code blocks."""
+
+    def test_parse_once(self):
+        """Each fenced code block is parsed exactly once."""
+        data = ['```', '1_2 {! autolabel}', '```', 'text',
+                '```', '3;4', '```']
+        parser.clear_caches()
+        calls = []
+        parse = parser.parse_result
+
+        def counted(*args, **kwargs):
+            """Record a parse call."""
+            calls.append(args)
+            return parse(*args, **kwargs)
+        parser.parse_result = counted
+        try:
+            result = '\n'.join(render.parse_fenced_to_html(data))
+        finally:
+            parser.parse_result = parse
+        self.assertEqual(len(calls), 2)
+        # global opts from the first block reach the second block
+        self.assertEqual(result.count('class="gallery autolabel'), 2)
+
+    def test_invalid_block_passthrough(self):
+        """Non-panelcode blocks fall back to code and don't stop rendering."""
+        data = ['```', 'print("hi")', '```', '```', '1_2', '```']
+        result = '\n'.join(render.parse_fenced_to_html(data, colorize=False))
+        self.assertIn('<pre><code>print("hi")', result)
+        self.assertIn('class="panelgroup', result)
+
+
+class TestSyntaxTree(unittest.TestCase):
+    """Test building and rendering panelcode syntax trees."""
+
+    def test_build(self):
+        """Trees hold counts, rows, attr words and key value options."""
+        tree = parser.parse_tree("0+r2,2 {c2} _ 3 {: img='a.png' dark}")
+        layout = tree.galleries[0].spreads[0].layouts[0]
+        self.assertEqual(layout.opts, (('img', 'a.png'), 'dark'))
+        panelgroup = layout.panelgroups[0]
+        self.assertEqual(panelgroup.opts, ('c2',))
+        self.assertEqual(panelgroup.rows,
+                         ((nodes.Panel(1, ('x',)), nodes.Panel(1, ('r2',))),
+                          (nodes.Panel(2, ()),)))
+
+    def test_render_read_only(self):
+        """Rendering does not change a tree, so it renders the same twice."""
+        tree = parser.parse_tree('1+2,3.c2 {r2} _ 2 {: autolabel} {! w3}')
+        tree_copy = parser.parse_tree('1+2,3.c2 {r2} _ 2 {: autolabel} {! w3}')
+        html1 = render.pobj_to_html5_ccs3_grid(tree)
+        html2 = render.pobj_to_html5_ccs3_grid(tree)
+        self.assertEqual(html1, html2)
+        self.assertEqual(tree, tree_copy)
+
+
+class TestFastGrammar(unittest.TestCase):
+    """Test that the fast grammar parses like the reference grammar."""
+
+    codes = ['1+2', '(r2+1,1)_3.c2', '1.z {: img=a.png dark }',
+             '0+2_u3 {| tall} | 4 {; broad} {@ imgpath=\'img/\'}',
+             'c2+1,3 {dark} _ 2.x+1 _ u0 + u1 + 2u {! w3 ibefore}',
+             '1 {: c 2 dark 3 .b }', '1\n@\n2 ;\n3']
+
+    def tearDown(self):
+        parser.fast_mode(False)
+
+    def test_same_trees(self):
+        """Fast grammar trees equal reference grammar trees."""
+        for code in self.codes:
+            self.assertEqual(parser.parse_tree(code, fast=True),
+                             parser.parse_tree(code, fast=False))
+
+    def test_packrat(self):
+        """Bounded packrat memoization gives the same trees."""
+        parser.fast_mode(True, packrat=64)
+        for code in self.codes:
+            self.assertEqual(parser.parse_tree(code),
+                             parser.parse_tree(code, fast=False))
+        self.assertTrue(len(parser.pp.ParserElement._exprArgCache) <= 64)
+
+    def test_packrat_lookup(self):
+        """An entry found by a lookup is read even if it is cleared
+        before pyparsing reads it."""
+        packrat = parser.PackratCache(4)
+        key = ('element', 'code', 0)
+        packrat[key] = 1
+        self.assertTrue(key in packrat)
+        packrat.clear()
+        self.assertEqual(packrat[key], 1)
+        with self.assertRaises(KeyError):
+            packrat[key]
+
+    def test_packrat_threads(self):
+        """Threads parsing at once with packrat get the serial results."""
+        parser.fast_mode(True, packrat=64)
+        element = parser.grammar(True)[parser.root]
+
+        def outcome(code):
+            """tree or error location, uncached"""
+            try:
+                return nodes.build(parser.parse(code, element))
+            except parser.pp.ParseException as err:
+                return err.loc
+        codes = [random_pcode(seed, seed % 3) for seed in range(40)]
+        expected = [outcome(code) for code in codes]
+        results = {}
+
+        def run(thread):
+            """parse all codes, in a different order per thread"""
+            for idx in range(len(codes)):
+                idx = (idx * 7 + thread) % len(codes)
+                results[thread, idx] = outcome(codes[idx])
+        threads = [threading.Thread(target=run, args=(thread,))
+                   for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for (thread, idx), result in results.items():
+            self.assertEqual(result, expected[idx])
+        self.assertEqual(len(results), 4 * len(codes))
+
+    def outcome(self, code, fast=None):
+        """tree of code, or the location of its error"""
+        try:
+            return parser.parse_tree(code, fast=fast)
+        except parser.pp.ParseException as err:
+            return ('error', err.loc)
+
+    def test_fuzz(self):
+        """Random valid and mutated code gets the same trees, or fails at
+        the same place, with the fast grammar and with packrat on."""
+        codes = [random_pcode(seed, mutations) for seed in range(100)
+                 for mutations in (0, 2)]
+        expected = [self.outcome(code, fast=False) for code in codes]
+        for code, result in zip(codes, expected):
+            self.assertEqual(self.outcome(code, fast=True), result,
+                             repr(code))
+        parser.fast_mode(True, packrat=64)
+        parser.clear_caches()
+        for code, result in zip(codes, expected):
+            self.assertEqual(self.outcome(code), result, repr(code))
+
+    def test_errors(self):
+        """Fast grammar rejects the same code at the same place."""
+        for code in ['1 {: a', '1 {dark} {b}', '1..2', '1 }']:
+            locs = []
+            for fast in (True, False):
+                with self.assertRaises(parser.pp.ParseException) as context:
+                    parser.parse(code, parser.root, fast=fast)
+                locs.append(context.exception.loc)
+            self.assertEqual(locs[0], locs[1])
+
+
+def random_pcode(seed, mutations=0):
+    """Random panelcode string for differential testing. With mutations,
+    also insert, delete or replace that many random characters,
+    which usually makes the code invalid.
+    """
+    rng = random.Random(seed)
+    attrs = ['r2', 'c3', 'x', 'u1', 'dark', 'w3', 'c 2', '.b', "img='a b'",
+             'url=a-b', "label=' x'", "c='2'"]
+
+    def opts(opener):
+        """option block, often empty, sometimes missing"""
+        if rng.random() < .6:
+            return ''
+        return ' %s %s}' % (opener, ' '.join(
+            rng.choice(attrs) for _ in range(rng.randint(0, 3))))
+
+    def unit():
+        """panel count and attr words"""
+        return rng.choice(['', '1', '2', '0', '10']) + ''.join(
+            rng.choice(['.', '']) + rng.choice(attrs[:6])
+            for _ in range(rng.randint(0, 2)))
+
+    def level(sub, delims, openers):
+        """sub-levels joined by a delimiter, with options"""
+        subs = [sub() for _ in range(rng.randint(1, 3))]
+        return rng.choice(delims).join(subs) + opts(rng.choice(openers))
+
+    def panelgroup():
+        """rows of units"""
+        code = level(unit, ['+', ',', ' + ', ',\n'], ['{', '{+'])
+        return '(%s)' % code if rng.random() < .2 else code
+
+    def layout():
+        """panelgroups"""
+        return level(panelgroup, ['_', ' _ '], ['{:', '{|'])
+
+    def spread():
+        """layouts"""
+        return level(layout, ['|', ' | '], ['{;', '{::'])
+
+    def gallery():
+        """spreads"""
+        return level(spread, [';', ' ;\n'], ['{@', '{:::'])
+
+    code = level(gallery, ['@', '\n@\n'], ['{!', '{::::'])
+    for _ in range(mutations):
+        idx = rng.randint(0, len(code))
+        char = rng.choice('01a.+,_|;@{}():!=\' \t\n')
+        code = code[:idx] + rng.choice([char, '']) + code[idx + 1:]
+    return code
+
+
+class TestBackends(unittest.TestCase):
+    """Differential tests: the recursive-descent backend parses like
+    the pyparsing grammar."""
+
+    def assertSameParse(self, code):
+        """Both backends give equal trees, or fail at the same place."""
+        results = []
+        for backend in parser.BACKENDS:
+            try:
+                results.append(parser.parse_tree(code, backend=backend))
+            except parser.pp.ParseException as err:
+                results.append(('error', err.loc))
+        self.assertEqual(results[0], results[1], repr(code))
+
+    def tearDown(self):
+        parser.use_backend('pyparsing')
+
+    def test_render_cases(self):
+        """TestRenderHTML passes on the rd backend, and every code it
+        parses gets the same tree from both backends."""
+        codes = []
+        parse = parser.parse
+
+        def recorded(code_str, *args, **kwargs):
+            """recording wrapper"""
+            codes.append(code_str)
+            return parse(code_str, *args, **kwargs)
+        parser.parse = recorded
+        parser.use_backend('rd')
+        try:
+            result = unittest.TestResult()
+            unittest.TestLoader().loadTestsFromTestCase(
+                TestRenderHTML).run(result)
+        finally:
+            parser.parse = parse
+            parser.use_backend('pyparsing')
+        self.assertTrue(result.wasSuccessful(),
+                        result.failures + result.errors)
+        self.assertTrue(len(codes) > 100)
+        for code in set(codes):
+            self.assertSameParse(code)
+
+    def test_fuzz(self):
+        """Random valid and mutated code parses the same."""
+        for seed in range(150):
+            self.assertSameParse(random_pcode(seed))
+            self.assertSameParse(random_pcode(seed, mutations=2))
+
+    def test_edge_cases(self):
+        """Empty groups, unbalanced parens, option block openers and
+        quoting parse the same."""
+        for code in ['', ' ', '1_', '()', '(1,2', '1,2)', '{}', '1 {: a',
+                     '{:::::}', '{+ a}{: b}{:: c}{::: d}{:::: e}', '1..2',
+                     "1 {img='\t a b'}", "1 {c='2' x=}", '1 { +}', '1 }']:
+            self.assertSameParse(code)
+
+    def test_levels(self):
+        """Both backends parse below the root level."""
+        for level in [parser.gallery, parser.layout, parser.panelgroup]:
+            self.assertEqual(
+                parser.parse_tree('1+2,3 {r2}', level, backend='rd'),
+                parser.parse_tree('1+2,3 {r2}', level, backend='pyparsing'))
+
+
+class TestParseCache(unittest.TestCase):
+    """Test the bounded parse result caches."""
+
+    def setUp(self):
+        parser.clear_caches()
+
+    def test_lru(self):
+        """The least recently used value is evicted first."""
+        lru = cache.LRUCache(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.put('c', 3)
+        self.assertNotIn('b', lru)
+        self.assertIsNone(lru.get('b'))
+        lru.invalidate('a')
+        self.assertEqual(len(lru), 1)
+        self.assertEqual(lru.stats(), {'hits': 1, 'misses': 1,
+                                       'evictions': 1, 'size': 1,
+                                       'maxsize': 2})
+
+    def test_recurring_blocks(self):
+        """Recurring blocks are parsed once, however they are commented."""
+        tree = render.graph_to_pcode_obj('1.z {: img=a.png } // scaffold')
+        self.assertIs(render.graph_to_pcode_obj(
+            '1.z {: img=a.png } /* page 2 */'), tree)
+        self.assertEqual(parser.TREE_CACHE.hits, 1)
+        self.assertEqual(len(parser.TREE_CACHE), 1)
+        self.assertEqual(len(parser.PARSE_CACHE), 0)
+
+    def test_copies(self):
+        """Callers get their own copy of cached pyparsing results."""
+        result = parser.parse('1_2 {: dark }', parser.root)
+        result['pcode'][0]['gallery'][0].pop()
+        self.assertEqual(parser.parse_tree('1_2 {: dark }'),
+                         parser.parse_tree('1_2 {: dark }', fast=True))
+
+    def test_errors(self):
+        """Code that doesn't parse raises each time, from the cache."""
+        for _ in range(2):
+            with self.assertRaises(parser.pp.ParseException) as context:
+                parser.parse('print("hi")', parser.root)
+            self.assertEqual(context.exception.loc, 5)
+        self.assertEqual(parser.PARSE_CACHE.hits, 1)
+        for _ in range(2):
+            with self.assertRaises(parser.pp.ParseException) as context:
+                parser.parse_tree('print("hi")')
+            self.assertEqual(context.exception.loc, 5)
+        self.assertEqual(parser.TREE_CACHE.hits, 1)
+
+    def test_interned(self):
+        """Attr strings are shared across trees, in a bounded cache
+        that clear_caches empties."""
+        first = parser.parse_tree('1 {: dark }', fast=False)
+        second = parser.parse_tree('2 {: dark }', fast=True)
+        self.assertIs(first.galleries[0].spreads[0].layouts[0].opts[0],
+                      second.galleries[0].spreads[0].layouts[0].opts[0])
+        self.assertIn('dark', nodes.STRINGS)
+        parser.clear_caches()
+        self.assertEqual(len(nodes.STRINGS), 0)
+        maxsize = nodes.STRINGS.maxsize
+        try:
+            nodes.STRINGS.resize(4)
+            for idx in range(10):
+                nodes.intern_str('attr%d' % idx)
+            self.assertEqual(len(nodes.STRINGS), 4)
+        finally:
+            nodes.STRINGS.resize(maxsize)
+
+
+class TestGalleryStream(unittest.TestCase):
+    """Test parsing and rendering panelcode streams gallery by gallery."""
+
+    code = ("1_2 {@ dark} @ 3.c2 {: img='a @ b}.png' label=x} ; 4\n"
+            "@ 1 {: autolabel} {! w3 imgpath='img/'}")
+
+    def test_split(self):
+        """Code splits at top-level @, across chunks of any size."""
+        for chunk_size in [1, 2, 7, 1000]:
+            self.assertEqual(
+                list(parser.split_galleries(StringIO.StringIO(self.code),
+                                            chunk_size)),
+                ['1_2 {@ dark} ',
+                 " 3.c2 {: img='a @ b}.png' label=x} ; 4\n",
+                 " 1 {: autolabel} {! w3 imgpath='img/'}"])
+
+    def test_same_trees(self):
+        """Streamed galleries and opts are those of the whole tree."""
+        tree = parser.parse_tree(self.code)
+        stream = parser.GalleryStream(StringIO.StringIO(self.code),
+                                      chunk_size=5)
+        self.assertEqual(stream.opts, tree.opts)
+        self.assertEqual(tuple(stream), tree.galleries)
+
+    def test_uncached(self):
+        """Streamed galleries are parsed without filling the caches."""
+        parser.clear_caches()
+        code = '\n@\n'.join(['1_2 ; 3.c2 {: label=x} {@ dark}'] * 20)
+        galleries = tuple(parser.GalleryStream(StringIO.StringIO(code)))
+        self.assertEqual(len(galleries), 20)
+        self.assertEqual(len(parser.PARSE_CACHE), 0)
+        self.assertEqual(len(parser.TREE_CACHE), 0)
+
+    def test_render(self):
+        """Streams render like whole trees, with opts read ahead or not."""
+        html = render.pobj_to_html5_ccs3_grid(parser.parse_tree(self.code))
+        stream = parser.GalleryStream(StringIO.StringIO(self.code))
+        self.assertEqual(render.pobj_to_html5_ccs3_grid(stream), html)
+
+        class Pipe(object):
+            """stream that can't seek"""
+            def __init__(self, data):
+                self.read = StringIO.StringIO(data).read
+        stream = parser.GalleryStream(Pipe(self.code))
+        self.assertEqual(stream.opts, parser.parse_tree(self.code).opts)
+        self.assertEqual(render.pobj_to_html5_ccs3_grid(stream), html)
+        stream = parser.GalleryStream(Pipe(self.code.decode('ascii')),
+                                      chunk_size=4)
+        self.assertEqual(render.pobj_to_html5_ccs3_grid(stream), html)
+
+    def test_comments(self):
+        """Delimiters in comments and quoted values don't split code,
+        and comments are removed before galleries are parsed."""
+        code = u'1_2 // see @ note\n@ 3 /* ; @ */ {@ x } {! a="@" }'
+        self.assertEqual(
+            list(parser.split_galleries(StringIO.StringIO(code), 3)),
+            [u'1_2 // see @ note\n', u' 3 /* ; @ */ {@ x } {! a="@" }'])
+        tree = parser.parse_tree(''.join(render.decomment(
+            u'1_2 // see @ note\n@ 3 {@ x }')))
+        stream = parser.GalleryStream(StringIO.StringIO(
+            u'1_2 // see @ note\n@ 3 {@ x }'))
+        self.assertEqual(tuple(stream), tree.galleries)
+
+    def test_split_chunks(self):
+        """Streams split as whole code does, for chunks of any size."""
+        for seed in range(100):
+            code = random_pcode(seed).replace(
+                ' ;', " ; // c;@\n", 1).replace('@', " /* @; */ @", 1)
+            expected = [';'.join(codes)
+                        for codes in parser.split_spreads(code)]
+            for chunk_size in (1, 2, 3, 7):
+                self.assertEqual(list(parser.split_galleries(
+                    StringIO.StringIO(code), chunk_size)), expected)
+
+    def test_errors(self):
+        """Invalid code raises ParseException."""
+        with self.assertRaises(parser.pp.ParseException):
+            list(parser.GalleryStream(StringIO.StringIO('1 @ 2 } @ 3')))
+
+
+class TestLint(unittest.TestCase):
+    """Test validation without rendering."""
+
+    doc = ('# Doc\n\n```\n1_2 {: dark }\n```\n\ntext\n\n'
+           '```\n1 /* note */ _ 2 }\n```\n')
+
+    def test_recognize(self):
+        """The recognizer accepts and rejects code like the parser."""
+        for seed in range(100):
+            for code in [random_pcode(seed), random_pcode(seed, 2)]:
+                locs = []
+                for check in [rdparser.parse, rdparser.recognize]:
+                    try:
+                        check(code)
+                        locs.append(None)
+                    except parser.pp.ParseException as err:
+                        locs.append(err.loc)
+                self.assertEqual(locs[0], locs[1], repr(code))
+
+    def test_lint_text(self):
+        """Invalid blocks are located by document line and column,
+        counting any comments before the error."""
+        self.assertEqual(lint.lint_text(self.doc, 'doc.md'),
+                         [lint.Problem('doc.md', 10, 18,
+                                       'Expected end of text')])
+        self.assertEqual(lint.lint_text('1 ;\n 2 ))', markdown=False),
+                         [lint.Problem('', 2, 5, 'Expected end of text')])
+
+    def test_lint_paths(self):
+        """Directories are searched; parallel and serial runs agree."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for idx in range(4):
+                with open(os.path.join(tmpdir, '%d.md' % idx), 'w') as out:
+                    out.write(self.doc)
+            with open(os.path.join(tmpdir, 'a.panelcode'), 'w') as out:
+                out.write('1_2\n@ 3 {! x}\n')
+            problems = lint.lint_paths([tmpdir], jobs=1)
+            self.assertEqual(len(problems), 4)
+            self.assertEqual(lint.lint_paths([tmpdir], jobs=2), problems)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_lint_file(self):
+        """Files count lines at line endings only, and files that can't
+        be read or decoded are problems rather than errors."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'doc.md')
+            with io.open(path, 'w', encoding='utf-8', newline='') as out:
+                out.write(u'a\x0cb\u2028c\r\n\r```\n1 }\n```\n')
+            self.assertEqual(lint.lint_file(path),
+                             [lint.Problem(path, 4, 3,
+                                           'Expected end of text')])
+            with open(path, 'wb') as out:
+                out.write(b'```\n1_2 \xff\n```\n')
+            problems = lint.lint_file(path)
+            self.assertEqual([problem[:3] for problem in problems],
+                             [(path, 1, 1)])
+            self.assertTrue(problems[0].msg.startswith('Not utf-8'))
+            missing = os.path.join(tmpdir, 'missing.md')
+            self.assertEqual(lint.lint_paths([missing], jobs=1),
+                             [lint.Problem(missing, 1, 1,
+                                           'No such file or directory')])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestLazyImports(unittest.TestCase):
+    """Test that heavy dependencies are imported on first use."""
+
+    def test_render_import(self):
+        """Importing render or lint imports no pyparsing, pygments, jinja2
+        or mistune, and builds no grammar."""
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        loaded = subprocess.check_output(
+            [sys.executable, '-c', 'import sys\n'
+             'import panelcode.render, panelcode.lint, panelcode.parser\n'
+             'print(sorted(name for name in sys.modules if name.split(".")'
+             '[-1] in ("pyparsing", "pygments", "jinja2", "mistune")))\n'
+             'print(panelcode.parser.GRAMMARS)'], cwd=root)
+        self.assertEqual(loaded.split(), ['[]', '{}'])
+
+    def test_first_use(self):
+        """Lazy modules import on first use."""
+        self.assertEqual(render.mistune.Markdown()('*a*'),
+                         '<p><em>a</em></p>\n')
+        self.assertEqual(sorted(parser.grammar(fast=True)),
+                         sorted(parser.LEVELS))
+
+
+class TestTreeFile(unittest.TestCase):
+    """Test binary tree file round trips."""
+
+    def trees(self):
+        """Parsed trees of random valid code."""
+        trees = [parser.parse_tree(u"1.z {: img='caf\xe9.png' } {! w3}"),
+                 parser.parse_tree('')]
+        for seed in range(200):
+            try:
+                trees.append(parser.parse_tree(random_pcode(seed)))
+            except parser.pp.ParseException:
+                pass
+        return trees
+
+    def test_round_trip(self):
+        """Trees and parse results load back as equal trees."""
+        trees = self.trees()
+        self.assertEqual(list(treefile.loads(treefile.dumps(trees))), trees)
+        results = parser.parse('(r2+1,1)_3.c2 {: dark }', parser.root)
+        self.assertEqual(treefile.loads(treefile.dumps([results]))[0],
+                         nodes.build(results))
+
+    def test_load(self):
+        """Files load memory-mapped, read trees in place and render."""
+        trees = self.trees()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            utils.tree_dump(trees, 'trees.pnlc', tmpdir + '/')
+            with utils.tree_load('trees.pnlc', tmpdir + '/') as loaded:
+                self.assertEqual(len(loaded), len(trees))
+                self.assertEqual(loaded[-1], trees[-1])
+                self.assertEqual(render.pobj_to_html5_ccs3_grid(loaded[0]),
+                                 render.pobj_to_html5_ccs3_grid(trees[0]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_versions(self):
+        """Other data and newer versions are refused."""
+        data = treefile.dumps([parser.parse_tree('1_2')])
+        for bad in ['', 'PNLD' + data[4:], data[:4] + '\x02' + data[5:],
+                    data[:-30]]:
+            with self.assertRaises(treefile.TreeFileError):
+                treefile.loads(bad)
+
+    def test_load_empty(self):
+        """An empty file is refused as not a tree file."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'empty.pnlc')
+            open(path, 'wb').close()
+            for use_mmap in (True, False):
+                with self.assertRaises(treefile.TreeFileError):
+                    treefile.load(path, use_mmap)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestResolvedOpts(unittest.TestCase):
+    """Test options resolved once per node."""
+
+    def test_resolve(self):
+        """Options load and render as opts_load and opts_render."""
+        opts = ('dark', 'w3', ('img', 'a.png'))
+        ropts = render.ResolvedOpts(opts)
+        self.assertEqual((ropts.attr_words, ropts.kv_words, ropts.kv_exprs),
+                         render.opts_load(opts))
+        self.assertEqual(ropts.classes, render.opts_render(opts))
+
+    def test_inherit(self):
+        """Flags add up down the tree, the highest width wins,
+        and children share unchanged values with their parent."""
+        pcode = render.ResolvedOpts(('w4', 'autolabel'))
+        layout = pcode.child(('w2', 'ibefore')).child(('tall',))
+        self.assertEqual(layout.width, 4)
+        self.assertEqual(layout.flags, frozenset(['autolabel', 'ibefore']))
+        self.assertIs(layout.child(('w1',)).flags, layout.flags)
+        self.assertEqual(render.ResolvedOpts(()).child(('w2',)).width, 2)
+
+    def test_render(self):
+        """Inherited options render at the levels below."""
+        html = ''.join(render.pobj_to_html5_ccs3_grid(parser.parse_tree(
+            "1 {: img=a.png } ; 2_3 {: label=b } {; w6 } {! autolabel}"),
+            [[['ibefore', '']]]))
+        self.assertEqual(html.count('w6'), 3)
+        self.assertEqual(html.count('<div class="img">'), 1)
+        self.assertIn('<div class="label bottom">a</div>', html)
+        self.assertIn('<div class="label bottom"><div>b</div></div>', html)
+
+
+class TestStreaming(unittest.TestCase):
+    """Test streaming html output to file-like sinks."""
+
+    data = ['# doc', '', '```', '1_2 {! autolabel}', '```', '', 'prose',
+            '', '```', '(r2+1,1)_3.c2 ; 4', '```', '', '```', 'not {{',
+            '```']
+
+    def test_stream_fenced(self):
+        """Sinks receive the joined lines of parse_fenced_to_html."""
+        for mode in ('pre', 'post', 'replace'):
+            for fmt in ('markdown', 'html'):
+                sink = StringIO.StringIO()
+                render.stream_fenced_to_html(self.data, sink, mode=mode,
+                                             fmt=fmt, encoding=None)
+                self.assertEqual(sink.getvalue(), '\n'.join(
+                    render.parse_fenced_to_html(self.data, mode, fmt=fmt)))
+
+    def test_stream_page(self):
+        """Pages stream as html_page_wrapper renders them, with all
+        styles unless pruning is asked for."""
+        items = list(render.text_items(render.iter_fenced_to_html(
+            self.data, fmt='htmlfull', fragment=False)))
+        for prune_styles in (False, True):
+            page = '\n'.join(render.html_page_wrapper(
+                items, show_timestamp=False, prune_styles=prune_styles))
+            self.assertEqual(''.join(render.iter_page_wrapper(
+                iter(items), show_timestamp=False,
+                prune_styles=prune_styles)), page)
+            sink = StringIO.StringIO()
+            render.stream_fenced_to_html(self.data, sink, fmt='htmlfull',
+                                         show_timestamp=False,
+                                         prune_styles=prune_styles)
+            self.assertEqual(sink.getvalue().decode('utf-8'), page)
+        sink = StringIO.StringIO()
+        render.stream_fenced_to_html(self.data, sink, fmt='htmlfull',
+                                     show_timestamp=False)
+        self.assertEqual(sink.getvalue().decode('utf-8'), '\n'.join(
+            render.html_page_wrapper(items, show_timestamp=False,
+                                     prune_styles=False)))
+
+    def test_page_head_first(self):
+        """Streamed pages send their head before rendering contents."""
+        consumed = []
+
+        def contents():
+            """html items, recording when they are taken"""
+            for item in ['<p>a</p>', '<p>b</p>']:
+                consumed.append(item)
+                yield item
+        chunks = render.iter_page_wrapper(contents(), show_timestamp=False)
+        head = next(chunks)
+        self.assertIn('<head>', head)
+        self.assertEqual(consumed, [])
+        self.assertIn('<p>b</p>', ''.join(chunks))
+
+    def test_first_chunk(self):
+        """Output starts before the blocks are rendered."""
+        rendered = []
+        iter_grid = render.iter_html5_ccs3_grid
+
+        def counted(*args):
+            """record calls"""
+            rendered.append(args)
+            return iter_grid(*args)
+        chunks = render.iter_lines(render.iter_fenced_to_html(
+            self.data, fmt='markdown'))
+        render.iter_html5_ccs3_grid = counted
+        try:
+            next(chunks)
+            self.assertEqual(len(rendered), 0)
+            list(chunks)
+            self.assertEqual(len(rendered), 2)
+        finally:
+            render.iter_html5_ccs3_grid = iter_grid
+
+    def test_stream_page_file(self):
+        """Streamed page files match saved pages."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            utils.stream_page(iter([u'caf\xe9', u'\n<p>']), 'page.html',
+                              tmpdir + '/')
+            with io.open(tmpdir + '/page.html', encoding='utf-8') as infile:
+                self.assertEqual(infile.read(), u'caf\xe9\n<p>\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestCSSPrune(unittest.TestCase):
+    """Test pruning stylesheets to the classes used."""
+
+    css = """/* comment */
+@import url(base.css);
+body { margin: 0; }
+.gallery, .codex > .spread { display: block; }
+.spread:not(.vertical) > .layout[title~="a.b"] { border: 0; }
+@media print { .layout { color: #000; } .thumb { width: 1px; } }
+@media print { .thumb { width: 2px; } }
+@font-face { font-family: x; src: url(x.woff); }
+"""
+
+    def test_selector_classes(self):
+        """Negations and attribute tests need no classes."""
+        self.assertEqual(cssprune.selector_classes(
+            'div.spread:not(.vertical) > .layout[title~="a.b"]:hover'),
+            frozenset(['spread', 'layout']))
+
+    def test_prune(self):
+        """Only rules and selectors that can match are kept."""
+        pruned = cssprune.prune(self.css, ['gallery', 'spread', 'layout'])
+        self.assertEqual(pruned, """@import url(base.css);
+body {
+  margin: 0; }
+.gallery {
+  display: block; }
+.spread:not(.vertical) > .layout[title~="a.b"] {
+  border: 0; }
+@media print {
+  .layout {
+    color: #000; }
+}
+@font-face {
+  font-family: x; src: url(x.woff); }
+""")
+
+    def test_html_classes(self):
+        """Classes are collected from html, with console sizes."""
+        self.assertEqual(cssprune.html_classes(
+            ['<div class="gallery  dark">', "<p class='x'>"]),
+            set(['gallery', 'dark', 'x']))
+        self.assertIn('thumb', cssprune.html_classes(
+            '<select class="gallery-size">'))
+
+    def test_page(self):
+        """Pages inline pruned styles by default, and prune_page prunes
+        unpruned pages to the same styles."""
+        items = render.parse_fenced_to_html(['```', '1_2.c2 {w3}', '```'])
+        pruned = '\n'.join(render.html_page_wrapper(
+            items, show_timestamp=False))
+        full = '\n'.join(render.html_page_wrapper(
+            items, show_timestamp=False, prune_styles=False))
+        self.assertIn('.gallery {', pruned)
+        self.assertIn('.comicbook-us', full)
+        self.assertNotIn('.comicbook-us', pruned)
+        html, before, after = cssprune.prune_page(full)
+        self.assertLess(after * 5, before)
+        self.assertEqual(cssprune.prune_page(pruned)[2], after)
+
+
+class TestSharedStyles(unittest.TestCase):
+    """Test shared, content-hashed stylesheets for batches of pages."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp() + '/'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_publish(self):
+        """Stylesheets are written once under hashed names, and linked."""
+        urls = utils.publish_styles(self.tmpdir)
+        self.assertEqual(len(urls), len(render.PAGE_STYLESHEETS))
+        self.assertTrue(urls[0].startswith('styles/site.'))
+        with open(self.tmpdir + urls[0], 'rb') as infile:
+            self.assertEqual(infile.read().decode('utf-8'),
+                             templates.source(filename='site.css'))
+        os.utime(self.tmpdir + urls[0], (0, 0))
+        self.assertEqual(utils.publish_styles(self.tmpdir), urls)
+        self.assertEqual(os.stat(self.tmpdir + urls[0]).st_mtime, 0)
+        page = '\n'.join(render.html_page_wrapper(
+            ['<p>'], styles_inline=False, stylesheets=urls))
+        self.assertIn('<link rel="stylesheet" href="%s">' % urls[1], page)
+        self.assertNotIn('<style>', page)
+
+    def test_copy_changed(self):
+        """Style copies are only made for new or changed files."""
+        src = self.tmpdir + 'src'
+        dest = self.tmpdir + 'dest'
+        os.makedirs(src + '/sub')
+        for name in ('a.css', 'sub/b.css'):
+            with open(src + '/' + name, 'w') as outfile:
+                outfile.write(name)
+        utils.copy_styles(src, dest)
+        os.utime(dest + '/a.css', (0, 0))
+        with open(src + '/sub/b.css', 'w') as outfile:
+            outfile.write('changed')
+        utils.copy_styles(src, dest)
+        self.assertEqual(os.stat(dest + '/a.css').st_mtime, 0)
+        with open(dest + '/sub/b.css') as infile:
+            self.assertEqual(infile.read(), 'changed')
+
+
+class TestCustomCSS(unittest.TestCase):
+    """Test linking custom css by content fingerprint."""
+
+    data = ['# doc', '```', '1_2', '```']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.custom_css = os.path.join(self.tmpdir, 'custom.css')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_css(self, css):
+        """Write the custom css file."""
+        with open(self.custom_css, 'w') as outfile:
+            outfile.write(css)
+
+    def test_missing(self):
+        """Without custom css nothing is linked."""
+        self.assertIsNone(render.custom_css_href(self.custom_css))
+        result = '\n'.join(render.parse_fenced_to_html(
+            self.data, fmt='htmlfull', custom_css=self.custom_css))
+        self.assertNotIn('custom.css', result)
+        self.assertNotIn("$('head')", result)
+
+    def test_fingerprint(self):
+        """Links change when, and only when, the content does."""
+        self.write_css('.panel { color: red; }')
+        href = render.custom_css_href(self.custom_css)
+        self.assertRegexpMatches(href, r'^custom\.css\?v=[0-9a-f]{12}$')
+        self.assertEqual(render.custom_css_href(self.custom_css), href)
+        result = render.parse_fenced_to_html(self.data,
+                                             custom_css=self.custom_css)
+        self.assertIn(render.CUSTOM_CSS_LINK.format(href), result)
+        self.write_css('.panel { color: blue; }')
+        self.assertNotEqual(render.custom_css_href(self.custom_css), href)
+
+    def test_page_head(self):
+        """Full pages link custom css once, in the head."""
+        self.write_css('.panel { color: red; }')
+        result = '\n'.join(render.parse_fenced_to_html(
+            self.data, fmt='htmlfull', custom_css=self.custom_css))
+        self.assertEqual(result.count('custom.css?v='), 1)
+        self.assertLess(result.index('custom.css?v='),
+                        result.index('</head>'))
+
+    def test_out_dir(self):
+        """custom.css is looked up beside the output, not in the
+        current directory."""
+        self.write_css('.panel { color: red; }')
+        href = render.custom_css_href(self.custom_css)
+        cwd = os.getcwd()
+        elsewhere = tempfile.mkdtemp()
+        try:
+            os.chdir(elsewhere)
+            self.assertIsNone(render.custom_css_href())
+            self.assertEqual(render.custom_css_href(out_dir=self.tmpdir),
+                             href)
+            result = '\n'.join(render.parse_fenced_to_html(
+                self.data, fmt='htmlfull', out_dir=self.tmpdir))
+            self.assertEqual(result.count('custom.css?v='), 1)
+            page = os.path.join(self.tmpdir, 'page.html')
+            for fmt in ('htmlfull', 'html'):
+                with open(page, 'w') as sink:
+                    render.stream_fenced_to_html(self.data, sink, fmt=fmt)
+                with open(page) as saved:
+                    self.assertIn(render.CUSTOM_CSS_LINK.format(href),
+                                  saved.read())
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(elsewhere)
+
+
+class TestConsoleScript(unittest.TestCase):
+    """Test the console size switcher script."""
+
+    data = ['```', '1_2', '```', '', '```', '3', '```']
+
+    def test_once(self):
+        """Pages hold the script once, deferred and without jQuery,
+        however they are made; fragments leave it to their page."""
+        fragment = render.parse_fenced_to_html(self.data)
+        self.assertNotIn('<script', '\n'.join(fragment))
+        for page in ('\n'.join(render.parse_fenced_to_html(
+                self.data, fmt='htmlfull')),
+                     '\n'.join(render.html_page_wrapper(fragment))):
+            self.assertEqual(page.count('<script'), 1)
+            self.assertEqual(page.count(render.CONSOLE_SCRIPT), 1)
+            self.assertNotIn('jquery', page.lower())
+            self.assertLess(page.index(render.CONSOLE_SCRIPT),
+                            page.index('</head>'))
+        self.assertTrue(render.CONSOLE_SCRIPT.startswith(
+            '<script type="module">'))
+
+    def test_sizes(self):
+        """Console options are sizes the script switches between."""
+        for size in re.findall(r'<option value="(\w+)"',
+                               render.console_html()):
+            self.assertIn(size, render.CONSOLE_SIZES)
+
+
+class TestLazyConsoles(unittest.TestCase):
+    """Test consoles that insert their code when opened."""
+
+    data = ['```', "1_2 {: img='a<b>.png' }", '```']
+
+    def test_lazy(self):
+        """Lazy consoles hold the code view of eager ones, highlighted
+        on the server, in an inert template."""
+        eager = '\n'.join(render.parse_fenced_to_html(self.data, mode='pre'))
+        lazy = '\n'.join(render.parse_fenced_to_html(self.data, mode='pre',
+                                                     consoles='lazy'))
+        view = render.code_html(self.data[1] + '\n')
+        self.assertIn('<span class="na">', view)
+        self.assertIn(view, eager)
+        self.assertEqual(lazy.count(view), 1)
+        self.assertLess(lazy.index('<template class="console-code">'),
+                        lazy.index('<select class="gallery-size">'))
+        self.assertLess(lazy.index(view), lazy.index('</template>'))
+        self.assertEqual(lazy.replace('<template class="console-code">', '')
+                         .replace('</template>', '').split(),
+                         eager.split())
+        plain = '\n'.join(render.parse_fenced_to_html(
+            self.data, mode='pre', consoles='lazy', colorize=False))
+        self.assertIn('<template class="console-code">', plain)
+        self.assertIn('<pre><code>', plain)
+
+    def test_pruned_styles(self):
+        """Pages with lazy consoles keep the highlighting styles."""
+        items = render.parse_fenced_to_html(self.data, mode='pre',
+                                            consoles='lazy')
+        self.assertIn('.highlight .na', render.page_styles(items))
+
+
+class TestHighlightCache(unittest.TestCase):
+    """Test the cached code views of blocks."""
+
+    data = ['```', '1_2 {: dark }', '```', '```', 'print("hi")', '```']
+
+    def setUp(self):
+        highlight.HIGHLIGHT_CACHE.clear()
+
+    def test_cache(self):
+        """Recurring code is highlighted once per style."""
+        html = highlight.style_string('1_2 {: dark }')
+        self.assertIs(highlight.style_string('1_2 {: dark }'), html)
+        self.assertIs(highlight.html_formatter(),
+                      highlight.html_formatter())
+        highlight.style_string('1_2 {: dark }', style='default')
+        self.assertEqual(highlight.HIGHLIGHT_CACHE.stats()['size'], 2)
+        self.assertEqual(html, highlight.style_string(
+            '1_2 {: dark }', lexer=highlight.PanelcodeLexer()))
+
+    def test_shown_only(self):
+        """Code is highlighted only where a mode shows it."""
+        render.parse_fenced_to_html(self.data, mode='replace')
+        self.assertEqual(highlight.HIGHLIGHT_CACHE.misses, 1)
+        render.parse_fenced_to_html(self.data, mode='pre', consoles='lazy')
+        self.assertEqual(highlight.HIGHLIGHT_CACHE.misses, 2)
+        render.parse_fenced_to_html(self.data, mode='post')
+        self.assertEqual(highlight.HIGHLIGHT_CACHE.misses, 2)
+
+
+class TestFastLexer(unittest.TestCase):
+    """Differential tests: the combined-regex lexer emits the tokens of
+    the Pygments rule-by-rule lexer."""
+
+    def assertSameTokens(self, code):
+        """Both lexers give equal token streams."""
+        self.assertEqual(
+            list(highlight.FastPanelcodeLexer().get_tokens(code)),
+            list(highlight.PanelcodeLexer().get_tokens(code)), repr(code))
+
+    def test_fuzz(self):
+        """Random valid and mutated code lexes the same."""
+        for seed in range(150):
+            self.assertSameTokens(random_pcode(seed))
+            self.assertSameTokens(random_pcode(seed, mutations=4))
+
+    def test_edge_cases(self):
+        """Comments, errors, states left open at line ends, and quoting
+        lex the same."""
+        for code in ['', '1 // c\n2 # c', '1.c2.r3 {: a=\'x\' b="y" c:3}',
+                     '{: a=\n2', '2.x\n+ 1.b-a', '1.c-2_ 2.a9 ~ \xe9 {+',
+                     "{ a='' }}", '\t1.\t2', '1 {:::: x } $']:
+            self.assertSameTokens(code)
+
+    def test_classes(self):
+        """Code views, eager or lazy, have the token classes of the
+        lexer, which the page styles color."""
+        html = highlight.style_string("1.c2 {: a='b' n=3 } // c\n"
+                                      "@ 2_x9 # d")
+        self.assertEqual(
+            re.findall(r'<span class="(\w+)">([^<]*)</span>', html),
+            [('mi', '1'), ('p', '.'), ('na', 'c'), ('l', '2'),
+             ('p', '{:'), ('na', 'a'), ('p', '=&#39;'), ('s1', 'b'),
+             ('p', '&#39;'), ('na', 'n'), ('p', '='), ('mi', '3'),
+             ('p', '}'), ('c', '// c'), ('o', '@'), ('mi', '2'),
+             ('o', '_'), ('na', 'x'), ('l', '9'), ('c', '# d')])
+        self.assertEqual(html, highlight.style_string(
+            "1.c2 {: a='b' n=3 } // c\n@ 2_x9 # d",
+            lexer=highlight.PanelcodeLexer()))
+
+
+class TestScanner(unittest.TestCase):
+    """Test the tokenizer shared by the parser and the linter."""
+
+    def setUp(self):
+        parser.clear_caches()
+        highlight.HIGHLIGHT_CACHE.clear()
+
+    def tearDown(self):
+        parser.use_backend('pyparsing')
+
+    def test_scanned_once(self):
+        """Blocks are scanned once per render, by the parser only: code
+        views are lexed for highlighting (see highlight)."""
+        parser.use_backend('rd')
+        data = ['```', '1_2 {: dark }', '```', '```', '1 // one', '```']
+        render.parse_fenced_to_html(data, mode='post')
+        self.assertEqual(scanner.SCAN_CACHE.misses, 2)
+        self.assertEqual(highlight.HIGHLIGHT_CACHE.misses, 2)
+
+    def test_keys(self):
+        """Byte strings scan apart from their text unless ascii."""
+        self.assertEqual(scanner.scan_key('1_2'), scanner.scan_key(u'1_2'))
+        self.assertNotEqual(scanner.scan_key(u'\xe9'.encode('utf-8')),
+                            scanner.scan_key(u'\xe9'))
+
+
+class TestMarkdown(unittest.TestCase):
+    """Test rendering the prose between fences."""
+
+    data = ['# doc', '', '```', '1_2', '```', '', 'some *prose*']
+
+    def test_formats(self):
+        """Prose is rendered from markdown for html formats only."""
+        html = '\n'.join(render.parse_fenced_to_html(self.data, fmt='html'))
+        self.assertIn('<h1>doc</h1>', html)
+        self.assertIn('<em>prose</em>', html)
+        markdown = '\n'.join(render.parse_fenced_to_html(self.data))
+        self.assertIn('# doc', markdown)
+        self.assertIn('some *prose*', markdown)
+
+    def test_engine(self):
+        """One markdown engine serves all segments and documents."""
+        engine = render.markdown_engine()
+        render.parse_fenced_to_html(self.data, fmt='html')
+        self.assertIs(render.markdown_engine(), engine)
+        self.assertEqual(render.mdhtml_to_html('[a]: http://a.b\n\n[a]'),
+                         '<p><a href="http://a.b">a</a></p>\n')
+        self.assertEqual(render.mdhtml_to_html('[a]'), '<p>[a]</p>\n')
+
+
+def random_document(seed):
+    """Random well-formed markdown document as a list of lines, with
+    prose, blank lines and fenced code blocks of different fences, info
+    strings and indentation, for differential testing.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(rng.randint(0, 5)):
+        for _ in range(rng.randint(0, 3)):
+            lines.append(rng.choice(['', 'prose *x*', '  ', '# head',
+                                     'a ` b', '~~ c']))
+        fence = rng.choice(['```', '~~~', '````', '~~~~~'])
+        other = '~~~' if fence[0] == '`' else '```'
+        lines.append(rng.choice(['', ' ', '   ']) + fence +
+                     rng.choice(['', 'panelcode', ' pc ', ' x']))
+        lines.extend(rng.choice(['1_2', '  c2 {dark}', '', other,
+                                 other + 'x'])
+                     for _ in range(rng.randint(1, 3)))
+        if rng.random() < .5:
+            lines.append(random_pcode(seed))
+        lines.append(rng.choice(['', '  ']) + fence +
+                     rng.choice(['', '  ']))
+        lines.extend([''] * rng.randint(0, 2))
+    lines.append(rng.choice(['', 'tail']))
+    return lines
+
+
+class TestFences(unittest.TestCase):
+    """Differential tests: the line scanner splits documents like
+    the FENCES regex."""
+
+    def test_fuzz(self):
+        """Random well-formed documents split the same."""
+        for seed in range(300):
+            lines = random_document(seed)
+            self.assertEqual(fences.split_fences(lines),
+                             render.FENCES.split('\n'.join(lines)),
+                             repr(lines))
+
+    def test_lines(self):
+        """Documents may come as an iterator of lines, or of several."""
+        lines = random_document(7)
+        self.assertEqual(fences.split_fences(iter(lines)),
+                         fences.split_fences(['\n'.join(lines)]))
+
+    def test_malformed(self):
+        """Unterminated fences are prose, blocks after them are found,
+        and an empty block is a block."""
+        self.assertEqual(fences.split_fences(
+            ['a', '```', '1', '~~~', '2', '```x']),
+                         ['a\n```\n1\n~~~\n2\n```x'])
+        lines = ['~~~', 'x', '```', '1_2', '```', '````', 'y']
+        self.assertEqual(fences.split_fences(lines),
+                         render.FENCES.split('\n'.join(lines)))
+        self.assertEqual(fences.split_fences(lines),
+                         ['~~~\nx\n', '```', None, '1_2\n', '```',
+                          '````\ny'])
+        self.assertEqual(fences.split_fences(['```', '```']),
+                         ['', '```', None, '', '```', ''])
+
+
+class TestBlockRouting(unittest.TestCase):
+    """Test routing fenced blocks by info string and prefilter."""
+
+    data = ['```python', 'x', '```', '```', 'print("hi")', '```',
+            '```pcode', '1_2', '```', '``` PanelCode', '3', '```']
+
+    def test_routes(self):
+        """Blocks tagged as another language are not parsed, untagged
+        blocks only if they pass the prefilter."""
+        parser.clear_caches()
+        html = '\n'.join(render.parse_fenced_to_html(self.data))
+        self.assertEqual(parser.TREE_CACHE.misses, 2)
+        self.assertEqual(html.count('class="layout'), 2)
+        self.assertIn('<span class="na">x</span>', html)
+        self.assertEqual(lint.lint_text('\n'.join(self.data)),
+                         [lint.Problem('', 5, 6, 'Expected end of text')])
+
+    def test_prefilter(self):
+        """The prefilter only rejects code that does not parse."""
+        self.assertEqual(render.non_panelcode_loc("1 {: a='#' } [2]"), 13)
+        for seed in range(300):
+            self.assertIsNone(render.non_panelcode_loc(random_pcode(seed)))
+            code = random_pcode(seed, mutations=2)
+            if render.non_panelcode_loc(code) is not None:
+                with self.assertRaises(parser.pp.ParseException):
+                    parser.parse_tree(code, backend='rd')
+
+
+class TestParallelBlocks(unittest.TestCase):
+    """Test parsing code blocks with a process pool."""
+
+    def document(self, blocks):
+        """a document with global options and a block that fails"""
+        data = ['# blocks', '```', '1_2 {! w4 autolabel}', '```']
+        for idx in range(blocks):
+            data.extend(['text %d' % idx, '```',
+                         random_pcode(idx) if idx % 9 else '1_2 }', '```'])
+        return data
+
+    def test_same_output(self):
+        """Parallel pages are serial pages, blocks in order."""
+        data = self.document(render.PARALLEL_MIN_BLOCKS)
+        for consoles in (True, 'lazy'):
+            serial = render.parse_fenced_to_html(data, mode='pre',
+                                                 consoles=consoles)
+            self.assertEqual(render.parse_fenced_to_html(
+                data, mode='pre', consoles=consoles, jobs=2), serial)
+        out = StringIO.StringIO()
+        render.stream_fenced_to_html(data, out, fmt='html', jobs=2)
+        self.assertEqual(out.getvalue(), '\n'.join(
+            render.parse_fenced_to_html(data, fmt='html')))
+
+    def test_serial_fallback(self):
+        """Small documents and single jobs are rendered serially."""
+        self.assertEqual(render.block_jobs(4, 3), (1, None))
+        self.assertEqual(render.block_jobs(1, 1000), (1, None))
+        self.assertEqual(render.block_jobs(
+            2, render.PARALLEL_MIN_BLOCKS)[0], 2)
+        pcode_objs = render.parse_fenced_blocks(
+            fences.split_fences(self.document(3)), jobs=4)
+        self.assertErrorsEqual(pcode_objs[8],
+                               render.block_pcode_obj('1_2 }\n'))
+
+    def assertErrorsEqual(self, first, second):
+        """same ParseException: code, location and message"""
+        self.assertIsInstance(first, parser.pp.ParseException)
+        self.assertIsInstance(second, parser.pp.ParseException)
+        self.assertEqual((first.pstr, first.loc, first.msg),
+                         (second.pstr, second.loc, second.msg))
+
+    def test_same_errors(self):
+        """Blocks that fail in a pool fail as they do serially."""
+        data = self.document(render.PARALLEL_MIN_BLOCKS)
+        data.extend(['```python', 'x = 1', '```',
+                     '```', '1_2 <b>', '```', '```', '1 {: a', '```'])
+        data_fence_list = fences.split_fences(data)
+        serial = render.parse_fenced_blocks(data_fence_list)
+        parallel = render.parse_fenced_blocks(data_fence_list, jobs=2)
+        self.assertEqual(sorted(parallel), sorted(serial))
+        errors = 0
+        for idx in serial:
+            if isinstance(serial[idx], parser.pp.ParseException):
+                self.assertErrorsEqual(parallel[idx], serial[idx])
+                errors += 1
+            else:
+                self.assertEqual(parallel[idx], serial[idx])
+        self.assertGreater(errors, 3)
+
+
+class TestSplitParse(unittest.TestCase):
+    """Test parsing and rendering a large block in chunks."""
+
+    def book(self, spreads):
+        """one block of spreads of image layouts, in a few galleries"""
+        codes = []
+        for idx in range(spreads):
+            codes.append('1.z {: img=p%d.png } | 2_1' % idx)
+            if idx % 5 == 0:
+                codes[-1] += " | 3 {: label='a;b@c' }"
+            if idx % 25 == 24:
+                codes[-1] += ' {@ autolabel } @'
+            elif idx < spreads - 1:
+                codes[-1] += ' ; // next; spread @'
+        return '\n'.join(codes) + ' {! w4 autoilabel }'
+
+    def assertJoins(self, code, valid):
+        """chunks of code stitch into its tree, or None if invalid"""
+        galleries = parser.split_spreads(code.expandtabs())
+        joined = parser.join_chunks(galleries, [
+            parser.parse_chunk(chunk)
+            for chunk in parser.chunk_levels(galleries)])
+        try:
+            tree = parser.parse_tree(code)
+        except parser.pp.ParseException:
+            self.assertIsNone(joined)
+            return
+        if valid or joined is not None:
+            self.assertEqual(joined, tree)
+
+    def test_split_spreads(self):
+        """Only top-level delimiters split code."""
+        self.assertEqual(parser.split_spreads(
+            "1 {: a='x;y' } ; 2 // @;\n @ 3 /* ; */ {@ b }"),
+            [['1 {: a=\'x;y\' } ', ' 2 // @;\n '], [" 3 /* ; */ {@ b }"]])
+
+    def test_join_chunks(self):
+        """Chunks stitch into the tree of the whole code, or None where
+        the whole code doesn't parse."""
+        parser.use_backend('rd')
+        try:
+            for seed in range(300):
+                for mutations in (0, 2):
+                    self.assertJoins(random_pcode(seed, mutations),
+                                     mutations == 0)
+        finally:
+            parser.use_backend('pyparsing')
+        for seed in range(20):
+            self.assertJoins(random_pcode(seed), True)
+
+    def test_parallel_block(self):
+        """A large block renders as it does serially, layouts numbered
+        through each gallery."""
+        code = self.book(render.PARALLEL_MIN_BLOCKS + 1)
+        clean = ''.join(render.decomment(code))
+        self.assertEqual(render.split_pcode_obj(clean, jobs=2),
+                         parser.parse_tree(clean))
+        data = ['```', code, '```']
+        html = render.parse_fenced_to_html(data, mode='pre', jobs=2)
+        self.assertEqual(html, render.parse_fenced_to_html(data, mode='pre'))
+        self.assertIn('<div class="label bottom">55</div>', '\n'.join(html))
+        with self.assertRaises(parser.pp.ParseException):
+            render.split_pcode_obj(clean.replace(' {@ autolabel } @',
+                                                 ' {@ autolabel } ;', 1),
+                                   jobs=2)
+
+
+class TestTemplates(unittest.TestCase):
+    """Test the shared compiled template registry."""
+
+    def test_compiled_once(self):
+        """Repeated loads reuse one environment and compiled template."""
+        templates.clear()
+        tmpl = templates.load(filename='console.html')
+        self.assertIs(templates.load(filename='console.html'), tmpl)
+        self.assertIs(templates.load(filename='console.html', reload=True),
+                      tmpl)
+        self.assertEqual(len(templates.ENVIRONMENTS), 1)
+
+
 class TestRenderHTML(unittest.TestCase):
     """Test that renders are panelcode-correct and html-valid."""
 
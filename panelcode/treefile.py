@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Binary files of panelcode syntax trees.
+A compact, versioned format for persisting parsed panelcode (see nodes),
+so that corpora can be parsed once, then re-rendered or analyzed
+without re-parsing. Unlike pickles, files don't depend on pyparsing and
+loading them runs no code.
+
+    treefile.dump([parser.parse_tree(code) for code in codes], path)
+    with treefile.load(path) as trees:
+        html = render.pobj_to_html5_ccs3_grid(trees[0])
+
+Format, all integers little-endian int32 unless noted:
+
+    header       magic 'PNLC', version (uint16), flags (uint16), then
+                 the row counts of the tables below, in order (uint32)
+    pcodes       rows of (first gallery, galleries, first opt, opts)
+    galleries    rows of (first spread, spreads, first opt, opts)
+    spreads      rows of (first layout, layouts, first opt, opts)
+    layouts      rows of (first panelgroup, panelgroups, first opt, opts)
+    panelgroups  rows of (first row, rows, first opt, opts)
+    rows         rows of (first panel, panels)
+    panels       rows of (count, first arg, args)
+    args         rows of (string)
+    opts         rows of (key string, value string or -1 for attr words)
+    strings      rows of (end offset in the string data)
+    string data  utf-8, the rest of the file
+
+The children of a node are consecutive rows of the next table. A file
+holds any number of pcode trees. Files are memory-mapped where possible
+and read in place: a tree is only decoded when it is accessed.
+"""
+
+from __future__ import print_function
+import array
+import os
+import struct
+import sys
+try:
+    import mmap
+except ImportError:  # e.g. Jython
+    mmap = None
+
+import panelcode.nodes as nodes
+
+
+MAGIC = b'PNLC'
+VERSION = 1
+
+# tables in file order, with their int32 fields per row
+TABLES = (('pcodes', 4), ('galleries', 4), ('spreads', 4), ('layouts', 4),
+          ('panelgroups', 4), ('rows', 2), ('panels', 3), ('args', 1),
+          ('opts', 2), ('strings', 1))
+FIELDS = dict(TABLES)
+
+HEADER = struct.Struct('<4sHH' + 'I' * len(TABLES))
+
+# level tables and their children, which are rows of the table of the
+# same name
+LEVEL_TABLES = (('pcodes', 'galleries'), ('galleries', 'spreads'),
+                ('spreads', 'layouts'), ('layouts', 'panelgroups'),
+                ('panelgroups', 'rows'))
+
+NODE_TYPES = {'pcodes': nodes.Pcode, 'galleries': nodes.Gallery,
+              'spreads': nodes.Spread, 'layouts': nodes.Layout,
+              'panelgroups': nodes.Panelgroup}
+
+
+class TreeFileError(ValueError):
+    """Data is not a panelcode tree file this version can read."""
+
+
+class Writer(object):
+    """Flattens syntax trees into tables."""
+
+    def __init__(self):
+        self.tables = dict((name, array.array('i')) for name, _ in TABLES)
+        self.string_ids = {}
+        self.string_data = []
+        self.string_size = 0
+
+    def rows(self, name):
+        """Number of rows in a table."""
+        return len(self.tables[name]) // FIELDS[name]
+
+    def string(self, string):
+        """Id of a string in the string table, adding it if new."""
+        if string not in self.string_ids:
+            data = string.encode('utf-8')
+            self.string_size += len(data)
+            self.string_data.append(data)
+            self.tables['strings'].append(self.string_size)
+            self.string_ids[string] = len(self.string_ids)
+        return self.string_ids[string]
+
+    def opts(self, opts):
+        """Add options, return (first opt, opts)."""
+        first = self.rows('opts')
+        table = self.tables['opts']
+        for opt in opts:
+            if isinstance(opt, tuple):
+                table.extend((self.string(opt[0]), self.string(opt[1])))
+            else:
+                table.extend((self.string(opt), -1))
+        return first, len(opts)
+
+    def add(self, tree):
+        """Add a pcode tree, one level at a time."""
+        level = [nodes.build(tree)]
+        for name, children in LEVEL_TABLES:
+            table = self.tables[name]
+            first = self.rows(children)
+            next_level = []
+            for node in level:
+                kids = getattr(node, children)
+                table.extend((first, len(kids)) + self.opts(node.opts))
+                first += len(kids)
+                next_level.extend(kids)
+            level = next_level
+        for row in level:
+            self.tables['rows'].extend((self.rows('panels'), len(row)))
+            for panel in row:
+                self.tables['panels'].extend(
+                    (panel.count, self.rows('args'), len(panel.args)))
+                self.tables['args'].extend(self.string(arg)
+                                           for arg in panel.args)
+
+    def data(self):
+        """The file contents."""
+        parts = [HEADER.pack(MAGIC, VERSION, 0,
+                             *[self.rows(name) for name, _ in TABLES])]
+        for name, _ in TABLES:
+            table = self.tables[name]
+            if sys.byteorder == 'big':
+                table = array.array('i', table)
+                table.byteswap()
+            parts.append(table.tostring())
+        parts.extend(self.string_data)
+        return b''.join(parts)
+
+
+def dumps(trees):
+    """Serialize syntax trees (or parse results) to bytes."""
+    writer = Writer()
+    for tree in trees:
+        writer.add(tree)
+    return writer.data()
+
+
+def dump(trees, path):
+    """Save syntax trees (or parse results) to a tree file."""
+    data = dumps(trees)
+    with open(path, 'wb') as handle:
+        handle.write(data)
+
+
+class TreeFile(object):
+    """Syntax trees read in place from tree file data.
+    A sequence of pcode trees: trees[i] decodes tree i into nodes.
+    Use as a context manager, or close() when done with a loaded file.
+    """
+    def __init__(self, data, handle=None):
+        if len(data) < HEADER.size:
+            raise TreeFileError('not a panelcode tree file')
+        header = HEADER.unpack_from(data, 0)
+        if header[0] != MAGIC:
+            raise TreeFileError('not a panelcode tree file')
+        if header[1] > VERSION:
+            raise TreeFileError('panelcode tree file version %d is newer '
+                                'than %d' % (header[1], VERSION))
+        self.data = data
+        self.handle = handle
+        self.version = header[1]
+        self.counts = dict(zip([name for name, _ in TABLES], header[3:]))
+        self.offsets = {}
+        offset = HEADER.size
+        for name, fields in TABLES:
+            self.offsets[name] = offset
+            offset += 4 * fields * self.counts[name]
+        self.string_offset = offset
+        if len(data) < offset:
+            raise TreeFileError('truncated panelcode tree file')
+        self.strings = {}
+        self.row_structs = dict(
+            (fields, struct.Struct('<' + 'i' * fields))
+            for _, fields in TABLES)
+
+    def __len__(self):
+        return self.counts['pcodes']
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('tree index out of range')
+        return self.node('pcodes', idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.node('pcodes', idx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release a loaded file."""
+        if self.handle is not None:
+            if mmap is not None and isinstance(self.data, mmap.mmap):
+                self.data.close()
+            self.handle.close()
+            self.handle = None
+
+    def row(self, name, idx):
+        """Fields of row idx of a table, read in place."""
+        fields = FIELDS[name]
+        return self.row_structs[fields].unpack_from(
+            self.data, self.offsets[name] + 4 * fields * idx)
+
+    def string(self, idx):
+        """String idx of the string table, decoded once."""
+        try:
+            return self.strings[idx]
+        except KeyError:
+            start = self.row('strings', idx - 1)[0] if idx else 0
+            end = self.row('strings', idx)[0]
+            data = self.data[self.string_offset + start:
+                             self.string_offset + end]
+            string = nodes.intern_str(data.decode('utf-8'))
+            self.strings[idx] = string
+            return string
+
+    def opts(self, first, count):
+        """Options tuple of opts rows first to first + count."""
+        opts = []
+        for idx in range(first, first + count):
+            key, value = self.row('opts', idx)
+            if value < 0:
+                opts.append(self.string(key))
+            else:
+                opts.append((self.string(key), self.string(value)))
+        return tuple(opts)
+
+    def panel(self, idx):
+        """Panel node of a panels row."""
+        count, first, args = self.row('panels', idx)
+        return nodes.Panel(count, tuple(self.string(self.row('args', arg)[0])
+                                        for arg in range(first,
+                                                         first + args)))
+
+    def node(self, name, idx):
+        """Decode the node of a row of a level table, with its children."""
+        first, count, opts_first, opts_count = self.row(name, idx)
+        children = dict(LEVEL_TABLES)[name]
+        if children == 'rows':
+            kids = []
+            for row in range(first, first + count):
+                panels_first, panels = self.row('rows', row)
+                kids.append(tuple(self.panel(panel) for panel in
+                                  range(panels_first, panels_first + panels)))
+        else:
+            kids = [self.node(children, kid)
+                    for kid in range(first, first + count)]
+        return NODE_TYPES[name](tuple(kids),
+                                self.opts(opts_first, opts_count))
+
+
+def loads(data):
+    """Read syntax trees from tree file bytes."""
+    return TreeFile(data)
+
+
+def load(path, use_mmap=True):
+    """Open a tree file, memory-mapped where possible. Empty files,
+    which can't be mapped, are read and refused as not tree files.
+    """
+    handle = open(path, 'rb')
+    try:
+        if (use_mmap and mmap is not None and
+                os.fstat(handle.fileno()).st_size > 0):
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = handle.read()
+        return TreeFile(data, handle)
+    except Exception:
+        handle.close()
+        raise
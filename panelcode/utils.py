@@ -2,32 +2,86 @@
 # -*- coding: utf-8 -*-
 """Utility functions for paneler.
 Used to load data, save rendered output, and preview results.
-Also contains wrappers for picking and status functions.
+Also contains wrappers for picking, tree files and status functions.
 """
 
 from __future__ import print_function
+import hashlib
+import io
 import os
 import pickle
 import shutil
 
-
-def copy_styles():
-    """Copy styles from source into output folder."""
-    src = sketchPath() + '/styles'
-    dest = sketchPath() + '/data/output/styles'
+import panelcode.lazy as lazy
+import panelcode.treefile as treefile
+
+render = lazy.LazyModule('panelcode.render')
+templates = lazy.LazyModule('panelcode.templates')
+
+
+def copy_styles(src='', dest=''):
+    """Copy styles from source into output folder.
+    Only copies files that are new or changed, by content hash.
+    """
+    if src == '':
+        src = sketchPath() + '/styles'
+    if dest == '':
+        dest = sketchPath() + '/data/output/styles'
+    for dirpath, _, filenames in os.walk(src):
+        destpath = os.path.join(dest, os.path.relpath(dirpath, src))
+        for filename in filenames:
+            srcfile = os.path.join(dirpath, filename)
+            destfile = os.path.join(destpath, filename)
+            try:
+                if file_hash(srcfile) == file_hash(destfile):
+                    continue
+                if not os.path.isdir(destpath):
+                    os.makedirs(destpath)
+                shutil.copy2(srcfile, destfile)
+            # eg. src and dest are the same file, or can't be written
+            except (shutil.Error, EnvironmentError):  # as err:
+                # print('Error: %s' % err)
+                pass
+
+
+def file_hash(filepath):
+    """Sha1 hex digest of a file's contents, or None if it is missing."""
     try:
-        shutil.copytree(src, dest)
-    # eg. src and dest are the same file
-    except shutil.Error:  # as err:
-        # print('Error: %s' % err)
-        pass
-    # eg. source or destination doesn't exist
-    except IOError:  # as err:
-        # print('Error: %s' % err.strerror)
-        pass
-    except OSError:  # as err:
-        # print('Error: %s' % err.strerror)
-        pass
+        with open(filepath, 'rb') as infile:
+            return hashlib.sha1(infile.read()).hexdigest()
+    except EnvironmentError:
+        return None
+
+
+def publish_styles(path='', names=None, subdir='styles/'):
+    """Write page stylesheets (by default render.PAGE_STYLESHEETS)
+    once for a batch of pages, under content-hashed filenames,
+    e.g. styles/site.0123456789ab.css, and return their urls relative
+    to path, for pages to link (see render.html_page_wrapper). Files
+    with unchanged content are already there and are not written
+    again. As a file's name changes with its content, servers can let
+    browsers and CDNs cache them indefinitely.
+    """
+    if path == '':
+        path = sketchPath() + '/data/output/'
+    if names is None:
+        names = render.PAGE_STYLESHEETS
+    urls = []
+    for name in names:
+        data = templates.source(filename=name).encode('utf-8')
+        stem, ext = os.path.splitext(os.path.basename(name))
+        url = subdir + '%s.%s%s' % (stem, hashlib.sha1(data).hexdigest()[:12],
+                                    ext)
+        filepath = path + url
+        if not os.path.exists(filepath):
+            if not os.path.isdir(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            # write then rename, so a file at a hashed name is complete
+            with open(filepath + '.tmp', 'wb') as outfile:
+                outfile.write(data)
+            os.rename(filepath + '.tmp', filepath)
+        urls.append(url)
+    return urls
 
 
 def exists(filename, path=''):
@@ -82,6 +136,32 @@ def pickle_remove(filename, path=''):
         print(err)
 
 
+def tree_dump(trees, filename, path=''):
+    """Save panelcode syntax trees to a binary tree file."""
+    if path == '':
+        path = sketchPath() + '/data/output/'
+    try:
+        treefile.dump(trees, path + filename)
+    except EnvironmentError as err:
+        print(filename + ' not saved.')
+        print(err)
+        raise
+
+
+def tree_load(filename, path=''):
+    """Open a binary tree file of panelcode syntax trees.
+    Returns a sequence of trees; close() it when done.
+    """
+    if path == '':
+        path = sketchPath() + '/data/output/'
+    try:
+        return treefile.load(path + filename)
+    except EnvironmentError as err:
+        print(filename + ' not loaded.')
+        print(err)
+        raise
+
+
 def preview(filename='index.html', path=''):
     """Open file preview in default web browser (on macOS)."""
     if path == '':
@@ -97,6 +177,19 @@ def save_page(file_str, filename='index.html', path=''):
     saveStrings(filepath, [file_str])
 
 
+def stream_page(chunks, filename='index.html', path=''):
+    """Save page to output directory, writing html chunks as they come
+    (see render.iter_page_wrapper). Saves the same file as save_page.
+    """
+    if path == '':
+        path = sketchPath() + '/data/output/'
+    filepath = path + filename
+    with io.open(filepath, 'w', encoding='utf-8') as outfile:
+        for chunk in chunks:
+            outfile.write(unicode(chunk))
+        outfile.write(u'\n')
+
+
 def status():
     """Print working status to console."""
     print(sketchPath())
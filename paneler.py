@@ -4,10 +4,12 @@
 
 from __future__ import print_function
 import argparse
+import codecs
 import os
 import sys
 
 import panelcode
+from panelcode import parser
 from panelcode import render
 
 def decode(args):
@@ -20,13 +22,29 @@ def decode(args):
         else:
             data_list.append(line.decode('utf8'))
     if data_list:
-        result_list = render.parse_fenced_to_html(data_list, mode='pre', fmt=args.type)
+        # write html to stdout as it is rendered
         try:
-            sys.stdout.write('\n'.join(result_list).encode('utf-8'))
+            render.stream_fenced_to_html(
+                data_list, sys.stdout, mode='pre', fmt=args.type,
+                consoles='lazy' if args.lazy_consoles else True,
+                jobs=args.jobs or None, out_dir=args.out_dir)
         except TypeError as err:
             print(err)
 
 
+def decode_panelcode(args):
+    """Read in one panelcode block, emit html rendering gallery by
+    gallery as it is parsed (see parser.GalleryStream)."""
+
+    try:
+        stream = parser.GalleryStream(codecs.getreader('utf8')(sys.stdin))
+        render.write_html(render.iter_html5_ccs3_grid(stream), sys.stdout)
+    except parser.pp.ParseException as err:
+        print(err, file=sys.stderr)
+        return 1
+    return 0
+
+
 if __name__ == "__main__":
     DESC = """A panelcode parser and renderer."""
     AP = argparse.ArgumentParser(
@@ -36,5 +54,19 @@ if __name__ == "__main__":
         formatter_class=argparse.RawDescriptionHelpFormatter)
     AP.add_argument('-t', '--type', default='markdown',
                     help='set output type to: markdown, html, htmlpage')
+    AP.add_argument('-l', '--lazy-consoles', action='store_true',
+                    help='insert console code only when a console is opened')
+    AP.add_argument('-j', '--jobs', type=int, default=1,
+                    help='processes to parse and render with, '
+                    'default 1, 0 for one per core')
+    AP.add_argument('-d', '--out-dir', default=None,
+                    help='directory the output is saved in, where a '
+                    'custom.css to link is looked for, default that of '
+                    'the output file, else the current directory')
+    AP.add_argument('-p', '--panelcode', action='store_true',
+                    help='read one panelcode block rather than a document, '
+                    'rendered one gallery at a time')
     CL_ARGS = AP.parse_args()
+    if CL_ARGS.panelcode:
+        sys.exit(decode_panelcode(CL_ARGS))
     decode(CL_ARGS)